@@ -0,0 +1,115 @@
+"""Benchmark of `convert_to_training_data` and `do_rotations` on synthetic events.
+
+Generates raw events with the same branches as the ServiceX output (see
+`calratio_training_data.synthetic`) and times the conversion, and the rotations on
+their own, at several sizes. The peak memory (tracemalloc, which sees all the numpy
+buffers awkward allocates) is measured in a second pass, so it does not slow the
+timing down. No ServiceX access is needed, and the same seed always gives the same
+events, so runs on the same machine can be compared.
+
+    python benchmarks/bench_convert.py qcd signal --sizes 1000,100000,1000000 \\
+        --json-out baseline.json
+"""
+
+import json
+import time
+import tracemalloc
+from typing import Callable, List, Optional, Tuple
+
+import awkward as ak
+import typer
+
+from calratio_training_data.fetch import DataType
+from calratio_training_data.processing import do_rotations
+from calratio_training_data.synthetic import generate_raw_events
+from calratio_training_data.training_query import convert_to_training_data
+
+DS_NAME = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+
+
+def measure(fn: Callable[[], object], memory: bool) -> Tuple[float, Optional[float]]:
+    "Wall time in seconds, and peak traced memory in MB if asked for"
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    if not memory:
+        return elapsed, None
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak / 1_048_576
+
+
+def rotation_inputs(raw: ak.Array, data_type: DataType):
+    "The per-jet tracks, clusters and muon segments `do_rotations` works on"
+    unrotated = convert_to_training_data(raw, data_type, DS_NAME, rotation=False)
+    jets = ak.zip(
+        {"pt": unrotated.pt, "eta": unrotated.eta, "phi": unrotated.phi},
+        with_name="Momentum3D",
+    )
+    return unrotated, jets
+
+
+def main(
+    data_types: List[DataType] = typer.Argument(
+        ..., help="Types of data to generate (signal, qcd, bib)"
+    ),
+    sizes: str = typer.Option(
+        "1000,100000,1000000", "--sizes", help="Comma separated numbers of events"
+    ),
+    pileup: float = typer.Option(60.0, "--pileup", help="Mean pileup of the events"),
+    seed: int = typer.Option(0, "--seed", help="Random seed for the events"),
+    memory: bool = typer.Option(
+        True, "--memory/--no-memory", help="Also measure the peak memory"
+    ),
+    json_out: Optional[str] = typer.Option(
+        None, "--json-out", help="Write the results to this file as well"
+    ),
+):
+    results = []
+    print(
+        f"{'type':>7} {'events':>9} {'step':>16} {'time [s]':>9} {'events/s':>10} "
+        f"{'peak [MB]':>10}"
+    )
+    for data_type in data_types:
+        for n_events in [int(s) for s in sizes.split(",")]:
+            raw = generate_raw_events(n_events, data_type, pileup=pileup, seed=seed)
+            unrotated, jets = rotation_inputs(raw, data_type)
+
+            steps = {
+                "convert": lambda: convert_to_training_data(
+                    raw, data_type, DS_NAME, rotation=True
+                ),
+                "rotate tracks": lambda: do_rotations(unrotated.tracks, "track", jets),
+                "rotate clusters": lambda: do_rotations(unrotated.clusters, "cluster"),
+                "rotate msegs": lambda: do_rotations(unrotated.msegs, "mseg", jets),
+            }
+            for step, fn in steps.items():
+                elapsed, peak = measure(fn, memory)
+                peak_text = f"{peak:>10.1f}" if peak is not None else f"{'-':>10}"
+                print(
+                    f"{data_type.value:>7} {n_events:>9} {step:>16} {elapsed:>9.3f} "
+                    f"{n_events / elapsed:>10.0f} {peak_text}"
+                )
+                results.append(
+                    {
+                        "datatype": data_type.value,
+                        "events": n_events,
+                        "jets": len(unrotated),
+                        "step": step,
+                        "seconds": elapsed,
+                        "peak_mb": peak,
+                    }
+                )
+
+    if json_out is not None:
+        with open(json_out, "w") as f:
+            json.dump({"pileup": pileup, "seed": seed, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,73 @@
+"""Start-up time of the command line and the modules behind each command.
+
+Each entry point is run in a fresh interpreter several times, and the best time,
+less that of an empty interpreter, is compared against its budget. The exit code is
+1 if anything is over budget, so this can run as a check in a batch setup.
+
+    python benchmarks/bench_import.py --repeat 5
+"""
+
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import typer
+
+# What to run, and how long it may take (seconds on top of the bare interpreter).
+ENTRY_POINTS: Dict[str, List[str]] = {
+    "cli --help": ["-m", "calratio_training_data.fetch", "--help"],
+    "training-file": ["-c", "import calratio_training_data.combining"],
+    "reprocess": ["-c", "import calratio_training_data.training_query"],
+    "fetch": [
+        "-c",
+        "import calratio_training_data.training_query, calratio_training_data.query",
+    ],
+}
+BUDGETS: Dict[str, float] = {
+    "cli --help": 0.3,
+    "training-file": 0.8,
+    "reprocess": 1.0,
+    "fetch": 2.5,
+}
+
+
+def best_time(args: List[str], repeat: int) -> float:
+    "Fastest wall time of running python with `args`"
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(
+    repeat: int = typer.Option(5, "--repeat", help="Runs of each entry point"),
+    budget_scale: float = typer.Option(
+        1.0, "--budget-scale", help="Multiply the budgets by this (slow machines)"
+    ),
+):
+    baseline = best_time(["-c", "pass"], repeat)
+    print(f"empty interpreter: {baseline:0.3f} s")
+    print(f"{'entry point':>14} {'time [s]':>9} {'budget [s]':>11}")
+
+    over = []
+    for name, args in ENTRY_POINTS.items():
+        elapsed = best_time(args, repeat) - baseline
+        budget = BUDGETS[name] * budget_scale
+        flag = "" if elapsed <= budget else "  OVER BUDGET"
+        print(f"{name:>14} {elapsed:>9.3f} {budget:>11.3f}{flag}")
+        if elapsed > budget:
+            over.append(name)
+
+    if len(over) > 0:
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
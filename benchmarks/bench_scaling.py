@@ -0,0 +1,95 @@
+"""How the time of each stage of `convert_to_training_data` grows with the number of
+jets.
+
+Synthetic events (see `calratio_training_data.synthetic`) are converted at several
+sizes, with the per-stage timings the conversion records. For each stage the time
+per jet is printed, along with the scaling exponent between the smallest and largest
+size: 1.0 is linear, 2.0 quadratic. The exit code is 1 if the whole conversion grows
+faster than `--max-exponent`, so this can run as a check in a batch setup.
+
+    python benchmarks/bench_scaling.py qcd bib --sizes 30000,100000,300000
+
+`--engine numba` times the compiled matching and rotations instead.
+"""
+
+import math
+import time
+from typing import Dict, List
+
+import typer
+
+from calratio_training_data.constants import Engine
+from calratio_training_data.fetch import DataType
+from calratio_training_data.metrics import StageTimes, recording
+from calratio_training_data.synthetic import generate_raw_events
+from calratio_training_data.training_query import convert_to_training_data
+
+DS_NAME = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+
+# Stages quicker than this at the largest size are too noisy to fit an exponent to.
+MIN_SECONDS = 0.05
+
+
+def exponent(jets: List[int], seconds: List[float]) -> float:
+    "Slope of log(time) against log(jets), between the first and last size"
+    return math.log(seconds[-1] / seconds[0]) / math.log(jets[-1] / jets[0])
+
+
+def main(
+    data_types: List[DataType] = typer.Argument(
+        ..., help="Types of data to generate (signal, qcd, bib)"
+    ),
+    sizes: str = typer.Option(
+        "30000,100000,300000", "--sizes", help="Comma separated numbers of events"
+    ),
+    pileup: float = typer.Option(60.0, "--pileup", help="Mean pileup of the events"),
+    seed: int = typer.Option(0, "--seed", help="Random seed for the events"),
+    max_exponent: float = typer.Option(
+        1.2, "--max-exponent", help="Fail if the conversion scales worse than this"
+    ),
+    engine: Engine = typer.Option(
+        Engine.AWKWARD, "--engine", help="How to do the matching and rotations"
+    ),
+):
+    too_slow = []
+    for data_type in data_types:
+        jets: List[int] = []
+        totals: List[float] = []
+        stages: Dict[str, List[float]] = {}
+        for n_events in [int(s) for s in sizes.split(",")]:
+            raw = generate_raw_events(n_events, data_type, pileup=pileup, seed=seed)
+            times = StageTimes()
+            start = time.perf_counter()
+            with recording(times):
+                result = convert_to_training_data(
+                    raw, data_type, DS_NAME, engine=engine
+                )
+            totals.append(time.perf_counter() - start)
+            jets.append(len(result))
+            for name, seconds in times.stages.items():
+                stages.setdefault(name, []).append(seconds)
+            del raw, result
+
+        print(f"\n{data_type.value}: {', '.join(f'{j} jets' for j in jets)}")
+        print(f"{'stage':>18} {'us/jet at each size':>30} {'exponent':>9}")
+        rows = [(name, seconds) for name, seconds in stages.items()]
+        rows.append(("total", totals))
+        for name, seconds in rows:
+            per_jet = " ".join(f"{1e6 * s / j:>9.2f}" for s, j in zip(seconds, jets))
+            fit = (
+                f"{exponent(jets, seconds):>9.2f}"
+                if seconds[-1] >= MIN_SECONDS and len(jets) > 1
+                else f"{'-':>9}"
+            )
+            print(f"{name:>18} {per_jet:>30} {fit}")
+
+        if len(jets) > 1 and exponent(jets, totals) > max_exponent:
+            too_slow.append(data_type.value)
+
+    if len(too_slow) > 0:
+        print(f"\nScales worse than jets^{max_exponent}: {', '.join(too_slow)}")
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
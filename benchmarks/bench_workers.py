@@ -0,0 +1,72 @@
+"""Scaling benchmark for converting ServiceX output files in parallel.
+
+Runs the conversion of a fixed set of ServiceX output files (`atlas_xaod_tree`
+ROOT files, e.g. from the ServiceX cache) with 1, 2, 4, ... up to N worker
+processes and prints the wall time, speed up and throughput for each.
+
+    python benchmarks/bench_workers.py qcd "/path/to/cache/*.root" --max-workers 32
+"""
+
+import time
+from functools import partial
+from glob import glob
+from typing import List
+
+import typer
+
+from calratio_training_data.fetch import DataType
+from calratio_training_data.parallel_utils import process_map
+from calratio_training_data.training_query import RunConfig, convert_file
+
+
+def worker_counts(max_workers: int) -> List[int]:
+    "1, 2, 4, ... up to and including max_workers"
+    counts = []
+    n = 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+    return counts
+
+
+def main(
+    data_type: DataType = typer.Argument(..., help="Type of data in the files"),
+    files: str = typer.Argument(..., help="Glob pattern for the ServiceX output files"),
+    max_workers: int = typer.Option(8, "--max-workers", "-j", help="Largest pool size"),
+    ds_name: str = typer.Option(
+        "bench_mH125_mS40_ct1",
+        "--ds-name",
+        help="Dataset name used to build the signal descriptive label",
+    ),
+    rotation: bool = typer.Option(True, "--rotation/--no-rotation"),
+):
+    file_list = sorted(glob(files))
+    if not file_list:
+        raise typer.BadParameter(f"No files match {files}")
+
+    config = RunConfig(datatype=data_type, rotation=rotation, desc_label="bench")
+    fn = partial(convert_file, ds_name=ds_name, config=config)
+
+    print(f"Converting {len(file_list)} files of type {data_type.value}")
+    print(
+        f"{'workers':>8} {'time [s]':>10} {'speedup':>8} {'files/s':>8} {'jets/s':>10}"
+    )
+    baseline = None
+    for n in worker_counts(max_workers):
+        start = time.perf_counter()
+        n_jets = sum(
+            len(c)
+            for _, chunks, _ in process_map(fn, file_list, workers=n)
+            for c in chunks
+        )
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(
+            f"{n:>8} {elapsed:>10.2f} {baseline / elapsed:>8.2f} "
+            f"{len(file_list) / elapsed:>8.2f} {n_jets / elapsed:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
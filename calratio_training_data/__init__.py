@@ -1,7 +1,29 @@
-from .training_query import (  # noqa
-    fetch_training_data,
-    fetch_training_data_to_file,
-    build_preselection,
-    run_query,
-    RunConfig,
-)
+import importlib
+from typing import TYPE_CHECKING, Any
+
+# The ServiceX and func_adl packages take a second or more to import. Load them
+# only when something from them is first used, so the command line starts fast.
+_LAZY = {
+    "fetch_training_data": "training_query",
+    "fetch_training_data_to_file": "training_query",
+    "run_query": "training_query",
+    "RunConfig": "training_query",
+    "build_preselection": "query",
+}
+
+__all__ = list(_LAZY)
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .query import build_preselection  # noqa
+    from .training_query import (  # noqa
+        fetch_training_data,
+        fetch_training_data_to_file,
+        run_query,
+        RunConfig,
+    )
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{_LAZY[name]}", __name__), name)
@@ -0,0 +1,388 @@
+from dataclasses import dataclass
+from typing import Tuple
+
+import awkward as ak
+import numpy as np
+
+from calratio_training_data.constants import Engine
+from calratio_training_data.kinematics import delta_phi, delta_r, flat_lists
+
+# Cells (and phi windows) are made a little bigger than the matching cut so that
+# rounding in the float32 deltaR or deltaphi can never match a pair that was not
+# looked at. The exact cut is applied to the candidates afterwards.
+_CELL_MARGIN = 1e-3
+
+# Below this many (jet, object) pairs per jet on average, trying every pair is
+# quicker than the binary searches of the cell or phi window lookups.
+_ALL_PAIRS_PER_JET_DELTA_R = 32
+_ALL_PAIRS_PER_JET_DELTA_PHI = 8
+
+# Events are kept apart in the sorted phi keys by offsetting each by more than
+# 2 pi. A power of two, so the offsets are exact.
+_EVENT_SPACING = 8.0
+
+
+def _flat(values: ak.Array) -> np.ndarray:
+    return ak.to_numpy(ak.flatten(values, axis=1))
+
+
+def _offsets(counts: np.ndarray) -> np.ndarray:
+    "Where each list starts in the flattened array"
+    return np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+
+def _turn(phi: np.ndarray) -> np.ndarray:
+    "Angle round from -pi, in [0, 2 pi)"
+    turn = phi.astype(np.float64) + np.pi
+    with np.errstate(invalid="ignore"):
+        outside = (turn < 0) | (turn >= 2 * np.pi)
+    if outside.any():
+        turn[outside] %= 2 * np.pi
+    return turn
+
+
+def _cells(
+    eta: np.ndarray, phi: np.ndarray, eta_size: float, n_phi: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    "The (eta, phi) cell of each point. phi cells wrap around."
+    i_eta = np.floor(eta / eta_size).astype(np.int64)
+    i_phi = np.floor((phi + np.pi) / (2 * np.pi / n_phi)).astype(np.int64) % n_phi
+    return i_eta, i_phi
+
+
+def _candidates(start: np.ndarray, count: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Every position in the ranges `[start, start + count)` of each jet, with the jet
+    it belongs to. `start` and `count` are jets * ranges.
+    """
+    ranges_per_jet = start.shape[1]
+    start, count = start.ravel(), count.ravel()
+    first = np.cumsum(count) - count
+    position = (
+        np.arange(int(count.sum())) - np.repeat(first, count) + np.repeat(start, count)
+    )
+    jet = np.repeat(np.arange(len(start)) // ranges_per_jet, count)
+    return position, jet
+
+
+@dataclass
+class Association:
+    """The objects associated with each jet: the index (within its event) of every
+    matched object, in increasing order, and its distance from the jet. Both are
+    events * jets * var.
+
+    The matching is done once per type of object. Masks, nearest matches and the
+    matched records all come from this.
+    """
+
+    index: ak.Array
+    distance: ak.Array
+
+    def matched(self) -> ak.Array:
+        "True for jets with at least one matched object, events * jets"
+        return ak.num(self.index, axis=2) > 0
+
+    def nearest(self) -> ak.Array:
+        "Index of the closest matched object, events * jets (None if no match)"
+        closest = ak.argmin(self.distance, axis=2, keepdims=True)
+        return ak.firsts(self.index[closest], axis=2)
+
+    def select(self, mask: ak.Array) -> "Association":
+        "Only the jets in `mask`, events * jets"
+        return Association(self.index[mask], self.distance[mask])
+
+    def take(self, objects: ak.Array) -> ak.Array:
+        """Pick out the matched objects for each jet.
+
+        Args:
+            objects (ak.Array): Per-event objects, events * var, that were matched.
+
+        Returns:
+            ak.Array: The matched objects, events * jets * var.
+        """
+        n_objects = ak.to_numpy(ak.num(objects, axis=1))
+        n_jets = ak.to_numpy(ak.num(self.index, axis=1))
+        per_jet = ak.to_numpy(ak.flatten(ak.num(self.index, axis=2), axis=None))
+        jet_event = np.repeat(np.arange(len(n_jets)), n_jets)
+        flat_index = ak.to_numpy(ak.flatten(self.index, axis=None))
+        flat_index = flat_index + _offsets(n_objects)[np.repeat(jet_event, per_jet)]
+        flat = ak.flatten(objects, axis=1)[flat_index]
+        return ak.unflatten(ak.unflatten(flat, per_jet), n_jets)
+
+
+def _association(
+    jet: np.ndarray,
+    obj: np.ndarray,
+    distance: np.ndarray,
+    n_jets: np.ndarray,
+    n_objects: np.ndarray,
+) -> Association:
+    """Per-jet lists from matched pairs of flat jet and object indices, ordered by
+    jet and then by object, with the object index made relative to its event.
+    """
+    order = np.argsort(jet * max(int(n_objects.sum()), 1) + obj)
+    jet, obj, distance = jet[order], obj[order], distance[order]
+    jet_event = np.repeat(np.arange(len(n_jets)), n_jets)
+    index = obj - _offsets(n_objects)[jet_event[jet]]
+    per_jet = np.bincount(jet, minlength=int(n_jets.sum()))
+    return _per_jet_association(index, distance, per_jet, n_jets)
+
+
+def _per_jet_association(
+    index: np.ndarray, distance: np.ndarray, per_jet: np.ndarray, n_jets: np.ndarray
+) -> Association:
+    "Flat matches, ordered by jet, split up by jet and then by event"
+
+    def per_jet_lists(values: np.ndarray) -> ak.Array:
+        return ak.unflatten(ak.unflatten(values, per_jet), n_jets)
+
+    return Association(per_jet_lists(index), per_jet_lists(distance))
+
+
+def _few_pairs(n_jets: np.ndarray, n_objects: np.ndarray, per_jet: int) -> bool:
+    "True if there are few enough (jet, object) pairs to try them all"
+    return int(np.dot(n_jets, n_objects)) <= per_jet * int(n_jets.sum())
+
+
+def _all_pairs(
+    jet_event: np.ndarray, n_objects: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    "Every (jet, object) pair in each event, as flat object and jet indices"
+    return _candidates(
+        _offsets(n_objects)[jet_event][:, np.newaxis],
+        n_objects[jet_event][:, np.newaxis],
+    )
+
+
+def _cell_candidates(
+    jet_event: np.ndarray,
+    jet_eta: np.ndarray,
+    jet_phi: np.ndarray,
+    n_objects: np.ndarray,
+    obj_eta: np.ndarray,
+    obj_phi: np.ndarray,
+    max_delta_r: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The (jet, object) pairs, as flat indices, of the objects in each jet's own
+    and neighbouring (eta, phi) cells.
+    """
+    cell = max_delta_r * (1 + _CELL_MARGIN)
+    n_phi = max(int(2 * np.pi // cell), 1)
+    with np.errstate(invalid="ignore"):
+        jet_i_eta, jet_i_phi = _cells(jet_eta, jet_phi, cell, n_phi)
+        obj_i_eta, obj_i_phi = _cells(obj_eta, obj_phi, cell, n_phi)
+
+    # NaN's never pass the cut. Their objects get a key no jet looks for.
+    jet_ok = np.isfinite(jet_eta) & np.isfinite(jet_phi)
+    obj_ok = np.isfinite(obj_eta) & np.isfinite(obj_phi)
+    jet_i_eta[~jet_ok] = 0
+    obj_i_eta[~obj_ok] = 0
+
+    # One sortable key per (event, eta cell, phi cell), with room for the
+    # neighbouring eta cells of the jets.
+    eta_lo = min(jet_i_eta.min(initial=0), obj_i_eta.min(initial=0)) - 1
+    n_eta = max(jet_i_eta.max(initial=0), obj_i_eta.max(initial=0)) - eta_lo + 2
+
+    def key(event: np.ndarray, i_eta: np.ndarray, i_phi: np.ndarray) -> np.ndarray:
+        return (event * n_eta + (i_eta - eta_lo)) * n_phi + i_phi
+
+    # Objects sorted by cell (stable, so they stay in order within a cell).
+    obj_key = key(np.repeat(np.arange(len(n_objects)), n_objects), obj_i_eta, obj_i_phi)
+    obj_key[~obj_ok] = -1
+    del obj_i_eta, obj_i_phi, obj_ok
+    sorted_obj = np.argsort(obj_key, kind="stable")
+    sorted_key = obj_key[sorted_obj]
+    del obj_key
+
+    # The range of sorted objects in each neighbouring cell of each jet. With fewer
+    # than 3 phi cells the neighbours overlap, so only distinct ones are used.
+    phi_steps = sorted({s % n_phi for s in (-1, 0, 1)})
+    neighbours = np.stack(
+        [
+            key(jet_event, jet_i_eta + d_eta, (jet_i_phi + d_phi) % n_phi)
+            for d_eta in (-1, 0, 1)
+            for d_phi in phi_steps
+        ],
+        axis=1,
+    )
+    neighbours[~jet_ok] = -2
+    start = np.searchsorted(sorted_key, neighbours, side="left")
+    n_in_cell = np.searchsorted(sorted_key, neighbours, side="right") - start
+    position, cand_jet = _candidates(start, n_in_cell)
+    cand_obj = sorted_obj[position]
+
+    return cand_jet, cand_obj
+
+
+def _window_candidates(
+    jet_event: np.ndarray,
+    jet_phi: np.ndarray,
+    n_objects: np.ndarray,
+    obj_phi: np.ndarray,
+    max_delta_phi: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The (jet, object) pairs, as flat indices, of the objects in each jet's phi
+    window.
+    """
+    # Objects sorted by phi within each event, on one axis: event * _EVENT_SPACING +
+    # phi + pi. NaN's go past the end of their event, where no window reaches.
+    obj_key = _turn(obj_phi)
+    obj_key[np.isnan(obj_key)] = _EVENT_SPACING - 1
+    obj_key += np.repeat(np.arange(len(n_objects)), n_objects) * _EVENT_SPACING
+    sorted_obj = np.argsort(obj_key)
+    sorted_key = obj_key[sorted_obj]
+    del obj_key
+
+    # Each jet's window, clipped to its event's [0, 2 pi], and the piece that wraps
+    # around the other end if it goes past one.
+    width = max_delta_phi * (1 + _CELL_MARGIN)
+    event_key = jet_event * _EVENT_SPACING
+    lo = _turn(jet_phi) - width
+    hi = lo + 2 * width
+    start = np.zeros((len(lo), 2), dtype=np.int64)
+    count = np.zeros((len(lo), 2), dtype=np.int64)
+    with np.errstate(invalid="ignore"):
+        ok = ~np.isnan(lo)
+        if width >= np.pi:
+            lo[ok], hi[ok] = 0.0, 2 * np.pi
+        wraps = np.flatnonzero(ok & ((lo < 0) | (hi > 2 * np.pi)))
+        wrap_lo = np.where(lo[wraps] < 0, lo[wraps] + 2 * np.pi, 0.0)
+        wrap_hi = np.where(lo[wraps] < 0, 2 * np.pi, hi[wraps] - 2 * np.pi)
+        lo, hi = np.maximum(lo, 0.0), np.minimum(hi, 2 * np.pi)
+
+    def window(rows: np.ndarray, column: int, lo: np.ndarray, hi: np.ndarray):
+        start[rows, column] = np.searchsorted(
+            sorted_key, event_key[rows] + lo, side="left"
+        )
+        count[rows, column] = (
+            np.searchsorted(sorted_key, event_key[rows] + hi, side="right")
+            - start[rows, column]
+        )
+
+    window(np.flatnonzero(ok), 0, lo[ok], hi[ok])
+    window(wraps, 1, wrap_lo, wrap_hi)
+    position, cand_jet = _candidates(start, count)
+    cand_obj = sorted_obj[position]
+
+    return cand_jet, cand_obj
+
+
+def delta_r_matches(
+    jets: ak.Array,
+    objects: ak.Array,
+    max_delta_r: float,
+    engine: Engine = Engine.AWKWARD,
+) -> Association:
+    """For each jet, the index (within its event) of every object closer than
+    `max_delta_r` in deltaR. Gives the same pairs as a cut on `deltaR` over
+    `ak.cartesian` of jets and objects, without looking at every pair.
+
+    The objects in each event are binned in (eta, phi) cells at least `max_delta_r`
+    across, and each jet is only compared with the objects in its own and the 8
+    neighbouring cells (wrapping around in phi). The numba engine tries every pair
+    in a compiled loop instead.
+
+    Args:
+        jets (ak.Array): Per-event jets, with `eta` and `phi`.
+        objects (ak.Array): Per-event objects (e.g. tracks) with `eta` and `phi`,
+            with the same number of events as `jets`.
+        max_delta_r (float): Matching cone size.
+        engine (Engine): How to do the matching.
+
+    Returns:
+        Association: The matched objects, with their deltaR from the jet.
+    """
+    if engine == Engine.NUMBA:
+        from calratio_training_data import numba_kernels
+
+        jet_eta, jet_offsets = flat_lists(jets.eta)
+        obj_eta, obj_offsets = flat_lists(objects.eta)
+        per_jet, index, distance = numba_kernels.delta_r_pairs(
+            jet_eta,
+            _flat(jets.phi),
+            jet_offsets,
+            obj_eta,
+            _flat(objects.phi),
+            obj_offsets,
+            max_delta_r,
+        )
+        return _per_jet_association(index, distance, per_jet, np.diff(jet_offsets))
+
+    n_jets = ak.to_numpy(ak.num(jets, axis=1))
+    n_objects = ak.to_numpy(ak.num(objects, axis=1))
+    jet_eta, jet_phi = _flat(jets.eta), _flat(jets.phi)
+    obj_eta, obj_phi = _flat(objects.eta), _flat(objects.phi)
+    jet_event = np.repeat(np.arange(len(n_jets)), n_jets)
+
+    if _few_pairs(n_jets, n_objects, _ALL_PAIRS_PER_JET_DELTA_R):
+        cand_obj, cand_jet = _all_pairs(jet_event, n_objects)
+    else:
+        cand_jet, cand_obj = _cell_candidates(
+            jet_event, jet_eta, jet_phi, n_objects, obj_eta, obj_phi, max_delta_r
+        )
+
+    # Same calculation as `jet.deltaR(object)` on the Momentum3D records.
+    distance = delta_r(
+        jet_eta[cand_jet], jet_phi[cand_jet], obj_eta[cand_obj], obj_phi[cand_obj]
+    )
+    keep = distance < max_delta_r
+
+    return _association(
+        cand_jet[keep], cand_obj[keep], distance[keep], n_jets, n_objects
+    )
+
+
+def delta_phi_matches(
+    jets: ak.Array,
+    objects: ak.Array,
+    max_delta_phi: float,
+    engine: Engine = Engine.AWKWARD,
+) -> Association:
+    """For each jet, the index (within its event) of every object less than
+    `max_delta_phi` away in phi, on either side: the pairs passing
+    `abs(jet.deltaphi(object)) < max_delta_phi` over `ak.cartesian` of jets and
+    objects, without looking at every pair.
+
+    The objects in each event are sorted by phi, and each jet's window
+    `[phi - max_delta_phi, phi + max_delta_phi]` (in two pieces where it wraps
+    around +-pi) is found with a binary search. The numba engine tries every pair in
+    a compiled loop instead.
+
+    Args:
+        jets (ak.Array): Per-event jets, with `phi`.
+        objects (ak.Array): Per-event objects (e.g. muon segments) with `phi`,
+            with the same number of events as `jets`.
+        max_delta_phi (float): Half width of the window.
+        engine (Engine): How to do the matching.
+
+    Returns:
+        Association: The matched objects, with their abs(deltaphi) from the jet.
+    """
+    if engine == Engine.NUMBA:
+        from calratio_training_data import numba_kernels
+
+        jet_phi, jet_offsets = flat_lists(jets.phi)
+        obj_phi, obj_offsets = flat_lists(objects.phi)
+        per_jet, index, distance = numba_kernels.delta_phi_pairs(
+            jet_phi, jet_offsets, obj_phi, obj_offsets, max_delta_phi
+        )
+        return _per_jet_association(index, distance, per_jet, np.diff(jet_offsets))
+
+    n_jets = ak.to_numpy(ak.num(jets, axis=1))
+    n_objects = ak.to_numpy(ak.num(objects, axis=1))
+    jet_phi, obj_phi = _flat(jets.phi), _flat(objects.phi)
+    jet_event = np.repeat(np.arange(len(n_jets)), n_jets)
+
+    if _few_pairs(n_jets, n_objects, _ALL_PAIRS_PER_JET_DELTA_PHI):
+        cand_obj, cand_jet = _all_pairs(jet_event, n_objects)
+    else:
+        cand_jet, cand_obj = _window_candidates(
+            jet_event, jet_phi, n_objects, obj_phi, max_delta_phi
+        )
+
+    # Same calculation as `jet.deltaphi(object)`.
+    distance = np.abs(delta_phi(jet_phi[cand_jet], obj_phi[cand_obj]))
+    keep = distance < max_delta_phi
+
+    return _association(
+        cand_jet[keep], cand_obj[keep], distance[keep], n_jets, n_objects
+    )
@@ -0,0 +1,72 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Tuple, TypeVar
+
+from calratio_training_data.read_utils import read_ahead
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def _next(it: AsyncIterator[T]) -> T:
+    return await anext(it)
+
+
+async def as_completed_indexed(
+    awaitables: List[Awaitable[R]],
+) -> AsyncIterator[Tuple[int, R]]:
+    """Wait for all of `awaitables` together, returning each result as it finishes.
+
+    Args:
+        awaitables (List[Awaitable[R]]): The work to wait for.
+
+    Returns:
+        AsyncIterator[Tuple[int, R]]: The index of each awaitable in the list and its
+            result, in the order they finish.
+    """
+
+    async def indexed(index: int, aw: Awaitable[R]) -> Tuple[int, R]:
+        return index, await aw
+
+    tasks = [asyncio.ensure_future(indexed(i, aw)) for i, aw in enumerate(awaitables)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+def iterate_async(
+    make_items: Callable[[], AsyncIterator[T]], depth: int = 2
+) -> Iterator[T]:
+    """Iterate over an async iterator from ordinary (synchronous) code.
+
+    The event loop runs on a background thread (see `read_ahead`), so downloads and
+    other async work keep going while the caller works on the items it has.
+
+    Args:
+        make_items (Callable[[], AsyncIterator[T]]): Creates the async iterator. It is
+            called on the background thread, inside its event loop.
+        depth (int): How many items to keep ready for the caller.
+
+    Returns:
+        Iterator[T]: The items.
+    """
+
+    def items() -> Iterator[T]:
+        loop = asyncio.new_event_loop()
+        it = None
+        try:
+            it = make_items()
+            while True:
+                try:
+                    item = loop.run_until_complete(_next(it))
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            if it is not None and hasattr(it, "aclose"):
+                loop.run_until_complete(it.aclose())  # type: ignore
+            loop.close()
+
+    return read_ahead(items(), max(depth, 1))
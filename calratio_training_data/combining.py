@@ -7,6 +7,14 @@ import yaml
 from glob import glob
 import numpy as np
 
+from calratio_training_data.metrics import (
+    file_metrics,
+    recording,
+    report_file,
+    run_metrics,
+    stage,
+)
+
 
 @dataclass
 class InputSpec:
@@ -34,6 +42,7 @@ class CombineConfig:
     inputs: List[InputSpec]
     output_path: str = "main_training_file.parquet"
     event_filter: Optional[str] = None
+    profile_memory: bool = False
 
 
 def load_yaml_config(path: Path) -> CombineConfig:
@@ -74,34 +83,45 @@ def expand_inputs(inputs):
 
 def combine_training_data(config: CombineConfig):
 
-    arrays = []
-
-    expanded = expand_inputs(config.inputs)
-
-    for file_path, num_jets in expanded:
-
-        arr = ak.from_parquet(file_path)
-
-        if config.event_filter:
-            m = re.search(r"% (\d+)\s*==\s*(\d+)", config.event_filter)
-            mask = arr["eventNumber"] % int(m.group(1)) == int(m.group(2))
-            arr = arr[mask]
-
-        if num_jets is not None:
-            if num_jets > len(arr):
-                print(
-                    "Input num-jets is greater than number of jets in file, "
-                    "instead including all jets"
-                )
-            else:
-                # Randomly selecting jets (rows)
-                random_indices = np.random.choice(len(arr), num_jets, replace=False)
-                arr = arr[random_indices]
-
-        arrays.append(arr)
-
-    combined = ak.concatenate(arrays)
-
-    ak.to_parquet(combined, config.output_path)
+    with run_metrics(None, profile_memory=config.profile_memory):
+        arrays = []
+
+        expanded = expand_inputs(config.inputs)
+
+        for file_path, num_jets in expanded:
+
+            metrics = file_metrics(str(file_path))
+            with recording(metrics):
+                with stage("read"):
+                    arr = ak.from_parquet(file_path)
+
+                with stage("select"):
+                    if config.event_filter:
+                        m = re.search(r"% (\d+)\s*==\s*(\d+)", config.event_filter)
+                        mask = arr["eventNumber"] % int(m.group(1)) == int(m.group(2))
+                        arr = arr[mask]
+
+                    if num_jets is not None:
+                        if num_jets > len(arr):
+                            print(
+                                "Input num-jets is greater than number of jets in file, "
+                                "instead including all jets"
+                            )
+                        else:
+                            # Randomly selecting jets (rows)
+                            random_indices = np.random.choice(
+                                len(arr), num_jets, replace=False
+                            )
+                            arr = arr[random_indices]
+
+            metrics.jets = len(arr)
+            report_file(metrics)
+            arrays.append(arr)
+
+        with stage("concatenate"):
+            combined = ak.concatenate(arrays)
+
+        with stage("write"):
+            ak.to_parquet(combined, config.output_path, categorical_as_dictionary=True)
 
     return combined
@@ -3,12 +3,19 @@ from enum import Enum
 # The jet-track delta R for inclusion
 JET_TRACK_DELTA_R = 0.2
 
-# The delta phi for msegments to be considered for a jet
+# The delta phi for msegments to be considered for a jet (on either side of it:
+# abs(jet.deltaphi(segment)) < JET_MSEG_DELTA_PHI)
 JET_MSEG_DELTA_PHI = 0.2
 
 # The delta R between a LLP and a jet for the jet to be considered from the LLP
 LLP_JET_DELTA_R = 0.4
 
+# Objects skimmed in the ServiceX query (`--skim-to-jets`, `--llp-jets-only`) are kept
+# this much beyond the cuts above and below (in each cut's units), so float32 rounding
+# when converting can never miss one that is matched. The exact cuts are applied when
+# converting.
+SKIM_MARGIN = 0.01
+
 # Info specifying what range LLPs are valid for training in.
 # These are *detector* coordinates, not relative to the PV's location.
 
@@ -23,6 +30,19 @@ LLP_Lxy_max = 4000
 LLP_Lz_min = 3500
 LLP_Lz_max = 6000
 
+# The calorimeter layers whose energies are kept for each cluster, in the order the
+# ServiceX query packs them into the `clus_layers` branch.
+CLUSTER_LAYERS = [
+    "l1hcal",
+    "l2hcal",
+    "l3hcal",
+    "l4hcal",
+    "l1ecal",
+    "l2ecal",
+    "l3ecal",
+    "l4ecal",
+]
+
 # Min/Max Jet pT
 # Used for rescaling clus/track/jet pT
 min_jet_pt = 40  # GeV
@@ -37,6 +57,13 @@ class EventLabels(Enum):
     BIB = 2
 
 
+class Engine(str, Enum):
+    "How the matching and rotations are done. Both give the same output, bit for bit."
+
+    AWKWARD = "awkward"
+    NUMBA = "numba"
+
+
 # Triggers for BIB. These are in pairs. The first is the inclusive trigger
 # that should have fired, the second is the inclusive trigger with the bib
 # removal algorithm that should not have fired (e.g. the signal trigger).
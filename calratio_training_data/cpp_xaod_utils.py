@@ -2,6 +2,7 @@ import ast
 from typing import Tuple, TypeVar
 
 from func_adl import ObjectStream, func_adl_callable
+from func_adl_servicex_xaodr25 import FADLStream
 from func_adl_servicex_xaodr25.elementlink_datavector_xaod_iparticle__ import (
     ElementLink_DataVector_xAOD_IParticle__,
 )
@@ -11,6 +12,8 @@ from func_adl_servicex_xaodr25.xAOD.jet_v1 import Jet_v1
 from func_adl_servicex_xaodr25.xAOD.trackparticle_v1 import TrackParticle_v1
 from func_adl_servicex_xaodr25.xAOD.truthparticle_v1 import TruthParticle_v1
 
+from calratio_training_data.constants import CLUSTER_LAYERS
+
 T = TypeVar("T")
 
 
@@ -69,6 +72,63 @@ def track_summary_value(trk: TrackParticle_v1, value_selector: xAOD.SummaryType)
     ...
 
 
+def transfer_float_callback(
+    s: ObjectStream[T], a: ast.Call
+) -> Tuple[ObjectStream[T], ast.Call]:
+    """The cast is only wanted for some queries, and a python `if` would be sent to the
+    transformer as a C++ `?:` (whose type is the wider of the two). So the type is
+    picked here, while the query is built, from the (constant) `compact` argument.
+
+    Args:
+        s (ObjectStream[T]): The stream we are operating against
+        a (ast.Call): The actual call
+
+    Returns:
+        Tuple[ObjectStream[T], ast.Call]: Return the updated stream with the metadata code.
+    """
+    compact = a.args[1]
+    if not isinstance(compact, ast.Constant) or not isinstance(compact.value, bool):
+        raise ValueError(
+            "transfer_float needs `compact` to be a constant True or False, not "
+            f"{ast.unparse(compact)}"
+        )
+    value_type = "float" if compact.value else "double"
+
+    new_s = s.MetaData(
+        {
+            "metadata_type": "add_cpp_function",
+            "name": "transfer_float",
+            "code": [f"{value_type} result = value;"],
+            "result": "result",
+            "include_files": [],
+            "arguments": ["value", "compact"],
+            "return_type": value_type,
+        }
+    )
+    return new_s, a
+
+
+@func_adl_callable(transfer_float_callback)
+def transfer_float(value: float, compact: bool) -> float:
+    """The value as a 32 bit float if `compact` is True, otherwise unchanged.
+
+    * Use for values the transformer computes as `double` that are only needed as
+      `float`: it halves their size in the output files.
+    * Only one of the two can be used in a query.
+
+    Args:
+        value (float): The value to send back.
+        compact (bool): Cast it? Must be a constant when the query is built.
+
+    NOTE: This is a dummy function that injects C++ into the object stream to do the
+    actual work.
+
+    Returns:
+        float: The value, maybe as a 32 bit float.
+    """
+    ...
+
+
 def cvt_to_raw_calocluster_callback(
     s: ObjectStream[T], a: ast.Call
 ) -> Tuple[ObjectStream[T], ast.Call]:
@@ -119,6 +179,75 @@ def cvt_to_raw_calocluster(
     ...
 
 
+# The samplings whose energies are summed for each of `CLUSTER_LAYERS`.
+# Layer definitions come from https://gitlab.cern.ch/atlas-phys-exotics-llp-mscrid
+#     /fullrun2analysis/DiVertAnalysisR21/-/blob/master/DiVertAnalysis/Root
+#     /RegionVarCalculator_calRatio.cxx?ref_type=heads#L381
+LAYER_SAMPLINGS = {
+    "l1hcal": ["HEC0"],
+    "l2hcal": ["HEC1", "TileBar0", "TileGap1", "TileExt0"],
+    "l3hcal": ["HEC2", "TileBar1", "TileGap2", "TileExt1"],
+    "l4hcal": ["HEC3", "TileBar2", "TileGap3", "TileExt2"],
+    "l1ecal": ["PreSamplerB", "PreSamplerE"],
+    "l2ecal": ["EMB1", "EME1", "FCAL0"],
+    "l3ecal": ["EMB2", "EME2", "FCAL1"],
+    "l4ecal": ["EMB3", "EME3", "FCAL2"],
+}
+
+
+def cluster_layer_energies_callback(
+    s: ObjectStream[T], a: ast.Call
+) -> Tuple[ObjectStream[T], ast.Call]:
+    """Sum the sampling energies of all the layers in one go, so a cluster is only
+    looked at once for all of them.
+
+    Args:
+        s (ObjectStream[T]): The stream we are operating against
+        a (ast.Call): The actual call
+
+    Returns:
+        Tuple[ObjectStream[T], ast.Call]: Return the updated stream with the metadata code.
+    """
+    sums = [
+        " + ".join(
+            f"clus->eSample(CaloSampling::{sampling})"
+            for sampling in LAYER_SAMPLINGS[layer]
+        )
+        for layer in CLUSTER_LAYERS
+    ]
+    new_s = s.MetaData(
+        {
+            "metadata_type": "add_cpp_function",
+            "name": "cluster_layer_energies",
+            "code": ["std::vector<float> result;"]
+            + [f"result.push_back({energy});" for energy in sums],
+            "result": "result",
+            "include_files": ["xAODCaloEvent/CaloCluster.h"],
+            "arguments": ["clus"],
+            "return_type": "float",
+            "return_is_collection": True,
+        }
+    )
+    return new_s, a
+
+
+@func_adl_callable(cluster_layer_energies_callback)
+def cluster_layer_energies(clus: CaloCluster_v1) -> FADLStream[float]:
+    """The energy of the cluster in each of the `CLUSTER_LAYERS`, in that order: the
+    sum of the energies of the layer's samplings (see `LAYER_SAMPLINGS`).
+
+    Args:
+        clus (CaloCluster_v1): The cluster (see `cvt_to_raw_calocluster`).
+
+    NOTE: This is a dummy function that injects C++ into the object stream to do the
+    actual work.
+
+    Returns:
+        FADLStream[float]: The energy in each layer.
+    """
+    ...
+
+
 def add_jet_selection_tool(
     stream: ObjectStream[T], tool_name: str, cut_name: str
 ) -> ObjectStream[T]:
@@ -1,11 +1,13 @@
 import logging
 import logging.handlers
+import os
 from enum import Enum
 from typing import Optional, List
 from pathlib import Path
 
 import typer
 
+from calratio_training_data.constants import Engine
 
 app = typer.Typer()
 
@@ -30,6 +32,22 @@ def set_logging(verbosity: int) -> None:
         h.setLevel(level)
 
 
+def echo_memory_report(profile_memory: bool) -> None:
+    """
+    Print the memory summary of the run that just finished, if it profiled memory.
+
+    Args:
+        profile_memory (bool): The run was asked to profile memory.
+    """
+    if not profile_memory:
+        return
+    from calratio_training_data.metrics import format_memory_report, last_run_report
+
+    report = last_run_report()
+    if report is not None and "memory_profile" in report:
+        typer.echo(format_memory_report(report))
+
+
 class DataType(str, Enum):
     """Allowed data types for the fetch command."""
 
@@ -89,6 +107,93 @@ def fetch_command(
         "-n",
         help="Number of files to process in the dataset. Default is to process all files.",
     ),
+    read_ahead: int = typer.Option(
+        2,
+        "--read-ahead",
+        help="Number of ServiceX output files (or chunks, see --chunk-events) to read in "
+        "the background while converting. Use 0 to read each one only when it is needed.",
+    ),
+    chunk_events: Optional[int] = typer.Option(
+        None,
+        "--chunk-events",
+        help="Read and convert each ServiceX output file this many events at a time to "
+        "limit memory use. Default is to convert each file in one go.",
+    ),
+    max_file_size_gb: float = typer.Option(
+        2.0,
+        "--max-file-size-gb",
+        help="Start a new output file once the current one is this big on disk (GB).",
+    ),
+    resume: bool = typer.Option(
+        True,
+        "--resume/--no-resume",
+        help="Skip ServiceX output files a previous, interrupted, run with the same "
+        "settings already converted (tracked in the `_manifest.json` file next to the "
+        "output).",
+    ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        "-j",
+        help="Number of processes used to convert ServiceX output files in parallel.",
+    ),
+    ordered: bool = typer.Option(
+        True,
+        "--ordered/--unordered",
+        help="When converting in parallel, write results in ServiceX file order "
+        "(deterministic output) or as soon as each file is converted.",
+    ),
+    save_raw: Optional[str] = typer.Option(
+        None,
+        "--save-raw",
+        help="Directory to save a compact parquet copy of the raw ServiceX output in, "
+        "for use with the `reprocess` command.",
+    ),
+    metrics_out: Optional[str] = typer.Option(
+        None,
+        "--metrics-out",
+        help="Write a json report of the time spent in each stage, per file and for "
+        "the whole run (events/s, jets/s, MB/s) to this file.",
+    ),
+    profile_memory: bool = typer.Option(
+        False,
+        "--profile-memory",
+        help="Trace memory use (many times slower, so try it on a few files) and print "
+        "the peak for each stage and the biggest allocators at the end. Per-stage "
+        "and per-file peaks are added to the --metrics-out report.",
+    ),
+    engine: Engine = typer.Option(
+        Engine.AWKWARD,
+        "--engine",
+        help="Do the matching and rotations with numpy (awkward) or compiled loops "
+        "(numba, needs the numba package). The output is the same either way.",
+    ),
+    compact_schema: bool = typer.Option(
+        False,
+        "--compact-schema",
+        help="Write the track hit counts as small integers, the label as int8 and the "
+        "descriptive label dictionary encoded, for smaller files that load faster.",
+    ),
+    skim_to_jets: bool = typer.Option(
+        False,
+        "--skim-to-jets",
+        help="Only fetch the tracks and muon segments close enough to a good jet to be "
+        "matched to it. Much less data is downloaded; the training data is the same.",
+    ),
+    llp_jets_only: bool = typer.Option(
+        False,
+        "--llp-jets-only",
+        help="For signal, only fetch the jets near an LLP that decays in the calorimeter "
+        "(the only ones trained on). Much less data is downloaded; the training data is "
+        "the same.",
+    ),
+    compact_transfer: bool = typer.Option(
+        False,
+        "--compact-transfer",
+        help="Have ServiceX send the kinematics as 32 bit floats, the vertex track count "
+        "once per event, and only the branches used. Smaller downloads; the training "
+        "data is the same.",
+    ),
 ):
     """
     Fetch training data for cal ratio.
@@ -108,8 +213,313 @@ def fetch_command(
         n_files=n_files,
         datatype=data_type,
         desc_label=desc_label,
+        read_ahead=read_ahead,
+        chunk_events=chunk_events,
+        max_file_size_gb=max_file_size_gb,
+        resume=resume,
+        workers=workers,
+        ordered=ordered,
+        raw_cache_dir=save_raw,
+        metrics_out=metrics_out,
+        profile_memory=profile_memory,
+        engine=engine,
+        compact_schema=compact_schema,
+        skim_to_jets=skim_to_jets,
+        llp_jets_only=llp_jets_only,
+        compact_transfer=compact_transfer,
     )
-    fetch_training_data_to_file(dataset, run_config)
+    try:
+        fetch_training_data_to_file(dataset, run_config)
+    finally:
+        echo_memory_report(profile_memory)
+
+
+@app.command("fetch-many")
+def fetch_many_command(
+    production: Path = typer.Argument(
+        ...,
+        help="YAML file listing the datasets to fetch (dataset, datatype, desc-label, "
+        "n-files, output)",
+    ),
+    verbosity: int = typer.Option(
+        0,
+        "--verbose",
+        "-v",
+        count=True,
+        help="Increase verbosity level (use -v for INFO, -vv for DEBUG)",
+    ),
+    ignore_cache: bool = typer.Option(
+        False,
+        "--ignore-cache",
+        help="Ignore cache and fetch fresh data",
+    ),
+    local: bool = typer.Option(
+        False,
+        "--local",
+        help="Run ServiceX locally (requires docker)",
+    ),
+    rotation: bool = typer.Option(
+        True,
+        "--rotation/--no-rotation",
+        help="Applies/does not apply rotations on cluster, track, mseg eta and phi variables. "
+        "Rotations applied by default.",
+    ),
+    sx_backend: Optional[str] = typer.Option(
+        None,
+        "--sx-backend",
+        help="ServiceX backend Name. Default is to use what is in your `servicex.yaml` file.",
+    ),
+    read_ahead: int = typer.Option(
+        2,
+        "--read-ahead",
+        help="Number of ServiceX output files (or chunks, see --chunk-events) to read in "
+        "the background while converting. Use 0 to read each one only when it is needed.",
+    ),
+    chunk_events: Optional[int] = typer.Option(
+        None,
+        "--chunk-events",
+        help="Read and convert each ServiceX output file this many events at a time to "
+        "limit memory use. Default is to convert each file in one go.",
+    ),
+    max_file_size_gb: float = typer.Option(
+        2.0,
+        "--max-file-size-gb",
+        help="Start a new output file once the current one is this big on disk (GB).",
+    ),
+    resume: bool = typer.Option(
+        True,
+        "--resume/--no-resume",
+        help="Skip ServiceX output files a previous, interrupted, run with the same "
+        "settings already converted.",
+    ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        "-j",
+        help="Number of processes used to convert ServiceX output files in parallel.",
+    ),
+    ordered: bool = typer.Option(
+        True,
+        "--ordered/--unordered",
+        help="When converting in parallel, write results in ServiceX file order "
+        "(deterministic output) or as soon as each file is converted.",
+    ),
+    save_raw: Optional[str] = typer.Option(
+        None,
+        "--save-raw",
+        help="Directory to save a compact parquet copy of the raw ServiceX output in "
+        "(one sub-directory per dataset), for use with the `reprocess` command.",
+    ),
+    metrics_out: Optional[str] = typer.Option(
+        None,
+        "--metrics-out",
+        help="Write a json report of the time spent in each stage, per file and for "
+        "the whole run (events/s, jets/s, MB/s) to this file.",
+    ),
+    profile_memory: bool = typer.Option(
+        False,
+        "--profile-memory",
+        help="Trace memory use (many times slower, so try it on a few files) and print "
+        "the peak for each stage and the biggest allocators at the end. Per-stage "
+        "and per-file peaks are added to the --metrics-out report.",
+    ),
+    engine: Engine = typer.Option(
+        Engine.AWKWARD,
+        "--engine",
+        help="Do the matching and rotations with numpy (awkward) or compiled loops "
+        "(numba, needs the numba package). The output is the same either way.",
+    ),
+    compact_schema: bool = typer.Option(
+        False,
+        "--compact-schema",
+        help="Write the track hit counts as small integers, the label as int8 and the "
+        "descriptive label dictionary encoded, for smaller files that load faster.",
+    ),
+    skim_to_jets: bool = typer.Option(
+        False,
+        "--skim-to-jets",
+        help="Only fetch the tracks and muon segments close enough to a good jet to be "
+        "matched to it. Much less data is downloaded; the training data is the same.",
+    ),
+    llp_jets_only: bool = typer.Option(
+        False,
+        "--llp-jets-only",
+        help="For signal, only fetch the jets near an LLP that decays in the calorimeter "
+        "(the only ones trained on). Much less data is downloaded; the training data is "
+        "the same.",
+    ),
+    compact_transfer: bool = typer.Option(
+        False,
+        "--compact-transfer",
+        help="Have ServiceX send the kinematics as 32 bit floats, the vertex track count "
+        "once per event, and only the branches used. Smaller downloads; the training "
+        "data is the same.",
+    ),
+):
+    """
+    Fetch training data for a list of datasets, submitting them to ServiceX together.
+    """
+    set_logging(int(verbosity))
+    from calratio_training_data.production import load_production_yaml
+    from calratio_training_data.training_query import (
+        fetch_many_training_data_to_files,
+        RunConfig,
+    )
+
+    run_config = RunConfig(
+        ignore_cache=ignore_cache,
+        run_locally=local,
+        rotation=rotation,
+        sx_backend=sx_backend,
+        read_ahead=read_ahead,
+        chunk_events=chunk_events,
+        max_file_size_gb=max_file_size_gb,
+        resume=resume,
+        workers=workers,
+        ordered=ordered,
+        raw_cache_dir=save_raw,
+        metrics_out=metrics_out,
+        profile_memory=profile_memory,
+        engine=engine,
+        compact_schema=compact_schema,
+        skim_to_jets=skim_to_jets,
+        llp_jets_only=llp_jets_only,
+        compact_transfer=compact_transfer,
+    )
+    try:
+        failed = fetch_many_training_data_to_files(
+            load_production_yaml(production), run_config
+        )
+    finally:
+        echo_memory_report(profile_memory)
+    if len(failed) > 0:
+        typer.echo(f"ServiceX failed for: {', '.join(failed)}", err=True)
+        raise typer.Exit(1)
+
+
+@app.command("reprocess")
+def reprocess_command(
+    data_type: DataType = typer.Argument(
+        ..., help="Type of data to convert (signal, qcd, data, bib)"
+    ),
+    input_dir: str = typer.Argument(
+        ...,
+        help="Directory with raw ServiceX output files (.root) or the parquet copies "
+        "written by `fetch --save-raw`",
+    ),
+    desc_label: str = typer.Argument(
+        ...,
+        help='Descriptive label used for labeling datasets. Ex. "HSS, JZ2, data24"',
+    ),
+    dataset: Optional[str] = typer.Option(
+        None,
+        "--dataset",
+        help="The dataset the raw files came from (used in the signal descriptive "
+        "label). Default is the one recorded by `fetch --save-raw`.",
+    ),
+    verbosity: int = typer.Option(
+        0,
+        "--verbose",
+        "-v",
+        count=True,
+        help="Increase verbosity level (use -v for INFO, -vv for DEBUG)",
+    ),
+    output: str = typer.Option(
+        "training.parquet",
+        "--output",
+        "-o",
+        help="Output file path",
+    ),
+    rotation: bool = typer.Option(
+        True,
+        "--rotation/--no-rotation",
+        help="Applies/does not apply rotations on cluster, track, mseg eta and phi variables. "
+        "Rotations applied by default.",
+    ),
+    chunk_events: Optional[int] = typer.Option(
+        None,
+        "--chunk-events",
+        help="Read and convert each raw file this many events at a time to limit "
+        "memory use. Default is to convert each file in one go.",
+    ),
+    max_file_size_gb: float = typer.Option(
+        2.0,
+        "--max-file-size-gb",
+        help="Start a new output file once the current one is this big on disk (GB).",
+    ),
+    resume: bool = typer.Option(
+        True,
+        "--resume/--no-resume",
+        help="Skip raw files a previous, interrupted, run with the same settings "
+        "already converted.",
+    ),
+    workers: int = typer.Option(
+        os.cpu_count() or 1,
+        "--workers",
+        "-j",
+        help="Number of processes used to convert the raw files in parallel.",
+    ),
+    ordered: bool = typer.Option(
+        True,
+        "--ordered/--unordered",
+        help="When converting in parallel, write results in file order "
+        "(deterministic output) or as soon as each file is converted.",
+    ),
+    metrics_out: Optional[str] = typer.Option(
+        None,
+        "--metrics-out",
+        help="Write a json report of the time spent in each stage, per file and for "
+        "the whole run (events/s, jets/s, MB/s) to this file.",
+    ),
+    profile_memory: bool = typer.Option(
+        False,
+        "--profile-memory",
+        help="Trace memory use (many times slower, so try it on a few files) and print "
+        "the peak for each stage and the biggest allocators at the end. Per-stage "
+        "and per-file peaks are added to the --metrics-out report.",
+    ),
+    engine: Engine = typer.Option(
+        Engine.AWKWARD,
+        "--engine",
+        help="Do the matching and rotations with numpy (awkward) or compiled loops "
+        "(numba, needs the numba package). The output is the same either way.",
+    ),
+    compact_schema: bool = typer.Option(
+        False,
+        "--compact-schema",
+        help="Write the track hit counts as small integers, the label as int8 and the "
+        "descriptive label dictionary encoded, for smaller files that load faster.",
+    ),
+):
+    """
+    Re-run the conversion to training data on raw files already on disk, without
+    running a ServiceX query.
+    """
+    set_logging(int(verbosity))
+    from calratio_training_data.training_query import (
+        reprocess_training_data_to_file,
+        RunConfig,
+    )
+
+    run_config = RunConfig(
+        output_path=output,
+        rotation=rotation,
+        datatype=data_type,
+        desc_label=desc_label,
+        chunk_events=chunk_events,
+        max_file_size_gb=max_file_size_gb,
+        resume=resume,
+        workers=workers,
+        ordered=ordered,
+        metrics_out=metrics_out,
+        profile_memory=profile_memory,
+        engine=engine,
+        compact_schema=compact_schema,
+    )
+    try:
+        reprocess_training_data_to_file(input_dir, run_config, ds_name=dataset)
+    finally:
+        echo_memory_report(profile_memory)
 
 
 @app.command("training-file")
@@ -135,6 +545,12 @@ def training_file_command(
         "-o",
         help="Output path for combined dataset.",
     ),
+    profile_memory: bool = typer.Option(
+        False,
+        "--profile-memory",
+        help="Trace memory use (many times slower, so try it on a few files) and print "
+        "the peak for each stage and the biggest allocators at the end.",
+    ),
 ):
     """
     Combines processed datasets into large dataset to be used for training
@@ -183,8 +599,12 @@ def training_file_command(
         event_filter,
         output_path,
     )
+    final_config.profile_memory = profile_memory
 
-    combine_training_data(final_config)
+    try:
+        combine_training_data(final_config)
+    finally:
+        echo_memory_report(profile_memory)
 
 
 def run_from_command() -> None:
@@ -0,0 +1,101 @@
+from typing import Tuple
+
+import awkward as ak
+import numpy as np
+
+# Kinematics on the flat buffers behind jagged arrays: the values of every list laid
+# end to end and, where the lists matter, the offsets of where each list starts and
+# ends (n_lists + 1 of them). The arithmetic is what `vector`'s Momentum3D behaviors
+# do, in the same order, so the results are the same bit for bit, without going
+# through awkward's broadcasting at each step.
+
+
+def flat_lists(values: ak.Array) -> Tuple[np.ndarray, np.ndarray]:
+    """The flat values and offsets of an array of lists of numbers.
+
+    Args:
+        values (ak.Array): Lists of numbers, n * var.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The values of all the lists, one after the
+            other, and the offsets of each list in them.
+    """
+    counts = ak.to_numpy(ak.num(values, axis=1))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return ak.to_numpy(ak.flatten(values, axis=1)), offsets
+
+
+def jagged(values: np.ndarray, offsets: np.ndarray) -> ak.Array:
+    "Wrap flat values back up into lists (the inverse of `flat_lists`), without a copy"
+    return ak.Array(
+        ak.contents.ListOffsetArray(
+            ak.index.Index64(offsets), ak.contents.NumpyArray(values)
+        )
+    )
+
+
+def broadcast_to_lists(per_list: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    "Repeat one value per list for every entry in the list"
+    return np.repeat(per_list, np.diff(offsets))
+
+
+def delta_phi(phi1: np.ndarray, phi2: np.ndarray) -> np.ndarray:
+    "phi1 - phi2, wrapped into [-pi, pi) (as `deltaphi`)"
+    return (phi1 - phi2 + np.pi) % (2 * np.pi) - np.pi
+
+
+def delta_r(
+    eta1: np.ndarray, phi1: np.ndarray, eta2: np.ndarray, phi2: np.ndarray
+) -> np.ndarray:
+    "Distance in (eta, phi) (as `deltaR`)"
+    return np.sqrt(delta_phi(phi1, phi2) ** 2 + (eta1 - eta2) ** 2)
+
+
+def relative_to_parent(
+    eta: np.ndarray,
+    phi: np.ndarray,
+    parent_eta: np.ndarray,
+    parent_phi: np.ndarray,
+    offsets: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The eta and phi of each entry relative to its list's parent (e.g. a track
+    relative to its jet), as `deltaeta` and `deltaphi` do.
+
+    Args:
+        eta (np.ndarray): Flat eta of the entries.
+        phi (np.ndarray): Flat phi of the entries.
+        parent_eta (np.ndarray): One eta per list.
+        parent_phi (np.ndarray): One phi per list.
+        offsets (np.ndarray): Where each list starts and ends.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Delta eta and delta phi, flat.
+    """
+    return (
+        eta - broadcast_to_lists(parent_eta, offsets),
+        delta_phi(phi, broadcast_to_lists(parent_phi, offsets)),
+    )
+
+
+def weighted_sign(
+    values: np.ndarray, weights: np.ndarray, offsets: np.ndarray
+) -> np.ndarray:
+    """The sign of the weighted sum of each list: 1 if it is zero or more (including
+    empty lists), -1 if negative and 0 if it is NaN.
+
+    The sum is accumulated in the values' precision, in order, as `ak.sum` does, so
+    sums that round to zero come out the same.
+
+    Args:
+        values (np.ndarray): Flat values.
+        weights (np.ndarray): Flat weights, the same shape as `values`.
+        offsets (np.ndarray): Where each list starts and ends.
+
+    Returns:
+        np.ndarray: One `int64` sign per list.
+    """
+    weighted = values * weights
+    total = np.zeros(len(offsets) - 1, dtype=weighted.dtype)
+    np.add.at(total, broadcast_to_lists(np.arange(len(total)), offsets), weighted)
+    return np.where(total >= 0, 1, np.where(total < 0, -1, 0))
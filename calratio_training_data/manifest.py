@@ -0,0 +1,104 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+
+@dataclass
+class ShardRecord:
+    "An output file that has been completely written"
+
+    file: str
+    index: int
+    jets: int
+    source_files: List[str]
+
+
+@dataclass
+class ConversionManifest:
+    """Which ServiceX output files have been converted into which training files.
+
+    Written next to the training files so that an interrupted fetch can pick up where
+    it left off. The fingerprint records everything that changes the output - if it
+    does not match, the manifest is of no use.
+    """
+
+    fingerprint: Dict[str, str]
+    shards: List[ShardRecord] = field(default_factory=list)
+
+    # Source files that were converted, but had no jets to write out.
+    empty_files: List[str] = field(default_factory=list)
+
+    def completed_files(self) -> Set[str]:
+        "Names of all the source files that are already in finished training files"
+        done = set(self.empty_files)
+        for s in self.shards:
+            done.update(s.source_files)
+        return done
+
+    def next_shard_index(self) -> int:
+        "Index of the next training file to write"
+        return max((s.index for s in self.shards), default=-1) + 1
+
+
+def source_file_name(path: str) -> str:
+    """A stable name for a ServiceX output file.
+
+    The paths (or signed urls) ServiceX hands back can change from run to run, but
+    the file name does not.
+
+    Args:
+        path (str): Path or url of the ServiceX output file.
+
+    Returns:
+        str: The name to use in the manifest.
+    """
+    return Path(urlparse(path).path).name
+
+
+def manifest_path(output_path: str) -> str:
+    """The manifest for a training data set lives next to its files.
+
+    Args:
+        output_path (str): The base output path, e.g. `training.parquet`.
+
+    Returns:
+        str: The manifest path, e.g. `training_manifest.json`.
+    """
+    return output_path.replace(".parquet", "_manifest.json")
+
+
+def load_manifest(path: str) -> Optional[ConversionManifest]:
+    """Load a manifest.
+
+    Args:
+        path (str): Path to the manifest file.
+
+    Returns:
+        Optional[ConversionManifest]: The manifest, or `None` if there isn't one.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    return ConversionManifest(
+        fingerprint=data["fingerprint"],
+        shards=[ShardRecord(**s) for s in data.get("shards", [])],
+        empty_files=data.get("empty_files", []),
+    )
+
+
+def save_manifest(manifest: ConversionManifest, path: str):
+    """Write the manifest. The old one is only replaced once the new one is fully
+    written, so an interruption never leaves a corrupt manifest behind.
+
+    Args:
+        manifest (ConversionManifest): The manifest to save.
+        path (str): Where to write it.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(asdict(manifest), f, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,482 @@
+import json
+import logging
+import os
+import sys
+import sysconfig
+import threading
+import tracemalloc
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None  # type: ignore
+
+T = TypeVar("T")
+
+MB = 1_048_576
+
+# Frames kept for each traced allocation - enough to get from numpy and awkward back
+# to the line in this package that asked for the memory.
+TRACE_FRAMES = 16
+
+# Where stage timings go. Nothing is recorded when this is not set.
+_current: ContextVar[Optional["StageTimes"]] = ContextVar(
+    "calratio_metrics", default=None
+)
+_current_run: ContextVar[Optional["RunMetrics"]] = ContextVar(
+    "calratio_run_metrics", default=None
+)
+
+
+@dataclass
+class StageTimes:
+    """Seconds spent in each stage and, when memory is being profiled, the highest
+    traced memory and process RSS high-water mark (both MB) seen in each stage"""
+
+    stages: Dict[str, float] = field(default_factory=dict)
+    peak_mb: Dict[str, float] = field(default_factory=dict)
+    rss_mb: Dict[str, float] = field(default_factory=dict)
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_memory(self, stage: str, peak_mb: float, rss_mb: float):
+        self.peak_mb[stage] = max(self.peak_mb.get(stage, 0.0), peak_mb)
+        self.rss_mb[stage] = max(self.rss_mb.get(stage, 0.0), rss_mb)
+
+    def merge(self, other: "StageTimes"):
+        for name, seconds in other.stages.items():
+            self.add(name, seconds)
+        for name, peak in other.peak_mb.items():
+            self.add_memory(name, peak, other.rss_mb.get(name, 0.0))
+
+    def memory_dict(self) -> Dict[str, Any]:
+        if len(self.peak_mb) == 0:
+            return {}
+        return {"memory": {"peak_mb": self.peak_mb, "rss_mb": self.rss_mb}}
+
+
+@dataclass
+class FileMetrics(StageTimes):
+    "What it took to convert one raw file"
+
+    file: str = ""
+    events: int = 0
+    jets: int = 0
+    bytes: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "file": self.file,
+            "events": self.events,
+            "jets": self.jets,
+            "bytes": self.bytes,
+            "seconds": sum(self.stages.values()),
+            "stages": self.stages,
+            **self.memory_dict(),
+            **_rates(self.events, self.jets, self.bytes, sum(self.stages.values())),
+        }
+
+
+@dataclass
+class RunMetrics(StageTimes):
+    "Stage timings for a whole run, and for each file converted in it"
+
+    files: List[FileMetrics] = field(default_factory=list)
+    wall_seconds: float = 0.0
+    memory: Optional[Dict[str, Any]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Files may have been converted in parallel, so their stage times can add up
+        # to more than the wall time. Rates are per wall-clock second.
+        total = StageTimes()
+        total.merge(self)
+        for f in self.files:
+            total.merge(f)
+        events = sum(f.events for f in self.files)
+        jets = sum(f.jets for f in self.files)
+        n_bytes = sum(f.bytes for f in self.files)
+        return {
+            "wall_seconds": self.wall_seconds,
+            "events": events,
+            "jets": jets,
+            "bytes": n_bytes,
+            "stages": total.stages,
+            **total.memory_dict(),
+            **_rates(events, jets, n_bytes, self.wall_seconds),
+            **({"memory_profile": self.memory} if self.memory is not None else {}),
+            "files": [f.to_dict() for f in self.files],
+        }
+
+
+def _rates(events: int, jets: int, n_bytes: int, seconds: float) -> Dict[str, float]:
+    if seconds <= 0:
+        return {"events_per_s": 0.0, "jets_per_s": 0.0, "mb_per_s": 0.0}
+    return {
+        "events_per_s": events / seconds,
+        "jets_per_s": jets / seconds,
+        "mb_per_s": n_bytes / 1_048_576 / seconds,
+    }
+
+
+class _Peak:
+    "Highest traced memory (bytes) seen while a stage was running"
+
+    __slots__ = ("bytes", "__weakref__")
+
+    def __init__(self, start: int):
+        self.bytes = start
+
+
+# tracemalloc has a single, process wide, peak counter. Every time it is restarted
+# its value is folded into all the stages that are running (on any thread). Stages
+# that are abandoned (e.g. the last lap of a `StageClock`) drop out on their own.
+_peaks_lock = threading.Lock()
+_open_peaks: "weakref.WeakSet[_Peak]" = weakref.WeakSet()
+
+# Set while a run is profiling memory in this process.
+_profile: Optional["MemoryProfile"] = None
+
+# The report of the last run to finish in this process (see `last_run_report`).
+_last_report: Optional[Dict[str, Any]] = None
+
+
+def _fold_peak():
+    peak = tracemalloc.get_traced_memory()[1]
+    for p in _open_peaks:
+        p.bytes = max(p.bytes, peak)
+    tracemalloc.reset_peak()
+
+
+def _begin_peak() -> Optional[_Peak]:
+    if not tracemalloc.is_tracing():
+        return None
+    with _peaks_lock:
+        _fold_peak()
+        p = _Peak(tracemalloc.get_traced_memory()[0])
+        _open_peaks.add(p)
+    return p
+
+
+def _end_peak(p: _Peak) -> int:
+    with _peaks_lock:
+        if tracemalloc.is_tracing():
+            _fold_peak()
+        _open_peaks.discard(p)
+    return p.bytes
+
+
+def max_rss_mb(children: bool = False) -> float:
+    """High-water mark of the resident memory of this process (or of its finished
+    child processes), in MB. Zero where the platform does not tell us.
+    """
+    if resource is None:
+        return 0.0
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # Linux reports kB, macOS bytes.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss * scale / MB
+
+
+class _StageTimer:
+    "Times one run of a stage and, if tracemalloc is on, tracks its peak memory"
+
+    def __init__(self):
+        self._start = perf_counter()
+        self._peak = _begin_peak()
+
+    def stop(self, times: Optional[StageTimes], name: str):
+        seconds = perf_counter() - self._start
+        peak = _end_peak(self._peak) if self._peak is not None else None
+        if times is not None:
+            times.add(name, seconds)
+            if peak is not None:
+                times.add_memory(name, peak / MB, max_rss_mb())
+        if peak is not None and _profile is not None:
+            _profile.check()
+
+
+def start_memory_tracing():
+    "Start tracemalloc, keeping enough frames to find the allocating code"
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+
+
+@dataclass
+class MemoryProfile:
+    """Memory use of a whole run. A snapshot of the traced allocations is kept from
+    the end of whichever stage left the most memory allocated, to show what was
+    holding it.
+    """
+
+    largest_bytes: int = 0
+    snapshot: Optional[tracemalloc.Snapshot] = None
+    _run_peak: Optional[_Peak] = None
+
+    def check(self):
+        current = tracemalloc.get_traced_memory()[0]
+        if current > self.largest_bytes:
+            self.largest_bytes = current
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def to_dict(self, top: int = 10) -> Dict[str, Any]:
+        peak = _end_peak(self._run_peak) if self._run_peak is not None else 0
+        return {
+            "traced_peak_mb": peak / MB,
+            "rss_peak_mb": max_rss_mb(),
+            "worker_rss_peak_mb": max_rss_mb(children=True),
+            "top_allocators": top_allocators(self.snapshot, top),
+        }
+
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_LIBRARY_DIRS = tuple(
+    {sysconfig.get_paths()[k] for k in ("stdlib", "platstdlib", "purelib", "platlib")}
+)
+
+
+def _charged_frame(traceback: tracemalloc.Traceback) -> tracemalloc.Frame:
+    "The frame an allocation is charged to, see `top_allocators`"
+    frames = list(reversed(traceback))
+    for is_ours in [
+        lambda name: name.startswith(_PACKAGE_DIR),
+        lambda name: not name.startswith(_LIBRARY_DIRS),
+    ]:
+        frame = next((f for f in frames if is_ours(f.filename)), None)
+        if frame is not None:
+            return frame
+    return frames[0]
+
+
+def top_allocators(
+    snapshot: Optional[tracemalloc.Snapshot], top: int = 10
+) -> List[Dict[str, Any]]:
+    """The lines that held the most memory in `snapshot`. numpy and awkward do the
+    actual allocating, so each allocation is charged to the innermost line of this
+    package that led to it, or else the innermost line outside of the installed
+    libraries (e.g. a script).
+
+    Args:
+        snapshot (Optional[tracemalloc.Snapshot]): The traced allocations.
+        top (int): How many lines to return.
+
+    Returns:
+        List[Dict[str, Any]]: `where` (file:line), `mb` and `blocks` for each line,
+            biggest first.
+    """
+    if snapshot is None:
+        return []
+    by_line: Dict[str, List[int]] = {}
+    for s in snapshot.statistics("traceback"):
+        frame = _charged_frame(s.traceback)
+        filename = frame.filename
+        if filename == __file__:
+            # The profiling's own bookkeeping.
+            continue
+        if filename.startswith(_PACKAGE_DIR):
+            filename = os.path.relpath(filename, os.path.dirname(_PACKAGE_DIR))
+        total = by_line.setdefault(f"{filename}:{frame.lineno}", [0, 0])
+        total[0] += s.size
+        total[1] += s.count
+    ranked = sorted(by_line.items(), key=lambda i: i[1][0], reverse=True)[:top]
+    return [
+        {"where": where, "mb": size / MB, "blocks": count}
+        for where, (size, count) in ranked
+    ]
+
+
+def format_memory_report(report: Dict[str, Any]) -> str:
+    """Human readable memory summary of a run report (see `RunMetrics.to_dict`).
+
+    Args:
+        report (Dict[str, Any]): The run report, made while profiling memory.
+
+    Returns:
+        str: Peaks for the run, per stage, and the top allocators.
+    """
+    profile = report["memory_profile"]
+    lines = [
+        f"Peak memory: {profile['traced_peak_mb']:,.1f} MB traced, "
+        f"{profile['rss_peak_mb']:,.1f} MB RSS "
+        f"({profile['worker_rss_peak_mb']:,.1f} MB RSS in worker processes)",
+        f"{'stage':<20} {'peak [MB]':>10} {'RSS [MB]':>10}",
+    ]
+    memory = report.get("memory", {"peak_mb": {}, "rss_mb": {}})
+    for name, peak in sorted(
+        memory["peak_mb"].items(), key=lambda i: i[1], reverse=True
+    ):
+        lines.append(f"{name:<20} {peak:>10,.1f} {memory['rss_mb'][name]:>10,.1f}")
+    lines.append("Top allocators (at the stage end with the most memory in use):")
+    for a in profile["top_allocators"]:
+        lines.append(f"{a['mb']:>10,.1f} MB {a['blocks']:>9,} blocks  {a['where']}")
+    return "\n".join(lines)
+
+
+@contextmanager
+def recording(times: StageTimes) -> Iterator[StageTimes]:
+    """Send stage timings made in this block (on this thread) to `times`.
+
+    Args:
+        times (StageTimes): Where to record the timings.
+    """
+    token = _current.set(times)
+    try:
+        yield times
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the code in this block as stage `name`. Does nothing unless something is
+    recording (see `recording`).
+
+    Args:
+        name (str): The stage name, e.g. `read`.
+    """
+    times = _current.get()
+    if times is None:
+        yield
+        return
+    timer = _StageTimer()
+    try:
+        yield
+    finally:
+        timer.stop(times, name)
+
+
+def add_stage_time(name: str, seconds: float):
+    "Record time spent in stage `name` that was measured some other way"
+    times = _current.get()
+    if times is not None:
+        times.add(name, seconds)
+
+
+class StageClock:
+    """Times consecutive stages in a long function without re-indenting it: each
+    call to `lap` records the time since the previous one.
+    """
+
+    def __init__(self, prefix: str):
+        self._prefix = prefix
+        self._times = _current.get()
+        self._timer = _StageTimer() if self._times is not None else None
+
+    def lap(self, name: str):
+        if self._timer is not None:
+            self._timer.stop(self._times, f"{self._prefix}.{name}")
+            self._timer = _StageTimer()
+
+
+def timed_items(items: Iterable[T], name: str) -> Iterator[Tuple[T, StageTimes]]:
+    """Pair each item with the stage timings for producing it. Useful when the items
+    are produced on another thread, where stage timings would not be recorded.
+
+    Args:
+        items (Iterable[T]): The items, e.g. chunks read from a file.
+        name (str): The stage producing them, e.g. `read`.
+
+    Returns:
+        Iterator[Tuple[T, StageTimes]]: Each item and what it took (merge these into
+            the metrics being recorded).
+    """
+    it = iter(items)
+    while True:
+        timer = _StageTimer()
+        try:
+            item = next(it)
+        except StopIteration:
+            timer.stop(None, name)
+            return
+        times = StageTimes()
+        timer.stop(times, name)
+        yield item, times
+
+
+def file_metrics(path: str) -> FileMetrics:
+    """Start the metrics for a raw file.
+
+    Args:
+        path (str): Path or url of the file.
+
+    Returns:
+        FileMetrics: Empty metrics, with the on-disk size filled in if the file is
+            local.
+    """
+    return FileMetrics(
+        file=path, bytes=os.path.getsize(path) if os.path.exists(path) else 0
+    )
+
+
+def report_file(metrics: FileMetrics):
+    "Add the metrics for a converted file to the current run, if it is recording"
+    run = _current_run.get()
+    if run is not None:
+        run.files.append(metrics)
+
+
+@contextmanager
+def run_metrics(
+    output_path: Optional[str], profile_memory: bool = False
+) -> Iterator[Optional[RunMetrics]]:
+    """Record metrics for a run and write them as json when it finishes (even if it
+    fails part way through).
+
+    Args:
+        output_path (Optional[str]): Where to write the report. If `None` (and memory
+            isn't being profiled) nothing is recorded.
+        profile_memory (bool): Also trace memory use (tracemalloc, which slows things
+            down), and add the peaks and the biggest allocators to the report (see
+            `format_memory_report`).
+    """
+    global _profile, _last_report
+    if output_path is None and not profile_memory:
+        yield None
+        return
+
+    metrics = RunMetrics()
+    run_token = _current_run.set(metrics)
+    profile = None
+    stop_tracing = False
+    if profile_memory:
+        stop_tracing = not tracemalloc.is_tracing()
+        start_memory_tracing()
+        profile = MemoryProfile()
+        profile._run_peak = _begin_peak()
+        _profile = profile
+    start = perf_counter()
+    try:
+        with recording(metrics):
+            yield metrics
+    finally:
+        _current_run.reset(run_token)
+        metrics.wall_seconds = perf_counter() - start
+        if profile is not None:
+            _profile = None
+            metrics.memory = profile.to_dict()
+            if stop_tracing:
+                tracemalloc.stop()
+        report = metrics.to_dict()
+        _last_report = report
+        if output_path is not None:
+            with open(output_path, "w") as f:
+                json.dump(report, f, indent=2)
+        logging.info(
+            f"Run took {report['wall_seconds']:0.1f} s: "
+            f"{report['events_per_s']:,.0f} events/s, "
+            f"{report['jets_per_s']:,.0f} jets/s, {report['mb_per_s']:0.1f} MB/s"
+            + (f" (metrics in {output_path})." if output_path is not None else ".")
+        )
+
+
+def last_run_report() -> Optional[Dict[str, Any]]:
+    """The report (see `RunMetrics.to_dict`) of the last `run_metrics` block to finish
+    in this process, or `None` if none has recorded anything.
+    """
+    return _last_report
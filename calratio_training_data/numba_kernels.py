@@ -0,0 +1,248 @@
+from typing import Tuple
+
+import numpy as np
+
+try:
+    import numba
+except ImportError as e:  # pragma: no cover - depends on the environment
+    raise ImportError(
+        "The numba engine needs numba: pip install calratio_training_data[numba]"
+    ) from e
+
+# The `--engine numba` versions of the matching and rotation kernels: compiled loops
+# over the flat buffers (see `kinematics`) that do in one pass per list what the
+# numpy versions do in several, without the intermediate arrays.
+#
+# The results are the same bit for bit. Everything is done in the precision of the
+# inputs, in the same order of operations as `vector` and `kinematics`: the constants
+# (pi, cuts) are passed in already converted to the inputs' dtype, as numpy does with
+# python floats, since numba would otherwise promote the arithmetic to float64.
+
+
+@numba.njit(cache=True)
+def _rectify(phi, pi, two_pi):
+    "phi wrapped into [-pi, pi), as vector's `rectify`"
+    return (phi + pi) % two_pi - pi
+
+
+@numba.njit(cache=True)
+def _count_delta_r(
+    jet_eta, jet_phi, jet_offsets, obj_eta, obj_phi, obj_offsets, cut, pi, two_pi
+):
+    per_jet = np.zeros(len(jet_eta), dtype=np.int64)
+    for event in range(len(jet_offsets) - 1):
+        for jet in range(jet_offsets[event], jet_offsets[event + 1]):
+            for obj in range(obj_offsets[event], obj_offsets[event + 1]):
+                d_phi = _rectify(jet_phi[jet] - obj_phi[obj], pi, two_pi)
+                d_eta = jet_eta[jet] - obj_eta[obj]
+                if np.sqrt(d_phi * d_phi + d_eta * d_eta) < cut:
+                    per_jet[jet] += 1
+    return per_jet
+
+
+@numba.njit(cache=True)
+def _fill_delta_r(
+    jet_eta,
+    jet_phi,
+    jet_offsets,
+    obj_eta,
+    obj_phi,
+    obj_offsets,
+    cut,
+    pi,
+    two_pi,
+    index,
+    distance,
+):
+    n = 0
+    for event in range(len(jet_offsets) - 1):
+        for jet in range(jet_offsets[event], jet_offsets[event + 1]):
+            for obj in range(obj_offsets[event], obj_offsets[event + 1]):
+                d_phi = _rectify(jet_phi[jet] - obj_phi[obj], pi, two_pi)
+                d_eta = jet_eta[jet] - obj_eta[obj]
+                d_r = np.sqrt(d_phi * d_phi + d_eta * d_eta)
+                if d_r < cut:
+                    index[n] = obj - obj_offsets[event]
+                    distance[n] = d_r
+                    n += 1
+
+
+@numba.njit(cache=True)
+def _count_delta_phi(jet_phi, jet_offsets, obj_phi, obj_offsets, cut, pi, two_pi):
+    per_jet = np.zeros(len(jet_phi), dtype=np.int64)
+    for event in range(len(jet_offsets) - 1):
+        for jet in range(jet_offsets[event], jet_offsets[event + 1]):
+            for obj in range(obj_offsets[event], obj_offsets[event + 1]):
+                if abs(_rectify(jet_phi[jet] - obj_phi[obj], pi, two_pi)) < cut:
+                    per_jet[jet] += 1
+    return per_jet
+
+
+@numba.njit(cache=True)
+def _fill_delta_phi(
+    jet_phi, jet_offsets, obj_phi, obj_offsets, cut, pi, two_pi, index, distance
+):
+    n = 0
+    for event in range(len(jet_offsets) - 1):
+        for jet in range(jet_offsets[event], jet_offsets[event + 1]):
+            for obj in range(obj_offsets[event], obj_offsets[event + 1]):
+                d_phi = abs(_rectify(jet_phi[jet] - obj_phi[obj], pi, two_pi))
+                if d_phi < cut:
+                    index[n] = obj - obj_offsets[event]
+                    distance[n] = d_phi
+                    n += 1
+
+
+def _typed(values: np.ndarray, *constants: float):
+    "The constants in the dtype of `values`, as numpy treats python floats"
+    return tuple(values.dtype.type(c) for c in constants)
+
+
+def delta_r_pairs(
+    jet_eta: np.ndarray,
+    jet_phi: np.ndarray,
+    jet_offsets: np.ndarray,
+    obj_eta: np.ndarray,
+    obj_phi: np.ndarray,
+    obj_offsets: np.ndarray,
+    max_delta_r: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Every (jet, object) pair in each event closer than `max_delta_r`.
+
+    Args:
+        jet_eta, jet_phi (np.ndarray): Flat jet eta and phi.
+        jet_offsets (np.ndarray): Where each event's jets start and end.
+        obj_eta, obj_phi (np.ndarray): Flat object eta and phi.
+        obj_offsets (np.ndarray): Where each event's objects start and end.
+        max_delta_r (float): Matching cone size.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The number of matches of each jet,
+            and the index (within its event) and deltaR of every match, by jet and
+            then by object.
+    """
+    constants = _typed(jet_eta, max_delta_r, np.pi, 2 * np.pi)
+    args = (jet_eta, jet_phi, jet_offsets, obj_eta, obj_phi, obj_offsets) + constants
+    per_jet = _count_delta_r(*args)
+    index = np.empty(int(per_jet.sum()), dtype=np.int64)
+    distance = np.empty(len(index), dtype=jet_eta.dtype)
+    _fill_delta_r(*args, index, distance)
+    return per_jet, index, distance
+
+
+def delta_phi_pairs(
+    jet_phi: np.ndarray,
+    jet_offsets: np.ndarray,
+    obj_phi: np.ndarray,
+    obj_offsets: np.ndarray,
+    max_delta_phi: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Every (jet, object) pair in each event less than `max_delta_phi` apart in phi.
+    The same as `delta_r_pairs`, with abs(deltaphi) as the distance.
+    """
+    constants = _typed(jet_phi, max_delta_phi, np.pi, 2 * np.pi)
+    args = (jet_phi, jet_offsets, obj_phi, obj_offsets) + constants
+    per_jet = _count_delta_phi(*args)
+    index = np.empty(int(per_jet.sum()), dtype=np.int64)
+    distance = np.empty(len(index), dtype=jet_phi.dtype)
+    _fill_delta_phi(*args, index, distance)
+    return per_jet, index, distance
+
+
+@numba.njit(cache=True)
+def _relative_to_parent(
+    eta, phi, parent_eta, parent_phi, offsets, pi, two_pi, eta_out, phi_out
+):
+    for i in range(len(offsets) - 1):
+        for j in range(offsets[i], offsets[i + 1]):
+            eta_out[j] = eta[j] - parent_eta[i]
+            phi_out[j] = _rectify(phi[j] - parent_phi[i], pi, two_pi)
+
+
+@numba.njit(cache=True)
+def _sign(total):
+    if total >= 0:
+        return 1.0
+    if total < 0:
+        return -1.0
+    return 0.0
+
+
+@numba.njit(cache=True)
+def _rotate(
+    eta, phi, pt, parent_eta, parent_phi, offsets, zero, pi, two_pi, eta_out, phi_out
+):
+    for i in range(len(offsets) - 1):
+        eta_total = zero
+        phi_total = zero
+        for j in range(offsets[i], offsets[i + 1]):
+            d_eta = eta[j] - parent_eta[i]
+            d_phi = _rectify(phi[j] - parent_phi[i], pi, two_pi)
+            eta_total += d_eta * pt[j]
+            phi_total += d_phi * pt[j]
+            eta_out[j] = d_eta
+            phi_out[j] = d_phi
+        eta_sign = _sign(eta_total)
+        phi_sign = _sign(phi_total)
+        for j in range(offsets[i], offsets[i + 1]):
+            eta_out[j] = eta_out[j] * eta_sign
+            phi_out[j] = phi_out[j] * phi_sign
+
+
+def relative_to_parent(
+    eta: np.ndarray,
+    phi: np.ndarray,
+    parent_eta: np.ndarray,
+    parent_phi: np.ndarray,
+    offsets: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    "As `kinematics.relative_to_parent`"
+    eta_out, phi_out = np.empty_like(eta), np.empty_like(phi)
+    _relative_to_parent(
+        eta,
+        phi,
+        parent_eta,
+        parent_phi,
+        offsets,
+        *_typed(phi, np.pi, 2 * np.pi),
+        eta_out,
+        phi_out,
+    )
+    return eta_out, phi_out
+
+
+def rotate(
+    eta: np.ndarray,
+    phi: np.ndarray,
+    pt: np.ndarray,
+    parent_eta: np.ndarray,
+    parent_phi: np.ndarray,
+    offsets: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The eta and phi of each entry relative to its list's parent, each flipped so its
+    pT weighted sum over the list is positive: `kinematics.relative_to_parent`
+    followed by a `kinematics.weighted_sign` flip of eta and of phi.
+
+    Args:
+        eta, phi, pt (np.ndarray): Flat eta, phi and pT of the entries.
+        parent_eta, parent_phi (np.ndarray): One eta and phi per list.
+        offsets (np.ndarray): Where each list starts and ends.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Rotated eta and phi, flat, as float64 (as the
+            integer sign makes them in the numpy version).
+    """
+    eta_out = np.empty(len(eta), dtype=np.float64)
+    phi_out = np.empty(len(phi), dtype=np.float64)
+    _rotate(
+        eta,
+        phi,
+        pt,
+        parent_eta,
+        parent_phi,
+        offsets,
+        *_typed(eta, 0.0, np.pi, 2 * np.pi),
+        eta_out,
+        phi_out,
+    )
+    return eta_out, phi_out
@@ -0,0 +1,68 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def process_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    workers: int,
+    ordered: bool = True,
+    max_in_flight: Optional[int] = None,
+) -> Iterator[R]:
+    """Run `fn` on each item in a pool of worker processes.
+
+    Only a bounded number of items are submitted at a time so that finished results
+    do not pile up in memory faster than the caller can consume them.
+
+    Args:
+        fn (Callable[[T], R]): Function to run. Must be importable at the top level of a
+            module so it can be sent to the workers.
+        items (Iterable[T]): Arguments for `fn`. Keep these small (e.g. file paths), as
+            they are pickled to get them to the workers.
+        workers (int): Number of worker processes.
+        ordered (bool): If true, results are returned in the order of `items`. Otherwise
+            they are returned as soon as they are ready.
+        max_in_flight (Optional[int]): Maximum number of items submitted to the pool at
+            once. Defaults to twice the number of workers.
+
+    Returns:
+        Iterator[R]: The results of `fn`.
+    """
+    limit = max_in_flight if max_in_flight is not None else 2 * workers
+    it = iter(items)
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+
+    def submit_next() -> Optional[Future]:
+        for item in it:
+            return pool.submit(fn, item)
+        return None
+
+    try:
+        if ordered:
+            queue: deque = deque()
+            while len(queue) < limit and (f := submit_next()) is not None:
+                queue.append(f)
+            while queue:
+                result = queue.popleft().result()
+                if (f := submit_next()) is not None:
+                    queue.append(f)
+                yield result
+        else:
+            pending = set()
+            while len(pending) < limit and (f := submit_next()) is not None:
+                pending.add(f)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for d in done:
+                    if (f := submit_next()) is not None:
+                        pending.add(f)
+                for d in done:
+                    yield d.result()
+    finally:
+        # If the caller stopped early, do not run anything that hasn't started yet.
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,125 @@
+import logging
+import os
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import awkward as ak
+
+from calratio_training_data.metrics import stage
+
+# Called each time an output file is finished with the file path, the sources whose
+# data is now completely written, and the number of jets in the file. The path is
+# `None` for sources that had no jets once all files are written.
+FileWrittenCallback = Callable[[Optional[str], List[str], int], None]
+
+
+def shard_path(output_path: str, index: int) -> str:
+    """The name of an output file (shard) of a training data set.
+
+    Args:
+        output_path (str): The base output path, e.g. `training.parquet`.
+        index (int): The shard number.
+
+    Returns:
+        str: The shard path, e.g. `training_000.parquet`.
+    """
+    return output_path.replace(".parquet", f"_{index:03d}.parquet")
+
+
+def write_training_files(
+    data: Iterable[Tuple[str, ak.Array]],
+    output_path: str,
+    max_file_size: int,
+    first_index: int = 0,
+    on_file_written: Optional[FileWrittenCallback] = None,
+) -> Tuple[List[str], int]:
+    """Stream training data into parquet files.
+
+    Each array is appended to the current file as it arrives (as one or more row
+    groups), so only one array needs to be in memory at a time. Once a file is larger
+    than `max_file_size` on disk it is closed and the next source starts a new file.
+    All the data from one source always ends up in the same file.
+
+    Args:
+        data (Iterable[Tuple[str, ak.Array]]): The training data, along with the name
+            of the source (e.g. ServiceX output file) it came from. All the arrays
+            from one source must be next to each other. Empty arrays are not written.
+        output_path (str): The base output path. Files are named `<base>_000.parquet`,
+            `<base>_001.parquet`, etc.
+        max_file_size (int): Target on-disk size of each file in bytes. A file is
+            closed once it passes this size at the end of a source, so files will be
+            a bit larger.
+        first_index (int): The number of the first file to write.
+        on_file_written (Optional[FileWrittenCallback]): Called after each file is
+            closed.
+
+    Returns:
+        Tuple[List[str], int]: The paths of the files that were written and the total
+            number of jets written to them.
+    """
+    items = iter(data)
+    held: Optional[Tuple[str, ak.Array]] = None
+    sources: List[str] = []
+    written = []
+    total_jets = 0
+    index = first_index
+
+    def next_item() -> Optional[Tuple[str, ak.Array]]:
+        nonlocal held
+        if held is not None:
+            item, held = held, None
+            return item
+        return next(items, None)
+
+    def add_source(source: str):
+        if len(sources) == 0 or sources[-1] != source:
+            sources.append(source)
+
+    while True:
+        # Only start a file when we have something to put in it.
+        while (item := next_item()) is not None and len(item[1]) == 0:
+            add_source(item[0])
+        if item is None:
+            break
+
+        path = shard_path(output_path, index)
+        n_jets = 0
+
+        def row_groups(first: Tuple[str, ak.Array]) -> Iterator[ak.Array]:
+            nonlocal held, n_jets
+            source, a = first
+            while True:
+                add_source(source)
+                if len(a) > 0:
+                    n_jets += len(a)
+                    # Resumed once the array has been written.
+                    with stage("write"):
+                        yield a
+                if (item := next_item()) is None:
+                    return
+                if item[0] != source and os.path.getsize(path) >= max_file_size:
+                    held = item
+                    return
+                source, a = item
+
+        ak.to_parquet_row_groups(
+            row_groups(item),
+            path,
+            compression="ZSTD",
+            compression_level=-7,
+            categorical_as_dictionary=True,
+        )
+        logging.info(
+            f"Wrote file {path} with on-disk size "
+            f"{os.path.getsize(path) / 1_073_741_824:0.2f} GB and {n_jets:,} jets."
+        )
+        if on_file_written is not None:
+            on_file_written(path, sources, n_jets)
+        sources = []
+        written.append(path)
+        total_jets += n_jets
+        index += 1
+
+    if len(sources) > 0 and on_file_written is not None:
+        on_file_written(None, sources, 0)
+
+    return written, total_jets
@@ -1,13 +1,58 @@
-from typing import Optional
+from typing import Optional, Tuple
 import awkward as ak
 import numpy as np
-from vector._compute.planar.deltaphi import rectify
+
+from calratio_training_data.constants import Engine
+from calratio_training_data.kinematics import (
+    broadcast_to_lists,
+    delta_phi,
+    flat_lists,
+    jagged,
+    relative_to_parent,
+    weighted_sign,
+)
+
+
+def _jet_angles(jets: ak.Array, dtype: np.dtype) -> Tuple[np.ndarray, np.ndarray]:
+    # The eta and phi of each jet. Jets that are None only have empty lists, so their
+    # angle is never used.
+    missing = dtype.type(np.nan)
+    return (
+        ak.to_numpy(ak.fill_none(jets.eta, missing)),
+        ak.to_numpy(ak.fill_none(jets.phi, missing)),
+    )
 
 
 def relative_angle(jets: ak.Array, objects: ak.Array):
-    # Modifies in place the eta and phi to be relative to the jet axis
-    objects["eta"] = objects.deltaeta(jets)
-    objects["phi"] = objects.deltaphi(jets)
+    # Modifies in place the eta and phi to be relative to the jet axis.
+    eta, offsets = flat_lists(objects.eta)
+    phi, _ = flat_lists(objects.phi)
+    eta, phi = relative_to_parent(eta, phi, *_jet_angles(jets, eta.dtype), offsets)
+    objects["eta"] = jagged(eta, offsets)
+    objects["phi"] = jagged(phi, offsets)
+
+
+def rotate_and_flip(jets: ak.Array, objects: ak.Array):
+    # Modifies in place as `relative_angle` and then `flip_to_positive` of eta and
+    # of phi, in one compiled pass over each list (the numba engine).
+    from calratio_training_data import numba_kernels
+
+    eta, offsets = flat_lists(objects.eta)
+    phi, _ = flat_lists(objects.phi)
+    pt, _ = flat_lists(objects.pt)
+    eta, phi = numba_kernels.rotate(
+        eta, phi, pt, *_jet_angles(jets, eta.dtype), offsets
+    )
+    objects["eta"] = jagged(eta, offsets)
+    objects["phi"] = jagged(phi, offsets)
+
+
+def flip_to_positive(data: ak.Array, field: str):
+    # Modifies in place `field` so that its pT weighted sum is positive in each list
+    values, offsets = flat_lists(data[field])
+    pt, _ = flat_lists(data.pt)
+    sign = broadcast_to_lists(weighted_sign(values, pt, offsets), offsets)
+    data[field] = jagged(values * sign, offsets)
 
 
 def sort_by_pt(data: ak.Array) -> ak.Array:
@@ -16,7 +61,12 @@ def sort_by_pt(data: ak.Array) -> ak.Array:
     return data[new_data_index]
 
 
-def do_rotations(data: ak.Array, datatype, jets: Optional[ak.Array] = None):
+def do_rotations(
+    data: ak.Array,
+    datatype,
+    jets: Optional[ak.Array] = None,
+    engine: Engine = Engine.AWKWARD,
+):
     """
     Do rotations on clusters (tracks, msegs). Done to get the highest cluster (track, mseg) by pT
     is at the center. Ensures NN learns from a standardized set of jets.
@@ -27,6 +77,7 @@ def do_rotations(data: ak.Array, datatype, jets: Optional[ak.Array] = None):
         datatype (str): Type of data to be rotated, needed because msegs are rotated differently
             either: cluster, track, mseg
         jets (ak.Array): Set of jets, needed to do track and mseg rotation
+        engine (Engine): Do the rotations with numpy (awkward) or compiled loops (numba)
 
     Returns:
         processed (dict[str, ak.Array]): Processed data
@@ -36,30 +87,40 @@ def do_rotations(data: ak.Array, datatype, jets: Optional[ak.Array] = None):
         # Sort the data if its a cluster or a track
         data = sort_by_pt(data)
         if datatype == "cluster":
-            relative_angle(ak.firsts(data), data)
+            leading = ak.firsts(data)
+            axis = leading
         if datatype == "track":
             assert jets is not None, "Jets must be provided for track rotation"
-            relative_angle(jets, data)
+            axis = jets
 
-        # eta flip
-        eta_sign = ak.sum(np.multiply(data.eta, data.pt), axis=1)
-        eta_sign = ak.fill_none(eta_sign, 0)
-        eta_sign = np.vectorize(lambda x: 1 * (x >= 0) + (-1) * (x < 0))(eta_sign)
-        data["eta"] = data.eta * eta_sign
+        if engine == Engine.NUMBA:
+            rotate_and_flip(axis, data)
+        else:
+            relative_angle(axis, data)
 
-        # phi flip
-        phi_sign = ak.sum(np.multiply(data.phi, data.pt), axis=1)
-        phi_sign = ak.fill_none(phi_sign, 0)
-        phi_sign = np.vectorize(lambda x: 1 * (x >= 0) + (-1) * (x < 0))(phi_sign)
-        data["phi"] = data.phi * phi_sign
+            # eta flip, then phi flip
+            flip_to_positive(data, "eta")
+            flip_to_positive(data, "phi")
+
+        if datatype == "cluster":
+            # With no clusters there is no leading cluster to rotate to.
+            data = ak.mask(data, ~ak.is_none(leading))
 
     if datatype == "mseg" and data is not None:
         # msegs occasionally empty - check for that else it crashes
         assert jets is not None, "Jets must be provided for mseg rotation"
-        mseg_deta_pos = data.etaPos - jets.eta
-        data["etaPos"] = mseg_deta_pos
-        mseg_dphi_pos = rectify(np, data.phiPos - jets.phi)
-        data["phiPos"] = mseg_dphi_pos
-        mseg_dphi_dir = rectify(np, data.phiDir - jets.phi)
-        data["phiDir"] = mseg_dphi_dir
+        eta_pos, offsets = flat_lists(data.etaPos)
+        phi_pos, _ = flat_lists(data.phiPos)
+        phi_dir, _ = flat_lists(data.phiDir)
+        jet_eta, jet_phi = ak.to_numpy(jets.eta), ak.to_numpy(jets.phi)
+        relative = relative_to_parent
+        if engine == Engine.NUMBA:
+            from calratio_training_data import numba_kernels
+
+            relative = numba_kernels.relative_to_parent
+        eta_pos, phi_pos = relative(eta_pos, phi_pos, jet_eta, jet_phi, offsets)
+        phi_dir = delta_phi(phi_dir, broadcast_to_lists(jet_phi, offsets))
+        data["etaPos"] = jagged(eta_pos, offsets)
+        data["phiPos"] = jagged(phi_pos, offsets)
+        data["phiDir"] = jagged(phi_dir, offsets)
     return data
@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import yaml
+
+from calratio_training_data.fetch import DataType
+
+
+@dataclass
+class ProductionEntry:
+    "One dataset to fetch as part of a production"
+
+    dataset: str
+    datatype: DataType
+    desc_label: str
+    n_files: Optional[int] = None
+    output: str = "training.parquet"
+
+
+def default_output(dataset: str, desc_label: str) -> str:
+    """The output file for a dataset when the production list does not give one.
+
+    Args:
+        dataset (str): The dataset name.
+        desc_label (str): The descriptive label for the dataset.
+
+    Returns:
+        str: The output path, e.g. `HSS_513109.parquet`.
+    """
+    from calratio_training_data.sx_utils import extract_run_number_and_name
+
+    run_number, dataset_name = extract_run_number_and_name(dataset)
+    name = run_number if run_number else Path(dataset_name).stem
+    return f"{desc_label}_{name}.parquet"
+
+
+def load_production_yaml(path: Path) -> List[ProductionEntry]:
+    """Load a list of datasets to fetch. The file looks like:
+
+        output-dir: training      # optional
+        datasets:
+          - dataset: mc23_13p6TeV:mc23_13p6TeV.801234.....
+            datatype: signal
+            desc-label: HSS
+            n-files: 10           # optional, default is all files
+            output: hss.parquet   # optional
+
+    Args:
+        path (Path): The YAML file.
+
+    Returns:
+        List[ProductionEntry]: The datasets, in the order they are listed.
+    """
+    with open(path) as f:
+        data = yaml.safe_load(f)
+
+    output_dir = data.get("output-dir")
+    entries = []
+    for item in data["datasets"]:
+        output = item.get("output") or default_output(
+            item["dataset"], item["desc-label"]
+        )
+        if output_dir is not None:
+            output = str(Path(output_dir) / output)
+        entries.append(
+            ProductionEntry(
+                dataset=item["dataset"],
+                datatype=DataType(item["datatype"]),
+                desc_label=item["desc-label"],
+                n_files=item.get("n-files"),
+                output=output,
+            )
+        )
+
+    outputs = [e.output for e in entries]
+    duplicates = sorted({o for o in outputs if outputs.count(o) > 1})
+    if len(duplicates) > 0:
+        raise ValueError(
+            f"More than one dataset writes to {', '.join(duplicates)} - give each "
+            "one a different `output`."
+        )
+
+    return entries
@@ -0,0 +1,482 @@
+from dataclasses import dataclass
+from math import cos, pi, sqrt
+
+from func_adl import ObjectStream
+from func_adl_servicex_xaodr25 import FADLStream, FuncADLQueryPHYS
+from func_adl_servicex_xaodr25.xaod import xAOD
+from func_adl_servicex_xaodr25.xAOD.calocluster_v1 import CaloCluster_v1
+from func_adl_servicex_xaodr25.xAOD.eventinfo_v1 import EventInfo_v1
+from func_adl_servicex_xaodr25.xAOD.jet_v1 import Jet_v1
+from func_adl_servicex_xaodr25.xAOD.muonsegment_v1 import MuonSegment_v1
+from func_adl_servicex_xaodr25.xAOD.trackparticle_v1 import TrackParticle_v1
+from func_adl_servicex_xaodr25.xAOD.truthparticle_v1 import TruthParticle_v1
+from func_adl_servicex_xaodr25.xAOD.vertex_v1 import Vertex_v1
+from func_adl_servicex_xaodr25.xAOD.vxtype import VxType
+from func_adl_servicex_xaodr25 import cpp_float
+
+from calratio_training_data.constants import (
+    JET_MSEG_DELTA_PHI,
+    JET_TRACK_DELTA_R,
+    LLP_JET_DELTA_R,
+    SKIM_MARGIN,
+    LLP_central_eta_cut,
+    LLP_Lxy_max,
+    LLP_Lxy_min,
+    LLP_Lz_max,
+    LLP_Lz_min,
+)
+from calratio_training_data.triggers import trigger_bib_filter
+
+from .cpp_xaod_utils import (
+    add_jet_selection_tool,
+    cluster_layer_energies,
+    cvt_to_raw_calocluster,
+    jet_clean_llp,
+    track_summary_value,
+    transfer_float,
+    particle_radiates,
+)
+
+from calratio_training_data.fetch import DataType
+
+
+@dataclass
+class TopLevelEvent:
+    """Make it easy to type-safe carry everything around.
+
+    Note: SX will only evaluate the terms that are actually asked for in the final query!
+    """
+
+    event_info: EventInfo_v1
+    vertices: FADLStream[Vertex_v1]
+    pv_tracks: FADLStream[TrackParticle_v1]
+    # Number of `pv_tracks` (before any skimming of them)
+    n_pv_tracks: int
+    muon_segments: FADLStream[MuonSegment_v1]
+    # The good training jets. Their clusters come from `jet_clusters`, so that any
+    # selection of the jets applies to them too.
+    jets: FADLStream[Jet_v1]
+    # The jets that pass the kinematic cuts of `good_training_jet`: a superset of
+    # `jets` that is cheap to loop over for each track (see `skim_near_jets`).
+    kinematic_jets: FADLStream[Jet_v1]
+    topo_clusters: FADLStream[CaloCluster_v1]
+
+    # All tracks with no selection at all. From Inner Detector container
+    all_tracks: FADLStream[TrackParticle_v1]
+
+    # Truth particles
+    bsm_particles: FADLStream[TruthParticle_v1]
+
+
+def kinematic_training_jet(jet: Jet_v1) -> bool:
+    """Check that the jet passes the pT and eta cuts for training"""
+    return (jet.pt() / 1000.0 > 40 and jet.pt() / 1000.0 < 500) and abs(jet.eta()) < 2.5
+
+
+def good_training_jet(jet: Jet_v1) -> bool:
+    """Check that the jet is suitable for training"""
+    return kinematic_training_jet(jet) and jet_clean_llp(jet)
+
+
+def near_in_eta_phi(a, b, size: float) -> bool:
+    """Check that `a` and `b` are within `size` of each other in both eta and phi: a
+    box that holds the deltaR < `size` cone."""
+    return abs(a.eta() - b.eta()) < size and (
+        abs(a.phi() - b.phi()) < size or abs(a.phi() - b.phi()) > 2 * pi - size
+    )
+
+
+def near_in_phi(s: MuonSegment_v1, j: Jet_v1, cos_delta_phi: float) -> bool:
+    """Check that the angle in phi between the segment's position and the jet has a
+    cosine above `cos_delta_phi` (which must be positive). The cosine comes from the
+    dot product in x-y, squared to avoid a `sqrt` (which the C++ translation can't
+    multiply)."""
+    return s.x() * j.px() + s.y() * j.py() > 0 and (
+        (s.x() * j.px() + s.y() * j.py()) * (s.x() * j.px() + s.y() * j.py())
+        > cos_delta_phi
+        * cos_delta_phi
+        * (s.x() * s.x() + s.y() * s.y())
+        * (j.pt() * j.pt())
+    )
+
+
+def jet_clusters(jet: Jet_v1) -> FADLStream[CaloCluster_v1]:
+    """The clusters the jet is made of"""
+    return [
+        cvt_to_raw_calocluster(cl) for cl in jet.constituentLinks() if cl.isValid()
+    ]  # type: ignore
+
+
+def build_preselection(data_type: DataType):
+    # Start the query
+    query_base = add_jet_selection_tool(
+        FuncADLQueryPHYS(), "m_jetCleaning_llp", "LooseBadLLP"
+    )
+
+    # Apply any top level trigger/event selection.
+    if data_type == DataType.BIB:
+        query_base = trigger_bib_filter(query_base)
+
+    # Do top level object filtering
+    query_base_objects = query_base.Select(
+        lambda e: TopLevelEvent(
+            event_info=e.EventInfo("EventInfo"),
+            vertices=e.Vertices("PrimaryVertices").Where(
+                lambda v: v.vertexType() == VxType.VertexType.PriVtx
+            ),
+            pv_tracks=(
+                e.Vertices("PrimaryVertices")
+                .Where(lambda v: v.vertexType() == VxType.VertexType.PriVtx)
+                .First()
+                .trackParticleLinks()
+                .Where(lambda t: t.isValid())  # type: ignore
+            ),
+            n_pv_tracks=(
+                e.Vertices("PrimaryVertices")
+                .Where(lambda v: v.vertexType() == VxType.VertexType.PriVtx)
+                .First()
+                .trackParticleLinks()
+                .Where(lambda t: t.isValid())  # type: ignore
+                .Count()
+            ),
+            muon_segments=e.MuonSegments("MuonSegments"),
+            jets=[
+                j
+                for j in e.Jets(collection="AntiKt4EMTopoJets", calibrate=False)
+                if good_training_jet(j)
+            ],  # type: ignore
+            kinematic_jets=[
+                j
+                for j in e.Jets(collection="AntiKt4EMTopoJets", calibrate=False)
+                if kinematic_training_jet(j)
+            ],  # type: ignore
+            all_tracks=e.TrackParticles("InDetTrackParticles"),
+            topo_clusters=e.CaloClusters("CaloCalTopoClusters"),
+            bsm_particles=e.TruthParticles("TruthBSMWithDecayParticles")
+            .Where(lambda truth_p: truth_p.absPdgId() == 35 or truth_p.absPdgId() == 51)
+            .Where(lambda p: not particle_radiates(p)),
+        )
+    )
+
+    # Preselection
+    query_preselection = query_base_objects.Where(
+        lambda e: len(e.vertices) > 0  # type: ignore
+        and e.vertices.First().nTrackParticles() > 0
+        and len(e.jets) > 0  # type: ignore
+    )
+
+    return query_preselection
+
+
+def skim_near_jets(query: ObjectStream) -> ObjectStream:
+    """
+    Keep only the PV tracks and muon segments that can be matched to a good jet:
+    tracks within `JET_TRACK_DELTA_R` and segments within `JET_MSEG_DELTA_PHI` of at
+    least one jet (plus `SKIM_MARGIN`). The conversion matches the same tracks and
+    segments to each jet as without the skim, so the training data is unchanged, but
+    far less is sent back.
+
+    Tracks are kept in an (eta, phi) box around each jet, which holds the deltaR
+    cone. Segments are kept if the cosine of the angle in phi between their position
+    and the jet is large enough. Both are plain arithmetic, since every helper
+    function call adds to the (already deep) query.
+
+    The jets are looped over again for every track and segment, in every branch, so
+    the test is made against the `kinematic_jets`, which don't need the jet cleaning
+    tool. They are a superset of the good jets, so a few more tracks and segments
+    than needed may be kept.
+
+    Args:
+        query (ObjectStream): The preselection query (see `build_preselection`).
+
+    Returns:
+        ObjectStream: The query with the skimmed `TopLevelEvent`.
+    """
+    track_delta_r = JET_TRACK_DELTA_R + SKIM_MARGIN
+    mseg_cos_delta_phi = cos(JET_MSEG_DELTA_PHI + SKIM_MARGIN)
+
+    return query.Select(
+        lambda e: TopLevelEvent(
+            event_info=e.event_info,
+            vertices=e.vertices,
+            pv_tracks=e.pv_tracks.Where(
+                lambda t: e.kinematic_jets.Where(
+                    lambda j: near_in_eta_phi(j, t, track_delta_r)
+                ).Count()
+                > 0
+            ),
+            n_pv_tracks=e.n_pv_tracks,
+            muon_segments=e.muon_segments.Where(
+                lambda s: e.kinematic_jets.Where(
+                    lambda j: near_in_phi(s, j, mseg_cos_delta_phi)
+                ).Count()
+                > 0
+            ),
+            jets=e.jets,
+            kinematic_jets=e.kinematic_jets,
+            all_tracks=e.all_tracks,
+            topo_clusters=e.topo_clusters,
+            bsm_particles=e.bsm_particles,
+        )
+    )
+
+
+def in_calorimeter(p: TruthParticle_v1) -> bool:
+    """Check that the LLP decays in the calorimeter: the fiducial cut made when
+    converting, widened by `SKIM_MARGIN`, so some LLPs just outside it pass."""
+    return p.hasDecayVtx() and (
+        (
+            abs(p.eta()) < LLP_central_eta_cut + SKIM_MARGIN
+            and p.decayVtx().x() * p.decayVtx().x()
+            + p.decayVtx().y() * p.decayVtx().y()
+            > (LLP_Lxy_min - SKIM_MARGIN) * (LLP_Lxy_min - SKIM_MARGIN)
+            and p.decayVtx().x() * p.decayVtx().x()
+            + p.decayVtx().y() * p.decayVtx().y()
+            < (LLP_Lxy_max + SKIM_MARGIN) * (LLP_Lxy_max + SKIM_MARGIN)
+        )
+        or (
+            abs(p.eta()) > LLP_central_eta_cut - SKIM_MARGIN
+            and abs(p.decayVtx().z()) > LLP_Lz_min - SKIM_MARGIN
+            and abs(p.decayVtx().z()) < LLP_Lz_max + SKIM_MARGIN
+        )
+    )
+
+
+def select_llp_jets(query: ObjectStream) -> ObjectStream:
+    """
+    Keep only the LLPs that decay in the calorimeter, the jets (and their clusters)
+    near one of them, and the events with such a jet: only those jets are used to
+    train on. The conversion applies the exact cuts, so the training data is
+    unchanged, but it is made from far less data.
+
+    Jets are kept in an (eta, phi) box around each LLP, which holds the
+    `LLP_JET_DELTA_R` cone (plus `SKIM_MARGIN`). The LLPs must be in
+    `bsm_particles`, so this only makes sense for signal.
+
+    Args:
+        query (ObjectStream): The preselection query (see `build_preselection`).
+
+    Returns:
+        ObjectStream: The query with the selected `TopLevelEvent`s.
+    """
+    llp_delta_r = LLP_JET_DELTA_R + SKIM_MARGIN
+
+    return query.Select(
+        lambda e: TopLevelEvent(
+            event_info=e.event_info,
+            vertices=e.vertices,
+            pv_tracks=e.pv_tracks,
+            n_pv_tracks=e.n_pv_tracks,
+            muon_segments=e.muon_segments,
+            jets=e.jets.Where(
+                lambda j: e.bsm_particles.Where(
+                    lambda p: in_calorimeter(p) and near_in_eta_phi(p, j, llp_delta_r)
+                ).Count()
+                > 0
+            ),
+            kinematic_jets=e.kinematic_jets,
+            all_tracks=e.all_tracks,
+            topo_clusters=e.topo_clusters,
+            bsm_particles=e.bsm_particles.Where(lambda p: in_calorimeter(p)),
+        )
+    ).Where(
+        lambda e: len(e.jets) > 0  # type: ignore
+    )
+
+
+def without_duplicate_metadata(query: ObjectStream) -> ObjectStream:
+    """
+    The query with each `MetaData` call kept only once.
+
+    func_adl wraps the query in a `MetaData` call for every typed method call made in
+    a step, most of them the same ones again. Every wrapper adds to the depth of the
+    query, which is walked recursively when it is turned into text, so removing them
+    after each step keeps that within Python's default recursion limit. The
+    transformer collects the metadata from the whole query, so the C++ is unchanged.
+
+    Args:
+        query (ObjectStream): The query.
+
+    Returns:
+        ObjectStream: The same query, with the duplicate metadata removed.
+    """
+    return query.clone_with_new_ast(query.clean_ast(), query.item_type)
+
+
+def build_training_query(
+    data_type: DataType,
+    skim_to_jets: bool = False,
+    llp_jets_only: bool = False,
+    compact_transfer: bool = False,
+) -> ObjectStream:
+    """
+    Build the query that extracts the raw training data columns.
+
+    Args:
+        data_type (DataType): The type of data we are fetching.
+        skim_to_jets (bool): Only send back the tracks and muon segments near good
+            jets (see `skim_near_jets`).
+        llp_jets_only (bool): For signal, only send back the jets near an LLP that
+            decays in the calorimeter (see `select_llp_jets`).
+        compact_transfer (bool): Make the output files smaller: send back the
+            kinematics as 32 bit floats, the number of primary vertex tracks once per
+            event (`n_pv_tracks`, rather than `track_vertex_nParticles` for each
+            track), and only the branches the conversion reads for this data type.
+
+    Returns:
+        ObjectStream: The query, ready to be sent to ServiceX.
+    """
+    # Get the base query
+    query_preselection = without_duplicate_metadata(build_preselection(data_type))
+    if llp_jets_only and data_type == DataType.SIGNAL:
+        query_preselection = without_duplicate_metadata(
+            select_llp_jets(query_preselection)
+        )
+    if skim_to_jets:
+        query_preselection = without_duplicate_metadata(
+            skim_near_jets(query_preselection)
+        )
+
+    # Dictionary requires a constant test
+    is_signal = data_type == DataType.SIGNAL
+    is_bib = data_type == DataType.BIB
+    has_weights = not compact_transfer or data_type in (DataType.SIGNAL, DataType.QCD)
+    has_pdgid = is_signal and not compact_transfer
+    compact = compact_transfer
+
+    # Query the run number, etc.
+    query = query_preselection.Select(
+        lambda e: {
+            "runNumber": e.event_info.runNumber(),
+            "eventNumber": e.event_info.eventNumber(),
+            **({"mcEventWeight": e.event_info.mcEventWeight(0)} if has_weights else {}),
+            #
+            # Track Info
+            #
+            "track_pT": [transfer_float(t.pt() / 1000.0, compact) for t in e.pv_tracks],
+            "track_eta": [transfer_float(t.eta(), compact) for t in e.pv_tracks],
+            "track_phi": [transfer_float(t.phi(), compact) for t in e.pv_tracks],
+            **(
+                {"n_pv_tracks": e.n_pv_tracks}
+                if compact_transfer
+                else {
+                    "track_vertex_nParticles": [e.n_pv_tracks for t in e.pv_tracks],
+                }
+            ),
+            "track_d0": [t.d0() for t in e.pv_tracks],
+            "track_z0": [t.z0() for t in e.pv_tracks],
+            "track_chiSquared": [t.chiSquared() for t in e.pv_tracks],
+            "track_PixelShared": [
+                track_summary_value(t, xAOD.SummaryType.numberOfPixelSharedHits)
+                for t in e.pv_tracks
+            ],
+            "track_SCTShared": [
+                track_summary_value(t, xAOD.SummaryType.numberOfSCTSharedHits)
+                for t in e.pv_tracks
+            ],
+            "track_PixelHoles": [
+                track_summary_value(t, xAOD.SummaryType.numberOfPixelHoles)
+                for t in e.pv_tracks
+            ],
+            "track_SCTHoles": [
+                track_summary_value(t, xAOD.SummaryType.numberOfSCTHoles)
+                for t in e.pv_tracks
+            ],
+            "track_PixelHits": [
+                track_summary_value(t, xAOD.SummaryType.numberOfPixelHits)
+                for t in e.pv_tracks
+            ],
+            "track_SCTHits": [
+                track_summary_value(t, xAOD.SummaryType.numberOfSCTHits)
+                for t in e.pv_tracks
+            ],
+            #
+            # Muon Segments. We will convert to eta and phi after we load these guys.
+            #
+            "MSeg_x": [s.x() for s in e.muon_segments],
+            "MSeg_y": [s.y() for s in e.muon_segments],
+            "MSeg_z": [s.z() for s in e.muon_segments],
+            "MSeg_px": [s.px() for s in e.muon_segments],
+            "MSeg_py": [s.py() for s in e.muon_segments],
+            "MSeg_pz": [s.pz() for s in e.muon_segments],
+            "MSeg_t0": [s.t0() for s in e.muon_segments],
+            "MSeg_chiSquared": [s.chiSquared() for s in e.muon_segments],
+            #
+            # Jets
+            #
+            "jet_pt": [transfer_float(j.pt() / 1000.0, compact) for j in e.jets],
+            "jet_eta": [transfer_float(j.eta(), compact) for j in e.jets],
+            "jet_phi": [transfer_float(j.phi(), compact) for j in e.jets],
+            #
+            # Clusters
+            #   Write out all clusters
+            #   Layer definitions are in `LAYER_SAMPLINGS` (see `cpp_xaod_utils`)
+            # These are a double-nested list, a list of clusters for each jet.
+            "clus_eta": [
+                [transfer_float(c.eta(), compact) for c in jet_clusters(j)]
+                for j in e.jets
+            ],
+            "clus_phi": [
+                [transfer_float(c.phi(), compact) for c in jet_clusters(j)]
+                for j in e.jets
+            ],
+            "clus_pt": [
+                [transfer_float(c.pt() / 1000.0, compact) for c in jet_clusters(j)]
+                for j in e.jets
+            ],
+            # The energy in each of the `CLUSTER_LAYERS`, eight numbers per cluster,
+            # all filled in one pass over the clusters.
+            "clus_layers": [
+                jet_clusters(j).SelectMany(lambda c: cluster_layer_energies(c))
+                for j in e.jets
+            ],
+            "clus_time": [[c.time() for c in jet_clusters(j)] for j in e.jets],
+            **(
+                {
+                    "LLP_eta": [
+                        transfer_float(p.eta(), compact) for p in e.bsm_particles
+                    ],
+                    "LLP_phi": [
+                        transfer_float(p.phi(), compact) for p in e.bsm_particles
+                    ],
+                    "LLP_pt": [
+                        transfer_float(p.pt() / 1000.0, compact)
+                        for p in e.bsm_particles
+                    ],
+                    "LLP_Lz": [
+                        transfer_float(
+                            p.decayVtx().z() if p.hasDecayVtx() else 0.0, compact
+                        )
+                        for p in e.bsm_particles
+                    ],
+                    "LLP_Lxy": [
+                        transfer_float(
+                            (
+                                sqrt(p.decayVtx().x() ** 2 + p.decayVtx().y() ** 2)
+                                if p.hasDecayVtx()
+                                else 0.0
+                            ),
+                            compact,
+                        )
+                        for p in e.bsm_particles
+                    ],
+                }
+                if is_signal
+                else {}
+            ),
+            **(
+                {"LLP_pdgid": [p.absPdgId() for p in e.bsm_particles]}
+                if has_pdgid
+                else {}
+            ),
+            **(
+                {
+                    "jet_emf": [j.getAttribute[cpp_float]("EMFrac") for j in e.jets],
+                }
+                if is_bib
+                else {}
+            ),
+        }
+    )
+
+    return without_duplicate_metadata(query)
@@ -0,0 +1,199 @@
+import logging
+import os
+import queue
+import threading
+from typing import Iterable, Iterator, List, Optional, TypeVar
+
+import awkward as ak
+import numpy as np
+import pyarrow.parquet as pq
+import uproot
+
+T = TypeVar("T")
+
+# Name of the tree ServiceX writes out for the xAOD transformer
+SX_TREE_NAME = "atlas_xaod_tree"
+
+# Marks the end of the producer's items in the read-ahead queue.
+_END = object()
+
+
+def load_file(path: str, branches: Optional[List[str]] = None) -> ak.Array:
+    """Read the data in a ServiceX output file, or a parquet copy of one.
+
+    Args:
+        path (str): Path (or url) of the ServiceX output file.
+        branches (Optional[List[str]]): Only read these branches. All other branches
+            are never decompressed. If `None`, read everything.
+
+    Returns:
+        ak.Array: The contents of the `atlas_xaod_tree` tree.
+    """
+    if path.endswith(".parquet"):
+        return ak.from_parquet(path, columns=branches)
+
+    with uproot.open(path) as f:
+        tree = f[SX_TREE_NAME]
+        if branches is not None and logging.getLogger().isEnabledFor(logging.DEBUG):
+            _log_skipped_branches(path, tree, branches)
+        return tree.arrays(filter_name=branches)  # type: ignore
+
+
+def iterate_file(
+    path: str, branches: Optional[List[str]] = None, step_size: Optional[int] = None
+) -> Iterator[ak.Array]:
+    """Read the data in a ServiceX output file (or a parquet copy of one) a chunk
+    of events at a time.
+
+    Args:
+        path (str): Path (or url) of the ServiceX output file.
+        branches (Optional[List[str]]): Only read these branches. If `None`, read
+            everything.
+        step_size (Optional[int]): Number of events in each chunk. If `None`, the
+            whole file is returned as a single chunk.
+
+    Returns:
+        Iterator[ak.Array]: The contents of the `atlas_xaod_tree` tree, in order.
+    """
+    if step_size is None:
+        yield load_file(path, branches)
+        return
+
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(
+            batch_size=step_size, columns=branches
+        ):
+            yield ak.from_arrow(batch)
+        return
+
+    with uproot.open(path) as f:
+        tree = f[SX_TREE_NAME]
+        if branches is not None and logging.getLogger().isEnabledFor(logging.DEBUG):
+            _log_skipped_branches(path, tree, branches)
+        yield from tree.iterate(filter_name=branches, step_size=step_size)  # type: ignore
+
+
+def compact_raw_data(data: ak.Array) -> ak.Array:
+    """Shrink raw ServiceX data for storage by storing per-object floating point
+    columns as 32 bit floats. Conversion works in 32 bit floats, so this does not
+    change the training data. Per-event columns are kept as they are.
+
+    Args:
+        data (ak.Array): Raw data as read from a ServiceX output file.
+
+    Returns:
+        ak.Array: The same data, with smaller floats.
+    """
+    columns = {}
+    for name in data.fields:
+        column = data[name]
+        if column.ndim > 1 and ak.flatten(column, axis=None).layout.dtype == np.float64:
+            column = ak.values_astype(column, np.float32)
+        columns[name] = column
+    return ak.zip(columns, depth_limit=1)
+
+
+def cache_raw_chunks(chunks: Iterable[ak.Array], cache_path: str) -> Iterator[ak.Array]:
+    """Pass chunks of raw data through, writing a compact parquet copy of them as they
+    go by (see `compact_raw_data`).
+
+    The copy only appears at `cache_path` once all the chunks have been written, so
+    an interrupted run never leaves a partial copy behind.
+
+    Args:
+        chunks (Iterable[ak.Array]): Raw data chunks from one ServiceX output file.
+        cache_path (str): Where to write the parquet copy.
+
+    Returns:
+        Iterator[ak.Array]: The chunks, unchanged.
+    """
+    tmp_path = f"{cache_path}.tmp"
+    writer = None
+    try:
+        for chunk in chunks:
+            table = ak.to_arrow_table(compact_raw_data(chunk), extensionarray=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="ZSTD")
+            writer.write_table(table)
+            yield chunk
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(tmp_path, cache_path)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _log_skipped_branches(path: str, tree, branches: List[str]):
+    "Log how much data we are avoiding reading"
+    wanted = set(branches)
+    skipped = [b for b in tree.keys() if b not in wanted]
+    compressed = sum(tree[b].compressed_bytes for b in skipped)
+    uncompressed = sum(tree[b].uncompressed_bytes for b in skipped)
+    logging.debug(
+        f"Skipping {len(skipped)} of {len(tree.keys())} branches in {path}: "
+        f"{compressed / 1_048_576:0.2f} MB compressed, "
+        f"{uncompressed / 1_048_576:0.2f} MB uncompressed."
+    )
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    "Put an item on the queue, giving up if the consumer has gone away"
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def read_ahead(items: Iterable[T], depth: int = 2) -> Iterator[T]:
+    """Iterate over `items` on a background thread so that the next item is
+    being produced (e.g. a file read and decompressed) while the caller works on the
+    current one.
+
+    At most `depth` items are held waiting for the caller, which bounds the extra
+    memory used. Items are returned in order. Any exception raised while producing
+    an item is re-raised in the caller.
+
+    Args:
+        items (Iterable[T]): The items to iterate over. This is iterated on the
+            background thread, so put any expensive work in the iterator.
+        depth (int): How many items to keep ready. If zero or less, no background
+            thread is used and `items` is iterated in the caller's thread.
+
+    Returns:
+        Iterator[T]: The items, in order.
+    """
+    if depth <= 0:
+        yield from items
+        return
+
+    q: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in items:
+                if not _put(q, (True, item), stop):
+                    return
+            _put(q, (True, _END), stop)
+        except BaseException as e:
+            _put(q, (False, e), stop)
+
+    thread = threading.Thread(target=producer, name="read-ahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = q.get()
+            if not ok:
+                raise item
+            if item is _END:
+                break
+            yield item
+    finally:
+        # If the caller stops early, make sure the producer does not block forever.
+        stop.set()
+        thread.join()
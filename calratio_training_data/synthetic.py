@@ -0,0 +1,214 @@
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import awkward as ak
+import numpy as np
+
+from calratio_training_data.constants import (
+    CLUSTER_LAYERS,
+    LLP_Lxy_max,
+    LLP_Lxy_min,
+    LLP_Lz_max,
+    LLP_Lz_min,
+    min_jet_pt,
+)
+from calratio_training_data.fetch import DataType
+
+
+@dataclass
+class Multiplicities:
+    "Mean number of objects per event (or per jet for clusters)"
+
+    jets: float
+    tracks: float
+    clusters_per_jet: float
+    msegs: float
+    llps: int = 0
+
+    # Fraction of the tracks and muon segments that point at a jet.
+    near_jet_fraction: float = 0.4
+
+
+# Rough numbers for the good training jets, primary vertex tracks, clusters and
+# muon segments ServiceX hands back for each type of sample (at pileup 0).
+MULTIPLICITIES: Dict[DataType, Multiplicities] = {
+    DataType.SIGNAL: Multiplicities(
+        jets=2.5, tracks=25, clusters_per_jet=12, msegs=8, llps=2
+    ),
+    DataType.QCD: Multiplicities(jets=3.0, tracks=35, clusters_per_jet=15, msegs=4),
+    DataType.DATA: Multiplicities(jets=3.0, tracks=35, clusters_per_jet=15, msegs=4),
+    DataType.BIB: Multiplicities(
+        jets=1.5, tracks=10, clusters_per_jet=8, msegs=30, near_jet_fraction=0.2
+    ),
+}
+
+# Extra primary vertex tracks per pileup interaction (mis-assigned tracks).
+TRACKS_PER_PILEUP = 0.3
+
+
+def generate_raw_events(
+    n_events: int,
+    datatype: DataType,
+    pileup: float = 60.0,
+    seed: Optional[int] = 0,
+    multiplicities: Optional[Multiplicities] = None,
+) -> ak.Array:
+    """Make raw events with the same branches and types as the ServiceX output of
+    the training query (see `build_training_query`), for testing and benchmarking
+    without ServiceX.
+
+    Per-object floating point branches are `float64` and counts are `int32`, as the
+    query writes them. The kinematics are only roughly realistic: jets pass the
+    good training jet cuts, and a fraction of the tracks and muon segments (and, for
+    signal, the LLPs) point at the jets so that the matching has work to do.
+
+    Args:
+        n_events (int): Number of events to make.
+        datatype (DataType): Which type of sample to imitate.
+        pileup (float): Mean number of interactions per crossing. Adds tracks.
+        seed (Optional[int]): Random seed. The same seed gives the same events.
+        multiplicities (Optional[Multiplicities]): Override the mean object counts
+            for `datatype`.
+
+    Returns:
+        ak.Array: One record per event, with one field per branch.
+    """
+    rng = np.random.default_rng(seed)
+    m = multiplicities if multiplicities is not None else MULTIPLICITIES[datatype]
+
+    data: Dict[str, ak.Array] = {}
+    data["runNumber"] = np.full(n_events, 456714, dtype=np.uint32)
+    data["eventNumber"] = np.arange(n_events, dtype=np.uint64) + 1_000_000
+    if datatype in (DataType.SIGNAL, DataType.QCD):
+        data["mcEventWeight"] = rng.normal(1.0, 0.1, n_events)
+
+    # Jets
+    n_jets = np.maximum(rng.poisson(m.jets, n_events), 1)
+    total_jets = int(n_jets.sum())
+    jet_eta = rng.uniform(-2.5, 2.5, total_jets)
+    jet_phi = rng.uniform(-np.pi, np.pi, total_jets)
+    data["jet_pt"] = ak.unflatten(
+        min_jet_pt + rng.exponential(40.0, total_jets), n_jets
+    )
+    data["jet_eta"] = ak.unflatten(jet_eta, n_jets)
+    data["jet_phi"] = ak.unflatten(jet_phi, n_jets)
+    if datatype == DataType.BIB:
+        data["jet_emf"] = ak.unflatten(rng.uniform(0.0, 1.0, total_jets), n_jets)
+    jet_offsets = np.concatenate([[0], np.cumsum(n_jets)[:-1]])
+
+    def pick_jets(counts: np.ndarray):
+        "The eta and phi of a random jet in the same event, for each object"
+        event = np.repeat(np.arange(n_events), counts)
+        jet = jet_offsets[event] + (rng.random(len(event)) * n_jets[event]).astype(int)
+        return jet_eta[jet], jet_phi[jet]
+
+    def near_jets(counts: np.ndarray, spread: float):
+        "eta and phi for objects, some of them close to a jet"
+        total = int(counts.sum())
+        eta = rng.uniform(-2.5, 2.5, total)
+        phi = rng.uniform(-np.pi, np.pi, total)
+        near = rng.random(total) < m.near_jet_fraction
+        j_eta, j_phi = pick_jets(counts)
+        eta[near] = j_eta[near] + rng.normal(0.0, spread, near.sum())
+        phi[near] = _wrap(j_phi[near] + rng.normal(0.0, spread, near.sum()))
+        return eta, phi
+
+    # Tracks
+    n_tracks = rng.poisson(m.tracks + TRACKS_PER_PILEUP * pileup, n_events)
+    total_tracks = int(n_tracks.sum())
+    track_eta, track_phi = near_jets(n_tracks, 0.1)
+
+    def per_track(values: np.ndarray) -> ak.Array:
+        return ak.unflatten(values, n_tracks)
+
+    def track_counts(mean: float) -> ak.Array:
+        return per_track(rng.poisson(mean, total_tracks).astype(np.int32))
+
+    data["track_pT"] = per_track(0.5 + rng.exponential(2.0, total_tracks))
+    data["track_eta"] = per_track(track_eta)
+    data["track_phi"] = per_track(track_phi)
+    data["track_vertex_nParticles"] = per_track(
+        np.repeat(n_tracks, n_tracks).astype(np.int32)
+    )
+    data["track_d0"] = per_track(rng.normal(0.0, 0.05, total_tracks))
+    data["track_z0"] = per_track(rng.normal(0.0, 0.1, total_tracks))
+    data["track_chiSquared"] = per_track(rng.exponential(10.0, total_tracks))
+    data["track_PixelShared"] = track_counts(0.1)
+    data["track_SCTShared"] = track_counts(0.2)
+    data["track_PixelHoles"] = track_counts(0.05)
+    data["track_SCTHoles"] = track_counts(0.1)
+    data["track_PixelHits"] = track_counts(4.0)
+    data["track_SCTHits"] = track_counts(8.0)
+
+    # Muon segments, in the muon spectrometer, given as position and direction.
+    n_msegs = rng.poisson(m.msegs, n_events)
+    total_msegs = int(n_msegs.sum())
+    mseg_eta, mseg_phi = near_jets(n_msegs, 0.1)
+    r = rng.uniform(5000.0, 10000.0, total_msegs)
+    p = rng.uniform(1.0, 100.0, total_msegs)
+
+    def per_mseg(values: np.ndarray) -> ak.Array:
+        return ak.unflatten(values, n_msegs)
+
+    data["MSeg_x"] = per_mseg(r * np.cos(mseg_phi))
+    data["MSeg_y"] = per_mseg(r * np.sin(mseg_phi))
+    data["MSeg_z"] = per_mseg(r * np.sinh(mseg_eta))
+    data["MSeg_px"] = per_mseg(p * np.cos(mseg_phi))
+    data["MSeg_py"] = per_mseg(p * np.sin(mseg_phi))
+    data["MSeg_pz"] = per_mseg(p * np.sinh(mseg_eta))
+    data["MSeg_t0"] = per_mseg(rng.normal(0.0, 5.0, total_msegs))
+    data["MSeg_chiSquared"] = per_mseg(rng.exponential(5.0, total_msegs))
+
+    # Clusters, a list for each jet.
+    n_clusters = rng.poisson(m.clusters_per_jet, total_jets)
+    total_clusters = int(n_clusters.sum())
+    clus_jet = np.repeat(np.arange(total_jets), n_clusters)
+
+    def per_cluster(values: np.ndarray) -> ak.Array:
+        return ak.unflatten(ak.unflatten(values, n_clusters), n_jets)
+
+    data["clus_eta"] = per_cluster(
+        jet_eta[clus_jet] + rng.normal(0.0, 0.1, total_clusters)
+    )
+    data["clus_phi"] = per_cluster(
+        _wrap(jet_phi[clus_jet] + rng.normal(0.0, 0.1, total_clusters))
+    )
+    data["clus_pt"] = per_cluster(rng.exponential(3.0, total_clusters))
+    # The layer energies are packed, eight numbers per cluster, as the query does.
+    layers = np.stack(
+        [rng.exponential(500.0, total_clusters) for _ in CLUSTER_LAYERS], axis=1
+    )
+    data["clus_layers"] = ak.unflatten(
+        ak.unflatten(layers.ravel(), n_clusters * len(CLUSTER_LAYERS)), n_jets
+    )
+    data["clus_time"] = per_cluster(rng.normal(0.0, 5.0, total_clusters))
+
+    # LLPs, each one pointing at a jet and (mostly) decaying in the calorimeter.
+    if datatype == DataType.SIGNAL:
+        n_llps = np.full(n_events, m.llps)
+        total_llps = int(n_llps.sum())
+        llp_eta, llp_phi = pick_jets(n_llps)
+        llp_eta = llp_eta + rng.normal(0.0, 0.05, total_llps)
+        llp_phi = _wrap(llp_phi + rng.normal(0.0, 0.05, total_llps))
+
+        def per_llp(values: np.ndarray) -> ak.Array:
+            return ak.unflatten(values, n_llps)
+
+        data["LLP_eta"] = per_llp(llp_eta)
+        data["LLP_phi"] = per_llp(llp_phi)
+        data["LLP_pt"] = per_llp(rng.exponential(100.0, total_llps))
+        data["LLP_pdgid"] = per_llp(np.full(total_llps, 35, dtype=np.int32))
+        data["LLP_Lz"] = per_llp(
+            rng.uniform(LLP_Lz_min, LLP_Lz_max, total_llps)
+            * rng.choice([-1.0, 1.0], total_llps)
+        )
+        data["LLP_Lxy"] = per_llp(
+            rng.uniform(0.8 * LLP_Lxy_min, LLP_Lxy_max, total_llps)
+        )
+
+    return ak.zip(data, depth_limit=1)
+
+
+def _wrap(phi: np.ndarray) -> np.ndarray:
+    "Bring angles back into [-pi, pi)"
+    return (phi + np.pi) % (2 * np.pi) - np.pi
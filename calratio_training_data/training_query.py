@@ -1,33 +1,65 @@
+import asyncio
+import hashlib
+import json
 import logging
-from dataclasses import dataclass
-from math import sqrt
-from typing import Any, Dict, Generator, Optional
+import os
+from dataclasses import dataclass, replace
+from functools import partial
+from itertools import chain
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 import awkward as ak
-import uproot
 import numpy as np
-import servicex_local as sx_local
 import vector
 from func_adl import ObjectStream
-from func_adl_servicex_xaodr25 import FADLStream, FuncADLQueryPHYS
-from func_adl_servicex_xaodr25.calosampling import CaloSampling
-from func_adl_servicex_xaodr25.xaod import xAOD
-from func_adl_servicex_xaodr25.xAOD.calocluster_v1 import CaloCluster_v1
-from func_adl_servicex_xaodr25.xAOD.eventinfo_v1 import EventInfo_v1
-from func_adl_servicex_xaodr25.xAOD.jet_v1 import Jet_v1
-from func_adl_servicex_xaodr25.xAOD.muonsegment_v1 import MuonSegment_v1
-from func_adl_servicex_xaodr25.xAOD.trackparticle_v1 import TrackParticle_v1
-from func_adl_servicex_xaodr25.xAOD.truthparticle_v1 import TruthParticle_v1
-from func_adl_servicex_xaodr25.xAOD.vertex_v1 import Vertex_v1
-from func_adl_servicex_xaodr25.xAOD.vxtype import VxType
-from func_adl_servicex_xaodr25 import cpp_float
-from servicex import deliver
 
+from calratio_training_data.association import delta_phi_matches, delta_r_matches
+from calratio_training_data.async_utils import (
+    as_completed_indexed,
+    iterate_async,
+)
+from calratio_training_data.manifest import (
+    ConversionManifest,
+    ShardRecord,
+    load_manifest,
+    manifest_path,
+    save_manifest,
+    source_file_name,
+)
+from calratio_training_data.metrics import (
+    FileMetrics,
+    StageClock,
+    file_metrics,
+    recording,
+    report_file,
+    run_metrics,
+    stage,
+    start_memory_tracing,
+    timed_items,
+)
+from calratio_training_data.parallel_utils import process_map
+from calratio_training_data.parquet_utils import write_training_files
 from calratio_training_data.processing import do_rotations
-from calratio_training_data.triggers import trigger_bib_filter
+from calratio_training_data.production import ProductionEntry
+from calratio_training_data.read_utils import (
+    cache_raw_chunks,
+    iterate_file,
+    read_ahead,
+)
 
 
 from calratio_training_data.constants import (
+    CLUSTER_LAYERS,
     JET_MSEG_DELTA_PHI,
     JET_TRACK_DELTA_R,
     LLP_JET_DELTA_R,
@@ -36,17 +68,10 @@ from calratio_training_data.constants import (
     LLP_Lxy_min,
     LLP_Lz_max,
     LLP_Lz_min,
+    Engine,
     EventLabels,
 )
 
-from .cpp_xaod_utils import (
-    add_jet_selection_tool,
-    cvt_to_raw_calocluster,
-    jet_clean_llp,
-    track_summary_value,
-    particle_radiates,
-)
-
 from calratio_training_data.fetch import DataType
 from calratio_training_data.label_utils import extract_param_block
 
@@ -65,292 +90,206 @@ class RunConfig:
     n_files: Optional[int] = None
     datatype: DataType = DataType.SIGNAL
     desc_label: str = ""
+    read_ahead: int = 2
+    workers: int = 1
+    ordered: bool = True
+    chunk_events: Optional[int] = None
+    max_file_size_gb: float = 2.0
+    resume: bool = True
+    raw_cache_dir: Optional[str] = None
+    metrics_out: Optional[str] = None
+    profile_memory: bool = False
+    engine: Engine = Engine.AWKWARD
+    compact_schema: bool = False
+    skim_to_jets: bool = False
+    llp_jets_only: bool = False
+    compact_transfer: bool = False
+
+
+# Written in a raw cache directory to record where its files came from.
+RAW_CACHE_INFO = "raw_cache.json"
+
+
+# The raw branches `convert_to_training_data` reads, shared by all data types.
+_TRAINING_BRANCHES = [
+    "runNumber",
+    "eventNumber",
+    "jet_pt",
+    "jet_eta",
+    "jet_phi",
+    "track_pT",
+    "track_eta",
+    "track_phi",
+    "track_vertex_nParticles",
+    "track_d0",
+    "track_z0",
+    "track_chiSquared",
+    "track_PixelShared",
+    "track_SCTShared",
+    "track_PixelHoles",
+    "track_SCTHoles",
+    "track_PixelHits",
+    "track_SCTHits",
+    "MSeg_x",
+    "MSeg_y",
+    "MSeg_z",
+    "MSeg_px",
+    "MSeg_py",
+    "MSeg_pz",
+    "MSeg_t0",
+    "MSeg_chiSquared",
+    "clus_eta",
+    "clus_phi",
+    "clus_pt",
+    "clus_layers",
+    "clus_time",
+]
+
+# Raw files fetched before the query packed the cluster layer energies into
+# `clus_layers` have a branch for each layer instead. Whichever a file has is read.
+_UNPACKED_CLUSTER_BRANCHES = [f"clus_{layer}" for layer in CLUSTER_LAYERS]
+
+# Raw files fetched with `compact_transfer` have the number of primary vertex tracks
+# once per event, rather than in `track_vertex_nParticles` for each track.
+_COMPACT_TRANSFER_BRANCHES = ["n_pv_tracks"]
+
+# The types of the track counts with `compact_schema` (they are float32 like the other
+# track variables otherwise). Whole numbers this small are exact in float32, so
+# nothing changes but the size.
+_COMPACT_TRACK_TYPES = {
+    "vertex_nParticles": np.int16,
+    "PixelShared": np.uint8,
+    "SCTShared": np.uint8,
+    "PixelHoles": np.uint8,
+    "SCTHoles": np.uint8,
+    "PixelHits": np.uint8,
+    "SCTHits": np.uint8,
+}
+
+# Extra raw branches `convert_to_training_data` reads for each data type.
+_TRAINING_BRANCHES_BY_TYPE = {
+    DataType.SIGNAL: [
+        "mcEventWeight",
+        "LLP_eta",
+        "LLP_phi",
+        "LLP_pt",
+        "LLP_Lz",
+        "LLP_Lxy",
+    ],
+    DataType.QCD: ["mcEventWeight"],
+    DataType.DATA: [],
+    DataType.BIB: ["jet_emf"],
+}
+
+
+def training_branches(data_type: DataType) -> List[str]:
+    """The raw branches that `convert_to_training_data` uses for this data type. Only
+    these need to be read from the ServiceX output files.
 
+    Args:
+        data_type (DataType): The type of data being converted.
+
+    Returns:
+        List[str]: The branch names.
+    """
+    return (
+        _TRAINING_BRANCHES
+        + _UNPACKED_CLUSTER_BRANCHES
+        + _COMPACT_TRANSFER_BRANCHES
+        + _TRAINING_BRANCHES_BY_TYPE[data_type]
+    )
 
-@dataclass
-class TopLevelEvent:
-    """Make it easy to type-safe carry everything around.
 
-    Note: SX will only evaluate the terms that are actually asked for in the final query!
+def fetch_raw_training_data(
+    ds_name: str, config: RunConfig = RunConfig(ignore_cache=False, run_locally=False)
+):
     """
+    Fetch the specified dataset.
 
-    event_info: EventInfo_v1
-    vertices: FADLStream[Vertex_v1]
-    pv_tracks: FADLStream[TrackParticle_v1]
-    muon_segments: FADLStream[MuonSegment_v1]
-    jets: FADLStream[Jet_v1]
-    jet_clusters: FADLStream[FADLStream[CaloCluster_v1]]
-    topo_clusters: FADLStream[CaloCluster_v1]
+    Args:
+        ds_name (str): The dataset identifier.
+        config (RunConfig): Run configuration options.
+    """
+    return run_query(
+        ds_name,
+        training_query(config.datatype, config),
+        config,
+        branches=training_branches(config.datatype),
+    )
 
-    # All tracks with no selection at all. From Inner Detector container
-    all_tracks: FADLStream[TrackParticle_v1]
 
-    # Truth particles
-    bsm_particles: FADLStream[TruthParticle_v1]
+def fetch_raw_training_files(
+    ds_name: str, config: RunConfig = RunConfig(ignore_cache=False, run_locally=False)
+) -> List[str]:
+    """
+    Run the query for the specified dataset and return the ServiceX output files
+    without reading them.
 
+    Args:
+        ds_name (str): The dataset identifier.
+        config (RunConfig): Run configuration options.
 
-def good_training_jet(jet: Jet_v1) -> bool:
-    """Check that the jet is suitable for training"""
-    return (
-        (jet.pt() / 1000.0 > 40 and jet.pt() / 1000.0 < 500)
-        and abs(jet.eta()) < 2.5
-        and jet_clean_llp(jet)
-    )
+    Returns:
+        List[str]: Paths to the ServiceX output files.
+    """
+    return deliver_query(ds_name, training_query(config.datatype, config), config)
 
 
-def build_preselection(data_type: DataType):
-    # Start the query
-    query_base = add_jet_selection_tool(
-        FuncADLQueryPHYS(), "m_jetCleaning_llp", "LooseBadLLP"
-    )
+def training_query(datatype: DataType, config: RunConfig) -> ObjectStream:
+    """
+    The ServiceX query for a data type, with the query options in `config`.
 
-    # Apply any top level trigger/event selection.
-    if data_type == DataType.BIB:
-        query_base = trigger_bib_filter(query_base)
+    Args:
+        datatype (DataType): The type of data to fetch.
+        config (RunConfig): Run configuration options.
 
-    # Do top level object filtering
-    query_base_objects = query_base.Select(
-        lambda e: TopLevelEvent(
-            event_info=e.EventInfo("EventInfo"),
-            vertices=e.Vertices("PrimaryVertices").Where(
-                lambda v: v.vertexType() == VxType.VertexType.PriVtx
-            ),
-            pv_tracks=(
-                e.Vertices("PrimaryVertices")
-                .Where(lambda v: v.vertexType() == VxType.VertexType.PriVtx)
-                .First()
-                .trackParticleLinks()
-                .Where(lambda t: t.isValid())  # type: ignore
-            ),
-            muon_segments=e.MuonSegments("MuonSegments"),
-            jets=[
-                j
-                for j in e.Jets(collection="AntiKt4EMTopoJets", calibrate=False)
-                if good_training_jet(j)
-            ],  # type: ignore
-            jet_clusters=[
-                [
-                    cvt_to_raw_calocluster(cl)
-                    for cl in j.constituentLinks()
-                    if cl.isValid()
-                ]
-                for j in e.Jets(collection="AntiKt4EMTopoJets", calibrate=False)
-                if good_training_jet(j)
-            ],  # type: ignore
-            all_tracks=e.TrackParticles("InDetTrackParticles"),
-            topo_clusters=e.CaloClusters("CaloCalTopoClusters"),
-            bsm_particles=e.TruthParticles("TruthBSMWithDecayParticles")
-            .Where(lambda truth_p: truth_p.absPdgId() == 35 or truth_p.absPdgId() == 51)
-            .Where(lambda p: not particle_radiates(p)),
-        )
-    )
+    Returns:
+        ObjectStream: The query.
+    """
+    from .query import build_training_query
 
-    # Preselection
-    query_preselection = query_base_objects.Where(
-        lambda e: len(e.vertices) > 0  # type: ignore
-        and e.vertices.First().nTrackParticles() > 0
-        and len(e.jets) > 0  # type: ignore
+    return build_training_query(
+        datatype,
+        skim_to_jets=config.skim_to_jets,
+        llp_jets_only=config.llp_jets_only,
+        compact_transfer=config.compact_transfer,
     )
 
-    return query_preselection
-
 
-def fetch_raw_training_data(
-    ds_name: str, config: RunConfig = RunConfig(ignore_cache=False, run_locally=False)
-):
+def _layer_energies(data: ak.Array) -> Dict[str, ak.Array]:
     """
-    Fetch the specified dataset.
+    The energy of each cluster in each of the `CLUSTER_LAYERS`. The query packs
+    them into `clus_layers`, eight numbers per cluster; older raw files have a
+    `clus_<layer>` branch for each.
 
     Args:
-        ds_name (str): The dataset identifier.
-        config (RunConfig): Run configuration options.
+        data (ak.Array): The raw data.
+
+    Returns:
+        Dict[str, ak.Array]: The energies (event, jet, cluster) for each layer, in
+            `CLUSTER_LAYERS` order.
     """
-    # Get the base query
-    query_preselection = build_preselection(config.datatype)
-
-    # Dictionary requires a constant test
-    is_signal = config.datatype == DataType.SIGNAL
-    is_bib = config.datatype == DataType.BIB
-
-    # Query the run number, etc.
-    query = query_preselection.Select(
-        lambda e: {
-            "runNumber": e.event_info.runNumber(),
-            "eventNumber": e.event_info.eventNumber(),
-            "mcEventWeight": e.event_info.mcEventWeight(0),
-            #
-            # Track Info
-            #
-            "track_pT": [t.pt() / 1000.0 for t in e.pv_tracks],
-            "track_eta": [t.eta() for t in e.pv_tracks],
-            "track_phi": [t.phi() for t in e.pv_tracks],
-            "track_vertex_nParticles": [len(e.pv_tracks) for t in e.pv_tracks],  # type: ignore
-            "track_d0": [t.d0() for t in e.pv_tracks],
-            "track_z0": [t.z0() for t in e.pv_tracks],
-            "track_chiSquared": [t.chiSquared() for t in e.pv_tracks],
-            "track_PixelShared": [
-                track_summary_value(t, xAOD.SummaryType.numberOfPixelSharedHits)
-                for t in e.pv_tracks
-            ],
-            "track_SCTShared": [
-                track_summary_value(t, xAOD.SummaryType.numberOfSCTSharedHits)
-                for t in e.pv_tracks
-            ],
-            "track_PixelHoles": [
-                track_summary_value(t, xAOD.SummaryType.numberOfPixelHoles)
-                for t in e.pv_tracks
-            ],
-            "track_SCTHoles": [
-                track_summary_value(t, xAOD.SummaryType.numberOfSCTHoles)
-                for t in e.pv_tracks
-            ],
-            "track_PixelHits": [
-                track_summary_value(t, xAOD.SummaryType.numberOfPixelHits)
-                for t in e.pv_tracks
-            ],
-            "track_SCTHits": [
-                track_summary_value(t, xAOD.SummaryType.numberOfSCTHits)
-                for t in e.pv_tracks
-            ],
-            #
-            # Muon Segments. We will convert to eta and phi after we load these guys.
-            #
-            "MSeg_x": [s.x() for s in e.muon_segments],
-            "MSeg_y": [s.y() for s in e.muon_segments],
-            "MSeg_z": [s.z() for s in e.muon_segments],
-            "MSeg_px": [s.px() for s in e.muon_segments],
-            "MSeg_py": [s.py() for s in e.muon_segments],
-            "MSeg_pz": [s.pz() for s in e.muon_segments],
-            "MSeg_t0": [s.t0() for s in e.muon_segments],
-            "MSeg_chiSquared": [s.chiSquared() for s in e.muon_segments],
-            #
-            # Jets
-            #
-            "jet_pt": [j.pt() / 1000.0 for j in e.jets],
-            "jet_eta": [j.eta() for j in e.jets],
-            "jet_phi": [j.phi() for j in e.jets],
-            #
-            # Clusters
-            #   Write out all clusters
-            #   Layer definitions come from https://gitlab.cern.ch/atlas-phys-exotics-llp-mscrid
-            #       /fullrun2analysis/DiVertAnalysisR21/-/blob/master/DiVertAnalysis/Root
-            #       /RegionVarCalculator_calRatio.cxx?ref_type=heads#L381
-            # These are a double-nested list since the jet association is implicit in the xAOD.
-            "clus_eta": [
-                [c.eta() for c in jet_clusters] for jet_clusters in e.jet_clusters
-            ],
-            "clus_phi": [
-                [c.phi() for c in jet_clusters] for jet_clusters in e.jet_clusters
-            ],
-            "clus_pt": [
-                [c.pt() / 1000.0 for c in jet_clusters]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l1hcal": [
-                [c.eSample(CaloSampling.CaloSample.HEC0) for c in jet_clusters]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l2hcal": [
-                [
-                    c.eSample(CaloSampling.CaloSample.HEC1)
-                    + c.eSample(CaloSampling.CaloSample.TileBar0)
-                    + c.eSample(CaloSampling.CaloSample.TileGap1)
-                    + c.eSample(CaloSampling.CaloSample.TileExt0)
-                    for c in jet_clusters
-                ]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l3hcal": [
-                [
-                    c.eSample(CaloSampling.CaloSample.HEC2)
-                    + c.eSample(CaloSampling.CaloSample.TileBar1)
-                    + c.eSample(CaloSampling.CaloSample.TileGap2)
-                    + c.eSample(CaloSampling.CaloSample.TileExt1)
-                    for c in jet_clusters
-                ]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l4hcal": [
-                [
-                    c.eSample(CaloSampling.CaloSample.HEC3)
-                    + c.eSample(CaloSampling.CaloSample.TileBar2)
-                    + c.eSample(CaloSampling.CaloSample.TileGap3)
-                    + c.eSample(CaloSampling.CaloSample.TileExt2)
-                    for c in jet_clusters
-                ]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l1ecal": [
-                [
-                    c.eSample(CaloSampling.CaloSample.PreSamplerB)
-                    + c.eSample(CaloSampling.CaloSample.PreSamplerE)
-                    for c in jet_clusters
-                ]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l2ecal": [
-                [
-                    c.eSample(CaloSampling.CaloSample.EMB1)
-                    + c.eSample(CaloSampling.CaloSample.EME1)
-                    + c.eSample(CaloSampling.CaloSample.FCAL0)
-                    for c in jet_clusters
-                ]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l3ecal": [
-                [
-                    c.eSample(CaloSampling.CaloSample.EMB2)
-                    + c.eSample(CaloSampling.CaloSample.EME2)
-                    + c.eSample(CaloSampling.CaloSample.FCAL1)
-                    for c in jet_clusters
-                ]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_l4ecal": [
-                [
-                    c.eSample(CaloSampling.CaloSample.EMB3)
-                    + c.eSample(CaloSampling.CaloSample.EME3)
-                    + c.eSample(CaloSampling.CaloSample.FCAL2)
-                    for c in jet_clusters
-                ]
-                for jet_clusters in e.jet_clusters
-            ],
-            "clus_time": [
-                [c.time() for c in jet_clusters] for jet_clusters in e.jet_clusters
-            ],
-            **(
-                {
-                    "LLP_eta": [p.eta() for p in e.bsm_particles],
-                    "LLP_phi": [p.phi() for p in e.bsm_particles],
-                    "LLP_pt": [p.pt() / 1000.0 for p in e.bsm_particles],
-                    "LLP_pdgid": [p.absPdgId() for p in e.bsm_particles],
-                    "LLP_Lz": [
-                        p.decayVtx().z() if p.hasDecayVtx() else 0.0
-                        for p in e.bsm_particles
-                    ],
-                    "LLP_Lxy": [
-                        (
-                            sqrt(p.decayVtx().x() ** 2 + p.decayVtx().y() ** 2)
-                            if p.hasDecayVtx()
-                            else 0.0
-                        )
-                        for p in e.bsm_particles
-                    ],
-                }
-                if is_signal
-                else {}
-            ),
-            **(
-                {
-                    "jet_emf": [j.getAttribute[cpp_float]("EMFrac") for j in e.jets],
-                }
-                if is_bib
-                else {}
-            ),
-        }
-    )
+    if "clus_layers" not in ak.fields(data):
+        return {layer: data[f"clus_{layer}"] for layer in CLUSTER_LAYERS}
+
+    energies = ak.unflatten(data["clus_layers"], len(CLUSTER_LAYERS), axis=2)
+    return {layer: energies[:, :, :, i] for i, layer in enumerate(CLUSTER_LAYERS)}
 
-    return run_query(ds_name, query, config)
+
+def _vertex_n_particles(data: ak.Array) -> ak.Array:
+    """
+    The number of tracks on the primary vertex, for each track. Raw files fetched
+    with `compact_transfer` have it once per event, in `n_pv_tracks`.
+
+    Args:
+        data (ak.Array): The raw data.
+
+    Returns:
+        ak.Array: The count (event, track).
+    """
+    if "track_vertex_nParticles" in ak.fields(data):
+        return data["track_vertex_nParticles"]
+    return ak.broadcast_arrays(data["n_pv_tracks"], data["track_pT"])[0]
 
 
 def convert_to_training_data(
@@ -359,6 +298,8 @@ def convert_to_training_data(
     ds_name: str,
     rotation: bool = True,
     desc_label="",
+    engine: Engine = Engine.AWKWARD,
+    compact: bool = False,
 ) -> ak.Array:
     """
     Convert raw data dictionary to training data format.
@@ -367,10 +308,16 @@ def convert_to_training_data(
         raw_data (Dict[str, ak.Array]): The raw data as returned by run_query.
         datatype (DataType): Type of data we are using, given by required command
                         line input.
+        engine (Engine): How to do the matching and rotations (same output either
+                        way).
+        compact (bool): Write the counts and labels with narrow types (see
+                        `compact_schema`).
 
     Returns:
         ak.Record: The processed training data, suitable for writing to parquet.
     """
+    clock = StageClock("convert")
+
     # Build the constructs we can use to do matching (associated them with 3D vectors!).
     jets = ak.values_astype(
         ak.zip(
@@ -390,7 +337,7 @@ def convert_to_training_data(
                 "eta": data.track_eta,  # type: ignore
                 "phi": data.track_phi,  # type: ignore
                 "pt": data.track_pT,  # type: ignore
-                "vertex_nParticles": data.track_vertex_nParticles,  # type: ignore
+                "vertex_nParticles": _vertex_n_particles(data),  # type: ignore
                 "d0": data.track_d0,  # type: ignore
                 "z0": data.track_z0,  # type: ignore
                 "chiSquared": data.track_chiSquared,  # type: ignore
@@ -438,14 +385,7 @@ def convert_to_training_data(
                 "eta": data.clus_eta,  # type: ignore
                 "phi": data.clus_phi,  # type: ignore
                 "pt": data.clus_pt,  # type: ignore
-                "l1hcal": data.clus_l1hcal,  # type: ignore
-                "l2hcal": data.clus_l2hcal,  # type: ignore
-                "l3hcal": data.clus_l3hcal,  # type: ignore
-                "l4hcal": data.clus_l4hcal,  # type: ignore
-                "l1ecal": data.clus_l1ecal,  # type: ignore
-                "l2ecal": data.clus_l2ecal,  # type: ignore
-                "l3ecal": data.clus_l3ecal,  # type: ignore
-                "l4ecal": data.clus_l4ecal,  # type: ignore
+                **_layer_energies(data),
                 "time": data.clus_time,  # type: ignore
             },
             with_name="Momentum3D",
@@ -456,6 +396,8 @@ def convert_to_training_data(
     # Check to see if we have any jets that are missing clusters:
     # no_cluster_mask = len(clusters.pt) == 0
 
+    clock.lap("prepare")
+
     # If we are doing BIB, select only the jet with minimum EMF per event.
     if datatype == DataType.BIB:
         jet_emf = ak.values_astype(data["jet_emf"], np.float32)
@@ -508,17 +450,10 @@ def convert_to_training_data(
             )
             return ak.Array([])
 
-        llp_jet_pairs = ak.cartesian(
-            {
-                "jet": jets,
-                "llp": llps,
-            },
-            axis=1,
-            nested=True,
-        )
-
-        delta_r_jet_llp = llp_jet_pairs.jet.deltaR(llp_jet_pairs.llp)
-        jets_near_llps_mask = ak.any(delta_r_jet_llp < LLP_JET_DELTA_R, axis=-1)
+        # Each jet's LLPs within DeltaR, found once and used both to pick the jets
+        # and to find each jet's closest LLP.
+        jet_llps = delta_r_matches(jets, llps, LLP_JET_DELTA_R, engine)
+        jets_near_llps_mask = jet_llps.matched()
 
         # Window the jets (and clusters, which come pre-associated with the jets) to
         # only those near LLPs.
@@ -531,41 +466,29 @@ def convert_to_training_data(
         jets = jets[jets_near_llps_mask]
         clusters = clusters[jets_near_llps_mask]
 
-        # And for those jets, get a match LLP. Easiest is to re-run the matching.
-        llp_jet_pairs = ak.cartesian(
-            {
-                "jet": jets,
-                "llp": llps,
-            },
-            axis=1,
-            nested=True,
-        )
-        llp_match_jet_index = ak.argmin(
-            llp_jet_pairs.jet.deltaR(llp_jet_pairs.llp), axis=-1
-        )
+        # And for those jets, the matched LLP is the closest one.
+        llp_match_jet_index = jet_llps.select(jets_near_llps_mask).nearest()
         llp_match_jet = llps[llp_match_jet_index]
 
     # If there are no jets, then we don't need to do any of this.
     if len(jets) == 0:
         return ak.Array([])  # type: ignore
 
-    # Compute DeltaR between each jet and all tracks in the same event
-    jet_track_pairs = ak.cartesian({"jet": jets, "track": tracks}, axis=1, nested=True)
-    delta_r = jet_track_pairs.jet.deltaR(jet_track_pairs.track)
-    nearby_tracks = jet_track_pairs.track[delta_r < JET_TRACK_DELTA_R]
-
-    # delta-phi matching for muon segments.
-    jet_mseg_pairs = ak.cartesian(
-        {
-            "jet": jets,
-            "mseg": ak.zip({"x": msegs, "p": msegs_p}),
-        },
-        axis=1,
-        nested=True,
+    clock.lap("select")
+
+    # Tracks within DeltaR of each jet. Only tracks in nearby (eta, phi) cells are
+    # checked, rather than every jet-track pair.
+    nearby_tracks = delta_r_matches(jets, tracks, JET_TRACK_DELTA_R, engine).take(
+        tracks
     )
-    delta_phi = jet_mseg_pairs.jet.deltaphi(jet_mseg_pairs.mseg.x)
-    mseg_mask = delta_phi < JET_MSEG_DELTA_PHI
-    nearby_msegs = jet_mseg_pairs.mseg[mseg_mask]
+
+    # Muon segments within delta-phi of each jet, on either side. Segments are sorted
+    # by phi in each event and each jet's window found by binary search.
+    nearby_msegs = delta_phi_matches(jets, msegs, JET_MSEG_DELTA_PHI, engine).take(
+        ak.zip({"x": msegs, "p": msegs_p})
+    )
+
+    clock.lap("match")
 
     # Fill this dict with the leaves we want in the training data.
     per_jet_training_data_dict = {}
@@ -586,7 +509,7 @@ def convert_to_training_data(
         # Giving BIB data mcEventWeight of 1
         # Follows convention from CalRatioTrainer
         per_jet_training_data_dict["mcEventWeight"] = ak.Array(
-            [1.0] * len(per_jet_training_data_dict["runNumber"])
+            np.ones(len(per_jet_training_data_dict["runNumber"]))
         )
 
     # # The top level jet information.
@@ -620,7 +543,7 @@ def convert_to_training_data(
     empty_mask = counts > 0
 
     # Warning for empty jets
-    if len(empty_mask) - sum(empty_mask) > 0:
+    if not ak.all(empty_mask):
         logging.warning(
             "Found jets with no clusters! Those jets have been filtered out."
         )
@@ -630,45 +553,35 @@ def convert_to_training_data(
         key: arr[empty_mask] for key, arr in per_jet_training_data_dict.items()
     }
 
+    clock.lap("flatten")
+
     # Doing rotations on tracks, clusters, msegs
     if rotation:
         # Needed for rotations
         flat_filtered_jets = ak.flatten(jets, axis=1)[empty_mask]
 
         per_jet_training_data_dict["tracks"] = do_rotations(
-            per_jet_training_data_dict["tracks"], "track", flat_filtered_jets
+            per_jet_training_data_dict["tracks"], "track", flat_filtered_jets, engine
         )
         per_jet_training_data_dict["clusters"] = do_rotations(
-            per_jet_training_data_dict["clusters"], "cluster"
+            per_jet_training_data_dict["clusters"], "cluster", engine=engine
         )
         per_jet_training_data_dict["msegs"] = do_rotations(
-            per_jet_training_data_dict["msegs"], "mseg", flat_filtered_jets
+            per_jet_training_data_dict["msegs"], "mseg", flat_filtered_jets, engine
         )
 
-    if datatype in (DataType.BIB, DataType.QCD):
-        n = len(per_jet_training_data_dict["pt"])
+    clock.lap("rotate")
 
-        # Define a single dummy record
-        dummy_llp = ak.zip(
-            {
-                "eta": np.float32(0.0),
-                "phi": np.float32(0.0),
-                "pt": np.float32(0.0),
-                "Lz": np.float32(0.0),
-                "Lxy": np.float32(0.0),
-            },
+    n_jets = len(per_jet_training_data_dict["pt"])
+
+    if datatype in (DataType.BIB, DataType.QCD):
+        # No LLPs: a placeholder with the LLP fields, masked out for every jet.
+        zeros = np.zeros(n_jets)
+        llp = ak.zip(
+            {field: zeros for field in ["eta", "phi", "pt", "Lz", "Lxy"]},
             with_name="Momentum3D",
         )
-
-        # Repeat it n times using ak.Array + ak.broadcast_arrays
-        llp = ak.Array([dummy_llp] * n)
-        llp = ak.with_name(llp, "Momentum3D")  # ensure record name is preserved
-
-        # Mask everything if you want a nullable array
-        mask = ak.Array([False] * n)
-        llp = ak.mask(llp, mask)
-
-        per_jet_training_data_dict["llp"] = llp
+        per_jet_training_data_dict["llp"] = ak.mask(llp, np.zeros(n_jets, dtype=bool))
 
     # Adding labels
     label_map = {
@@ -679,93 +592,497 @@ def convert_to_training_data(
     label_value = label_map[datatype]
 
     per_jet_training_data_dict["label"] = ak.Array(
-        [label_value] * len(per_jet_training_data_dict["pt"])
+        np.full(n_jets, label_value, dtype=np.int64)
     )
 
-    # Adding descriptive label
+    # Adding descriptive label. The one string is shared by every jet.
     if datatype == DataType.SIGNAL:
         full_label = desc_label + "_" + extract_param_block(ds_name)
-        per_jet_training_data_dict["desc_label"] = ak.Array(
-            [full_label] * len(per_jet_training_data_dict["pt"])
-        )
     else:
-        per_jet_training_data_dict["desc_label"] = ak.Array(
-            [desc_label] * len(per_jet_training_data_dict["pt"])
-        )
+        full_label = desc_label
+    per_jet_training_data_dict["desc_label"] = ak.Array([full_label])[
+        np.zeros(n_jets, dtype=np.int64)
+    ]
 
     # Finally, build the data we will write out!
     training_data = ak.zip(
         per_jet_training_data_dict, with_name="Momentum3D", depth_limit=1
     )
+    if compact:
+        training_data = compact_schema(training_data)
+    clock.lap("label")
 
     return training_data  # type: ignore
 
 
-def fetch_training_data_to_file(ds_name: str, config: RunConfig):
-    result_list = fetch_training_data(ds_name, config)
-
-    # Finally, write it out into a training file.
-    # Accumulate the file data into a single file by concatenation.
-    data_queue = []
-    file_index = 0
-    event_size = 0
-    event_count = 0
-    for r in result_list:
-        if len(r) == 0:
-            continue
-        data_queue.append(r)
-        event_size += r.nbytes
-        event_count += len(r)
-        if (event_size / 1_073_741_824) >= 4:  # 4 GB in-memory
-            ak.to_parquet(
-                ak.concatenate(data_queue, axis=0),
-                config.output_path.replace(".parquet", f"_{file_index:03d}.parquet"),
-                compression="ZSTD",
-                compression_level=-7,
+def compact_schema(training_data: ak.Array) -> ak.Array:
+    """
+    Narrow the types of the training data to shrink the files and the memory needed
+    to load them: the track hit counts become small integers, the label `int8` and
+    the descriptive label a dictionary (categorical) of the distinct strings. The
+    values do not change. `runNumber` and `eventNumber` are always written with the
+    types they have in the raw data.
+
+    Args:
+        training_data (ak.Array): Per-jet training data from `convert_to_training_data`.
+
+    Returns:
+        ak.Array: The same data with the compact types.
+
+    Raises:
+        ValueError: If a track count does not fit in its compact type.
+    """
+    compact = ak.Array(training_data)
+    for field, dtype in _COMPACT_TRACK_TYPES.items():
+        values = training_data.tracks[field]
+        limits = np.iinfo(dtype)
+        if ak.any(values < limits.min) or ak.any(values > limits.max):
+            raise ValueError(
+                f"Track {field} values do not fit in {np.dtype(dtype).name} "
+                f"(range {ak.min(values)} to {ak.max(values)})."
             )
-            logging.info(
-                f"Writing file {file_index:03d} with in-memory size "
-                f"{event_size/1_073_741_824:0.2f} GB and "
-                f"{sum(len(e) for e in data_queue):,} jets."
+        compact["tracks", field] = ak.values_astype(values, dtype)
+    compact["label"] = ak.values_astype(training_data.label, np.int8)
+    compact["desc_label"] = ak.str.to_categorical(training_data.desc_label)
+    return compact
+
+
+def conversion_fingerprint(
+    ds_name: str, query: ObjectStream, config: RunConfig
+) -> Dict[str, Any]:
+    """
+    Everything that determines the training data we write for a dataset. If any of
+    these change, previously written training files can't be reused.
+
+    Args:
+        ds_name (str): The dataset identifier.
+        query (ObjectStream): The query sent to ServiceX.
+        config (RunConfig): Run configuration options.
+
+    Returns:
+        Dict[str, Any]: The fingerprint, suitable for writing as json.
+    """
+    return {
+        "dataset": ds_name,
+        "datatype": config.datatype.value,
+        "rotation": config.rotation,
+        "compact_schema": config.compact_schema,
+        "desc_label": config.desc_label,
+        "query_hash": hashlib.sha256(
+            query.generate_selection_string().encode()  # type: ignore
+        ).hexdigest(),
+    }
+
+
+def fetch_training_data_to_file(ds_name: str, config: RunConfig):
+    """
+    Fetch a dataset with ServiceX and convert it to training files.
+
+    ServiceX only hands back a dataset's files once its whole transform is done (it
+    has no public interface for getting them one at a time), so the conversion starts
+    after the transform finishes. `fetch_many_training_data_to_files` overlaps the
+    conversion of one dataset with the transforms of the others.
+
+    Args:
+        ds_name (str): The dataset identifier.
+        config (RunConfig): Run configuration options.
+    """
+    with run_metrics(config.metrics_out, config.profile_memory):
+        with stage("query"):
+            query = training_query(config.datatype, config)
+        with stage("servicex"):
+            files = deliver_query(ds_name, query, config)
+        write_fetched_training_data(files, ds_name, query, config)
+
+
+def fetch_many_training_data_to_files(
+    entries: List[ProductionEntry], config: RunConfig
+) -> List[str]:
+    """
+    Fetch several datasets at once, so all their transforms run at the same time,
+    and convert each one to its own training files as soon as it is delivered.
+
+    Each dataset is sent to ServiceX as its own request. A single spec with a Sample
+    for each would only return once the last transform is finished.
+
+    One dataset is converted at a time (its files spread over `config.workers`), so
+    at most one conversion is in flight. Datasets delivered in the meantime wait
+    their turn, while the transforms still running carry on. Within a dataset the
+    conversion only starts once its whole transform is done (see
+    `fetch_training_data_to_file`).
+
+    Args:
+        entries (List[ProductionEntry]): The datasets to fetch.
+        config (RunConfig): Run configuration options shared by all datasets. The
+            data type, label, number of files and output come from each entry.
+
+    Returns:
+        List[str]: The datasets that ServiceX failed to deliver. The others are
+            still converted.
+    """
+    with run_metrics(config.metrics_out, config.profile_memory):
+        return _fetch_many(entries, config)
+
+
+def _fetch_many(entries: List[ProductionEntry], config: RunConfig) -> List[str]:
+    with stage("query"):
+        queries = {
+            dt: training_query(dt, config) for dt in {e.datatype for e in entries}
+        }
+    configs = [
+        replace(
+            config,
+            datatype=entry.datatype,
+            desc_label=entry.desc_label,
+            n_files=entry.n_files,
+            output_path=entry.output,
+            raw_cache_dir=(
+                None
+                if config.raw_cache_dir is None
+                else os.path.join(config.raw_cache_dir, Path(entry.output).stem)
+            ),
+        )
+        for entry in entries
+    ]
+
+    async def deliver_entry(index: int) -> Optional[List[str]]:
+        entry = entries[index]
+        try:
+            return await deliver_query_async(
+                entry.dataset, queries[entry.datatype], configs[index]
             )
-            data_queue = []
-            file_index += 1
-            event_size = 0
-
-    if len(data_queue) > 0:
-        full_file_data = ak.concatenate(data_queue, axis=0)
-        if ak.count(full_file_data) > 0:
-            ak.to_parquet(
-                full_file_data,
-                config.output_path.replace(".parquet", f"_{file_index:03d}.parquet"),
-                compression="ZSTD",
-                compression_level=-7,
+        except Exception as e:
+            logging.error(f"ServiceX failed to deliver {entry.dataset}: {e}")
+            return None
+
+    def delivered() -> AsyncIterator[Tuple[int, Optional[List[str]]]]:
+        return as_completed_indexed([deliver_entry(i) for i in range(len(entries))])
+
+    # The event loop keeps the other transforms going while we convert.
+    failed = []
+    deliveries = iterate_async(delivered, depth=len(entries))
+    while True:
+        with stage("servicex"):
+            next_delivery = next(deliveries, None)
+        if next_delivery is None:
+            break
+        index, files = next_delivery
+        entry = entries[index]
+        if files is None:
+            failed.append(index)
+            continue
+        logging.info(f"Converting {len(files)} files from {entry.dataset}.")
+        write_fetched_training_data(
+            files, entry.dataset, queries[entry.datatype], configs[index]
+        )
+
+    return [entries[i].dataset for i in sorted(failed)]
+
+
+def write_fetched_training_data(
+    files: List[str], ds_name: str, query: ObjectStream, config: RunConfig
+):
+    """
+    Convert the ServiceX output files for a query and write out the training data.
+
+    Args:
+        files (List[str]): Paths to the ServiceX output files.
+        ds_name (str): The dataset identifier.
+        query (ObjectStream): The query that made the files.
+        config (RunConfig): Run configuration options.
+    """
+    fingerprint = conversion_fingerprint(ds_name, query, config)
+    write_raw_cache_info(ds_name, fingerprint, config)
+    write_training_data(files, ds_name, fingerprint, config)
+
+
+def write_raw_cache_info(ds_name: str, fingerprint: Dict[str, Any], config: RunConfig):
+    """
+    Record where the raw copies come from so `reprocess` can find out later. Does
+    nothing if raw copies are not being saved.
+
+    Args:
+        ds_name (str): The dataset identifier.
+        fingerprint (Dict[str, Any]): The fingerprint of the conversion.
+        config (RunConfig): Run configuration options.
+    """
+    if config.raw_cache_dir is None:
+        return
+    os.makedirs(config.raw_cache_dir, exist_ok=True)
+    with open(os.path.join(config.raw_cache_dir, RAW_CACHE_INFO), "w") as f:
+        json.dump(
+            {
+                "dataset": ds_name,
+                "datatype": config.datatype.value,
+                "query_hash": fingerprint["query_hash"],
+            },
+            f,
+            indent=2,
+        )
+
+
+def reprocess_training_data_to_file(
+    input_dir: str, config: RunConfig, ds_name: Optional[str] = None
+):
+    """
+    Convert ServiceX output files that are already on disk to training data, without
+    running any query. The input directory can hold the ServiceX output files
+    themselves, or the compact parquet copies written by `fetch --save-raw`.
+
+    Args:
+        input_dir (str): Directory with the raw `.root` or `.parquet` files.
+        config (RunConfig): Run configuration options.
+        ds_name (Optional[str]): The dataset the files came from (used to build the
+            signal descriptive label). Default is the dataset recorded when the raw
+            copies were written, or else the name of the directory.
+    """
+    info: Dict[str, Any] = {}
+    info_path = os.path.join(input_dir, RAW_CACHE_INFO)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+    if "datatype" in info and info["datatype"] != config.datatype.value:
+        raise ValueError(
+            f"Raw files in {input_dir} were fetched as {info['datatype']}, "
+            f"not {config.datatype.value}."
+        )
+    ds_name = ds_name or info.get("dataset") or Path(input_dir).resolve().name
+
+    files = sorted(
+        str(p)
+        for p in Path(input_dir).iterdir()
+        if p.is_file() and p.suffix in (".root", ".parquet")
+    )
+    if len(files) == 0:
+        raise ValueError(f"No .root or .parquet files found in {input_dir}.")
+    logging.info(f"Reprocessing {len(files)} raw files from {input_dir}.")
+
+    fingerprint = {
+        "dataset": ds_name,
+        "datatype": config.datatype.value,
+        "rotation": config.rotation,
+        "compact_schema": config.compact_schema,
+        "desc_label": config.desc_label,
+        "query_hash": info.get("query_hash", ""),
+        "input": str(Path(input_dir).resolve()),
+    }
+    with run_metrics(config.metrics_out, config.profile_memory):
+        write_training_data(files, ds_name, fingerprint, config)
+
+
+def write_training_data(
+    files: List[str], ds_name: str, fingerprint: Dict[str, Any], config: RunConfig
+):
+    """
+    Convert raw files to training data and write them out, keeping track of progress
+    in the manifest so an interrupted run can be resumed.
+
+    Args:
+        files (List[str]): Paths to the raw files.
+        ds_name (str): The dataset identifier the files came from.
+        fingerprint (Dict[str, Any]): The settings that determine the output (see
+            `conversion_fingerprint`).
+        config (RunConfig): Run configuration options.
+    """
+    # The output may go in a directory that doesn't exist yet (e.g. a production's
+    # `output-dir`).
+    os.makedirs(Path(config.output_path).parent, exist_ok=True)
+
+    # If a previous run with the same settings was interrupted, skip the files it
+    # already finished.
+    m_path = manifest_path(config.output_path)
+    manifest = load_manifest(m_path) if config.resume else None
+    if manifest is not None and manifest.fingerprint != fingerprint:
+        logging.warning(
+            f"Manifest {m_path} was written with different settings - starting over."
+        )
+        manifest = None
+    if manifest is None:
+        manifest = ConversionManifest(fingerprint=fingerprint)
+
+    completed = manifest.completed_files()
+    to_convert = [f for f in files if source_file_name(f) not in completed]
+    if len(to_convert) < len(files):
+        logging.info(
+            f"Skipping {len(files) - len(to_convert)} of {len(files)} raw "
+            f"files that were already converted (see {m_path})."
+        )
+
+    def record_file(path: Optional[str], sources: List[str], n_jets: int):
+        names = [source_file_name(s) for s in sources]
+        if path is None:
+            manifest.empty_files.extend(names)
+        else:
+            manifest.shards.append(
+                ShardRecord(
+                    file=Path(path).name,
+                    index=manifest.next_shard_index(),
+                    jets=n_jets,
+                    source_files=names,
+                )
             )
+        save_manifest(manifest, m_path)
+
+    # Finally, write it out into training files, one converted chunk at a time.
+    _, jet_count = write_training_files(
+        convert_training_files(to_convert, ds_name, config),
+        config.output_path,
+        max_file_size=int(config.max_file_size_gb * 1_073_741_824),
+        first_index=manifest.next_shard_index(),
+        on_file_written=record_file,
+    )
 
-    if event_count > 0:
-        logging.info(f"Wrote out a total of {event_count:,} jets to " f"files.")
+    jet_count_total = sum(s.jets for s in manifest.shards)
+    if jet_count_total > 0:
+        logging.info(
+            f"Wrote out a total of {jet_count_total:,} jets to files "
+            f"({jet_count:,} in this run)."
+        )
     else:
         logging.warning("No jets were written out! Turn on logging to see why (-v)")
 
 
-def fetch_training_data(ds_name, config: RunConfig):
-    raw_data = fetch_raw_training_data(ds_name, config)
-    for ar in raw_data:
-        yield convert_to_training_data(
-            ar,
+def read_raw_chunks(path: str, config: RunConfig) -> Iterator[ak.Array]:
+    """
+    Read the branches conversion needs from a raw file, a chunk at a time. If a raw
+    cache directory is configured, a compact parquet copy of the file is written
+    there as it is read.
+
+    Args:
+        path (str): Path to the ServiceX output file (or a parquet copy of one).
+        config (RunConfig): Run configuration options.
+
+    Returns:
+        Iterator[ak.Array]: The raw data, in chunks of `config.chunk_events` events.
+    """
+    chunks = iterate_file(path, training_branches(config.datatype), config.chunk_events)
+    if config.raw_cache_dir is None or path.endswith(".parquet"):
+        return chunks
+    cache_path = os.path.join(
+        config.raw_cache_dir, f"{Path(source_file_name(path)).stem}.parquet"
+    )
+    return cache_raw_chunks(chunks, cache_path)
+
+
+def convert_file(
+    path: str, ds_name: str, config: RunConfig
+) -> Tuple[str, List[ak.Array], FileMetrics]:
+    """
+    Read a single ServiceX output file and convert it to training data. This is what
+    runs in each worker process when converting in parallel.
+
+    Args:
+        path (str): Path to the ServiceX output file.
+        ds_name (str): The dataset identifier the file came from.
+        config (RunConfig): Run configuration options.
+
+    Returns:
+        Tuple[str, List[ak.Array], FileMetrics]: The path, the training data for each
+            chunk of events in the file, and how long each stage took.
+    """
+    if config.profile_memory:
+        # A no-op unless this is a fresh worker process.
+        start_memory_tracing()
+    metrics = file_metrics(path)
+    converted = []
+    for chunk, read_times in timed_items(read_raw_chunks(path, config), "read"):
+        metrics.merge(read_times)
+        converted.append(_convert_chunk(chunk, ds_name, config, metrics))
+    return path, converted, metrics
+
+
+def _convert_chunk(
+    chunk: ak.Array, ds_name: str, config: RunConfig, metrics: FileMetrics
+) -> ak.Array:
+    "Convert a chunk of raw data, recording how long it took in `metrics`"
+    with recording(metrics):
+        result = convert_to_training_data(
+            chunk,
             datatype=config.datatype,
             ds_name=ds_name,
             rotation=config.rotation,
             desc_label=config.desc_label,
+            engine=config.engine,
+            compact=config.compact_schema,
         )
+    metrics.events += len(chunk["jet_pt"])
+    metrics.jets += len(result)
+    return result
 
 
-def run_query(
+def convert_training_files(
+    files: List[str], ds_name: str, config: RunConfig
+) -> Iterator[Tuple[str, ak.Array]]:
+    """
+    Convert ServiceX output files to training data.
+
+    Args:
+        files (List[str]): Paths to the ServiceX output files.
+        ds_name (str): The dataset identifier the files came from.
+        config (RunConfig): Run configuration options.
+
+    Returns:
+        Iterator[Tuple[str, ak.Array]]: The file each chunk of training data came from,
+            and the training data. All chunks from one file are returned together.
+    """
+    if config.workers > 1:
+        # Each worker opens its own file, so only the file names need to be sent over.
+        for path, chunks, metrics in process_map(
+            partial(convert_file, ds_name=ds_name, config=config),
+            files,
+            workers=config.workers,
+            ordered=config.ordered,
+        ):
+            report_file(metrics)
+            for chunk in chunks:
+                yield path, chunk
+        return
+
+    # Decode the next chunk(s) in the background while we convert this one. Reading
+    # is timed there, as stage timings are not recorded on other threads.
+    raw_chunks = (
+        (path, chunk, read_times)
+        for path in files
+        for chunk, read_times in timed_items(read_raw_chunks(path, config), "read")
+    )
+    metrics: Optional[FileMetrics] = None
+    for path, chunk, read_times in read_ahead(raw_chunks, config.read_ahead):
+        if metrics is None or metrics.file != path:
+            if metrics is not None:
+                report_file(metrics)
+            metrics = file_metrics(path)
+        metrics.merge(read_times)
+        yield path, _convert_chunk(chunk, ds_name, config, metrics)
+    if metrics is not None:
+        report_file(metrics)
+
+
+def fetch_training_data(ds_name, config: RunConfig):
+    files = fetch_raw_training_files(ds_name, config)
+    for _, data in convert_training_files(files, ds_name, config):
+        yield data
+
+
+def deliver_query(
     ds_name: str,
     query: ObjectStream,
     config: RunConfig = RunConfig(ignore_cache=False, run_locally=False),
-) -> Generator[Dict[str, ak.Array], Any, None]:
+) -> List[str]:
+    """
+    Run the query on ServiceX and return the list of output files.
+
+    Args:
+        ds_name (str): The dataset identifier.
+        query (ObjectStream): The query to run.
+        config (RunConfig): Run configuration options.
+
+    Returns:
+        List[str]: Paths to the ServiceX output files.
+    """
     # Build the ServiceX spec and run it.
+    import servicex_local as sx_local
+    from servicex import deliver
+
     from .sx_utils import build_sx_spec
 
     spec, backend_name, adaptor = build_sx_spec(
@@ -786,14 +1103,76 @@ def run_query(
             spec, servicex_name=backend_name, ignore_local_cache=config.ignore_cache
         )
 
-    # Work one file at a time to return the results.
     if sx_result is None:
         raise ValueError("No result from ServiceX!")
 
-    entries = 0
     sample_name = spec.Sample[0].Name  # type: ignore
-    for file in sx_result[sample_name]:
-        f_data = uproot.open(file)["atlas_xaod_tree"].arrays()  # type: ignore
+    return list(sx_result[sample_name])
+
+
+async def deliver_query_async(
+    ds_name: str,
+    query: ObjectStream,
+    config: RunConfig = RunConfig(ignore_cache=False, run_locally=False),
+) -> List[str]:
+    """
+    Run the query on ServiceX without blocking the event loop, so that other
+    queries can be run (and their results converted) at the same time.
+
+    Args:
+        ds_name (str): The dataset identifier.
+        query (ObjectStream): The query to run.
+        config (RunConfig): Run configuration options.
+
+    Returns:
+        List[str]: Paths to the ServiceX output files.
+    """
+    import servicex_local as sx_local
+    from servicex.servicex_client import deliver_async
+
+    from .sx_utils import build_sx_spec
+
+    spec, backend_name, adaptor = build_sx_spec(
+        query,
+        ds_name,
+        prefer_local=config.run_locally,
+        backend_name=config.sx_backend,
+        n_files=config.n_files,
+    )
+    if config.run_locally or backend_name == "local-backend":
+        # The local backend has no async interface.
+        sx_result = await asyncio.to_thread(
+            sx_local.deliver,
+            spec,
+            adaptor=adaptor,
+            ignore_local_cache=config.ignore_cache,
+        )
+    else:
+        sx_result = await deliver_async(
+            spec, servicex_name=backend_name, ignore_local_cache=config.ignore_cache
+        )
+
+    if sx_result is None:
+        raise ValueError("No result from ServiceX!")
+
+    return list(sx_result[spec.Sample[0].Name])  # type: ignore
+
+
+def run_query(
+    ds_name: str,
+    query: ObjectStream,
+    config: RunConfig = RunConfig(ignore_cache=False, run_locally=False),
+    branches: Optional[List[str]] = None,
+) -> Generator[Dict[str, ak.Array], Any, None]:
+    files = deliver_query(ds_name, query, config)
+
+    # Work one file at a time to return the results.
+    entries = 0
+    # Decode the next file(s) in the background while the caller converts this one.
+    chunks = chain.from_iterable(
+        iterate_file(f, branches, config.chunk_events) for f in files
+    )
+    for f_data in read_ahead(chunks, config.read_ahead):
         entries += len(f_data)
         yield f_data  # type: ignore
 
@@ -0,0 +1,30 @@
+import awkward as ak
+import numpy as np
+import vector
+
+vector.register_awkward()
+
+
+def random_lists(rng, n: int, mean: float) -> ak.Array:
+    "Lists of float32 momenta, some of them empty"
+    counts = rng.poisson(mean, n)
+    total = int(counts.sum())
+    return ak.values_astype(
+        ak.unflatten(
+            ak.zip(
+                {
+                    "pt": rng.exponential(10, total),
+                    "eta": rng.uniform(-2.5, 2.5, total),
+                    "phi": rng.uniform(-np.pi, np.pi, total),
+                },
+                with_name="Momentum3D",
+            ),
+            counts,
+        ),
+        np.float32,
+    )
+
+
+def same_bits(a: np.ndarray, b: np.ndarray) -> bool:
+    "The same dtype and the same bytes (so NaN's and -0.0 compare too)"
+    return a.dtype == b.dtype and np.array_equal(a.view(np.uint8), b.view(np.uint8))
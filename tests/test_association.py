@@ -0,0 +1,261 @@
+import awkward as ak
+import numpy as np
+import pytest
+import vector
+
+from calratio_training_data import association
+from calratio_training_data.association import delta_phi_matches, delta_r_matches
+
+vector.register_awkward()
+
+
+@pytest.fixture(autouse=True, params=["all pairs", "lookup"])
+def pairs_or_lookup(request, monkeypatch):
+    "Run every test both trying all pairs and with the cell and phi window lookups"
+    per_jet = 10**9 if request.param == "all pairs" else -1
+    monkeypatch.setattr(association, "_ALL_PAIRS_PER_JET_DELTA_R", per_jet)
+    monkeypatch.setattr(association, "_ALL_PAIRS_PER_JET_DELTA_PHI", per_jet)
+
+
+def momenta(events) -> ak.Array:
+    return ak.values_astype(ak.Array(events, with_name="Momentum3D"), np.float32)
+
+
+def cartesian_matches(jets: ak.Array, objects: ak.Array, max_dr: float) -> ak.Array:
+    "The all-pairs way of matching"
+    pairs = ak.cartesian({"jet": jets, "obj": objects}, axis=1, nested=True)
+    return pairs.obj[pairs.jet.deltaR(pairs.obj) < max_dr]
+
+
+def cartesian_phi_matches(
+    jets: ak.Array, objects: ak.Array, max_dphi: float
+) -> ak.Array:
+    "The all-pairs way of matching in phi"
+    pairs = ak.cartesian({"jet": jets, "obj": objects}, axis=1, nested=True)
+    return pairs.obj[abs(pairs.jet.deltaphi(pairs.obj)) < max_dphi]
+
+
+def random_events(rng, n_events: int, n_jets: float, n_objects: float):
+    def objects(mean: float) -> ak.Array:
+        counts = rng.poisson(mean, n_events)
+        total = int(counts.sum())
+        return ak.values_astype(
+            ak.unflatten(
+                ak.zip(
+                    {
+                        "pt": rng.uniform(1, 100, total),
+                        "eta": rng.uniform(-2.5, 2.5, total),
+                        "phi": rng.uniform(-np.pi, np.pi, total),
+                    },
+                    with_name="Momentum3D",
+                ),
+                counts,
+            ),
+            np.float32,
+        )
+
+    return objects(n_jets), objects(n_objects)
+
+
+@pytest.mark.parametrize("max_dr", [0.2, 0.4, 1.0, 2.5, 4.0])
+def test_delta_r_matches_same_as_cartesian(max_dr):
+    jets, tracks = random_events(np.random.default_rng(1), 500, 4, 60)
+
+    matched = delta_r_matches(jets, tracks, max_dr).take(tracks)
+
+    expected = cartesian_matches(jets, tracks, max_dr)
+    assert ak.sum(ak.num(expected, axis=2)) > 0
+    assert matched.to_list() == expected.to_list()
+    assert matched.type == expected.type
+
+
+def test_delta_r_matches_phi_wrap():
+    "Tracks just the other side of +-pi from the jet are found"
+    jets = momenta([[{"pt": 50.0, "eta": 0.0, "phi": 3.1}]])
+    tracks = momenta(
+        [
+            [
+                {"pt": 1.0, "eta": 0.0, "phi": -3.1},
+                {"pt": 2.0, "eta": 0.0, "phi": 0.0},
+                {"pt": 3.0, "eta": 0.1, "phi": 3.0},
+            ]
+        ]
+    )
+
+    index = delta_r_matches(jets, tracks, 0.2).index
+
+    assert index.to_list() == [[[0, 2]]]
+
+
+def test_delta_r_matches_order():
+    "Matched tracks keep their order in the event, whatever cell they are in"
+    jets = momenta([[{"pt": 50.0, "eta": 0.0, "phi": 0.0}]])
+    tracks = momenta(
+        [
+            [
+                {"pt": 1.0, "eta": 0.15, "phi": 0.0},
+                {"pt": 2.0, "eta": -0.15, "phi": 0.0},
+                {"pt": 3.0, "eta": 0.0, "phi": 0.1},
+                {"pt": 4.0, "eta": 0.0, "phi": -0.1},
+            ]
+        ]
+    )
+
+    assert delta_r_matches(jets, tracks, 0.2).index.to_list() == [[[0, 1, 2, 3]]]
+
+
+def test_delta_r_matches_events_apart():
+    "Tracks in other events are never matched, even at the same eta and phi"
+    jets = momenta([[{"pt": 50.0, "eta": 1.0, "phi": 1.0}], []])
+    tracks = momenta([[], [{"pt": 1.0, "eta": 1.0, "phi": 1.0}]])
+
+    assert delta_r_matches(jets, tracks, 0.2).index.to_list() == [[[]], []]
+
+
+def test_delta_r_matches_empty():
+    jets = momenta([[], [{"pt": 50.0, "eta": 0.0, "phi": 0.0}]])
+    tracks = momenta([[{"pt": 1.0, "eta": 0.0, "phi": 0.0}], []])
+
+    matches = delta_r_matches(jets, tracks, 0.2)
+
+    assert matches.index.to_list() == [[], [[]]]
+    assert matches.take(tracks).to_list() == [[], [[]]]
+
+
+def test_delta_r_matches_nan():
+    "NaN's are never matched, just as with a deltaR cut"
+    jets = momenta(
+        [
+            [
+                {"pt": 50.0, "eta": 0.0, "phi": 0.0},
+                {"pt": 50.0, "eta": float("nan"), "phi": 0.0},
+            ]
+        ]
+    )
+    tracks = momenta(
+        [
+            [
+                {"pt": 1.0, "eta": 0.0, "phi": float("nan")},
+                {"pt": 2.0, "eta": 0.0, "phi": 0.0},
+            ]
+        ]
+    )
+
+    assert delta_r_matches(jets, tracks, 0.2).index.to_list() == [[[1], []]]
+
+
+@pytest.mark.parametrize("max_dphi", [0.05, 0.2, 1.0, 3.0, 3.2])
+def test_delta_phi_matches_same_as_cartesian(max_dphi):
+    jets, msegs = random_events(np.random.default_rng(2), 500, 4, 30)
+
+    matched = delta_phi_matches(jets, msegs, max_dphi).take(msegs)
+
+    expected = cartesian_phi_matches(jets, msegs, max_dphi)
+    assert ak.sum(ak.num(expected, axis=2)) > 0
+    assert matched.to_list() == expected.to_list()
+    assert matched.type == expected.type
+
+
+def test_delta_phi_matches_both_sides_and_wrap():
+    "Segments either side of the jet are found, including across +-pi"
+    jets = momenta(
+        [
+            [
+                {"pt": 50.0, "eta": 0.0, "phi": 3.1},
+                {"pt": 50.0, "eta": 0.0, "phi": -3.1},
+                {"pt": 50.0, "eta": 0.0, "phi": 0.0},
+            ]
+        ]
+    )
+    msegs = momenta(
+        [
+            [
+                {"pt": 1.0, "eta": 2.0, "phi": -3.05},
+                {"pt": 2.0, "eta": -1.0, "phi": 0.1},
+                {"pt": 3.0, "eta": 0.0, "phi": 3.0},
+                {"pt": 4.0, "eta": 0.0, "phi": -0.1},
+                {"pt": 5.0, "eta": 0.0, "phi": 1.0},
+            ]
+        ]
+    )
+
+    index = delta_phi_matches(jets, msegs, 0.2).index
+
+    assert index.to_list() == [[[0, 2], [0, 2], [1, 3]]]
+
+
+def test_delta_phi_matches_events_apart():
+    "Segments in other events are never matched, even at the same phi"
+    jets = momenta([[{"pt": 50.0, "eta": 1.0, "phi": 3.1}], []])
+    msegs = momenta([[], [{"pt": 1.0, "eta": 1.0, "phi": 3.1}]])
+
+    assert delta_phi_matches(jets, msegs, 0.2).index.to_list() == [[[]], []]
+
+
+def test_delta_phi_matches_empty_and_nan():
+    jets = momenta(
+        [
+            [],
+            [
+                {"pt": 50.0, "eta": 0.0, "phi": 0.0},
+                {"pt": 50.0, "eta": 0.0, "phi": float("nan")},
+            ],
+        ]
+    )
+    msegs = momenta(
+        [
+            [{"pt": 1.0, "eta": 0.0, "phi": 0.0}],
+            [
+                {"pt": 1.0, "eta": 0.0, "phi": float("nan")},
+                {"pt": 2.0, "eta": 0.0, "phi": 0.0},
+            ],
+        ]
+    )
+
+    index = delta_phi_matches(jets, msegs, 0.2).index
+
+    assert index.to_list() == [[], [[1], []]]
+
+
+def test_association_distance_matched_nearest():
+    "Distances, masks and nearest matches agree with the all-pairs calculation"
+    jets, llps = random_events(np.random.default_rng(3), 500, 4, 3)
+    matches = delta_r_matches(jets, llps, 0.4)
+
+    pairs = ak.cartesian({"jet": jets, "obj": llps}, axis=1, nested=True)
+    delta_r = pairs.jet.deltaR(pairs.obj)
+    assert matches.distance.to_list() == delta_r[delta_r < 0.4].to_list()
+
+    matched = matches.matched()
+    assert matched.to_list() == ak.any(delta_r < 0.4, axis=-1).to_list()
+    assert ak.sum(matched) > 0
+
+    nearest = matches.select(matched).nearest()
+    expected = ak.argmin(delta_r[matched], axis=-1)
+    assert nearest.to_list() == expected.to_list()
+    assert llps[nearest].to_list() == llps[expected].to_list()
+
+
+def test_association_nearest_no_match():
+    jets = momenta(
+        [
+            [
+                {"pt": 50.0, "eta": 0.0, "phi": 0.0},
+                {"pt": 50.0, "eta": 2.0, "phi": 0.0},
+            ]
+        ]
+    )
+    llps = momenta(
+        [
+            [
+                {"pt": 1.0, "eta": 0.3, "phi": 0.0},
+                {"pt": 2.0, "eta": 0.1, "phi": 0.0},
+            ]
+        ]
+    )
+
+    matches = delta_r_matches(jets, llps, 0.4)
+
+    assert matches.index.to_list() == [[[0, 1], []]]
+    assert matches.matched().to_list() == [[True, False]]
+    assert matches.nearest().to_list() == [[1, None]]
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from calratio_training_data.async_utils import as_completed_indexed, iterate_async
+
+
+async def _delivered(items):
+    "A stand-in for files arriving from ServiceX one at a time"
+    for i in items:
+        await asyncio.sleep(0)
+        yield i
+
+
+async def _collect(agen):
+    return [x async for x in agen]
+
+
+def test_as_completed_indexed():
+    async def after(delay, value):
+        await asyncio.sleep(delay)
+        return value
+
+    results = asyncio.run(
+        _collect(as_completed_indexed([after(0.2, "a"), after(0.0, "b")]))
+    )
+
+    assert results == [(1, "b"), (0, "a")]
+
+
+def test_iterate_async():
+    assert list(iterate_async(lambda: _delivered(range(4)))) == [0, 1, 2, 3]
+
+
+def test_iterate_async_error():
+    async def items():
+        yield 1
+        raise ValueError("transform failed")
+
+    it = iterate_async(items)
+    assert next(it) == 1
+    with pytest.raises(ValueError, match="transform failed"):
+        next(it)
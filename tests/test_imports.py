@@ -0,0 +1,53 @@
+import subprocess
+import sys
+
+import pytest
+
+# Slow to import, and only needed to talk to ServiceX or build the query.
+SERVICEX_STACK = ["servicex", "servicex_local", "func_adl_servicex_xaodr25"]
+
+# Only needed to read ServiceX output and convert it.
+CONVERSION_STACK = ["uproot", "vector"]
+
+
+def loaded_modules(code: str) -> set:
+    "The top level modules loaded after running `code` in a fresh interpreter"
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"{code}\nimport sys\nprint(' '.join(sys.modules))",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return {m.split(".")[0] for m in result.stdout.split()}
+
+
+@pytest.mark.parametrize(
+    "code, not_loaded",
+    [
+        ("import calratio_training_data", SERVICEX_STACK + CONVERSION_STACK),
+        ("import calratio_training_data.fetch", SERVICEX_STACK + CONVERSION_STACK),
+        (
+            "import calratio_training_data.combining",
+            SERVICEX_STACK + CONVERSION_STACK,
+        ),
+        ("import calratio_training_data.training_query", SERVICEX_STACK),
+    ],
+)
+def test_lazy_imports(code, not_loaded):
+    "Each command only pays for the packages it uses"
+    loaded = loaded_modules(code)
+    assert loaded.isdisjoint(not_loaded), loaded & set(not_loaded)
+
+
+def test_package_exports():
+    "The lazy package level names still work"
+    import calratio_training_data
+
+    assert calratio_training_data.RunConfig().workers == 1
+    assert callable(calratio_training_data.fetch_training_data_to_file)
+    with pytest.raises(AttributeError):
+        calratio_training_data.not_a_thing  # noqa: B018
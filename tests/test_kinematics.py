@@ -0,0 +1,90 @@
+import awkward as ak
+import numpy as np
+import vector
+
+from calratio_training_data.kinematics import (
+    delta_phi,
+    delta_r,
+    flat_lists,
+    jagged,
+    relative_to_parent,
+    weighted_sign,
+)
+from momentum_helpers import random_lists, same_bits
+
+vector.register_awkward()
+
+
+def test_flat_lists_round_trip():
+    lists = ak.Array([[1.0, 2.0], [], [3.0]])
+
+    values, offsets = flat_lists(lists)
+
+    assert values.tolist() == [1.0, 2.0, 3.0]
+    assert offsets.tolist() == [0, 2, 2, 3]
+    assert jagged(values, offsets).to_list() == lists.to_list()
+
+
+def test_delta_phi_and_delta_r_same_as_vector():
+    rng = np.random.default_rng(1)
+    a = ak.flatten(random_lists(rng, 1000, 3))
+    b = a[rng.permutation(len(a))]
+
+    assert same_bits(
+        delta_phi(ak.to_numpy(a.phi), ak.to_numpy(b.phi)), ak.to_numpy(a.deltaphi(b))
+    )
+    assert same_bits(
+        delta_r(
+            ak.to_numpy(a.eta),
+            ak.to_numpy(a.phi),
+            ak.to_numpy(b.eta),
+            ak.to_numpy(b.phi),
+        ),
+        ak.to_numpy(a.deltaR(b)),
+    )
+
+
+def test_relative_to_parent_same_as_vector():
+    rng = np.random.default_rng(2)
+    objects = random_lists(rng, 1000, 5)
+    jets = ak.values_astype(
+        ak.zip(
+            {
+                "pt": rng.exponential(10, 1000),
+                "eta": rng.uniform(-2.5, 2.5, 1000),
+                "phi": rng.uniform(-np.pi, np.pi, 1000),
+            },
+            with_name="Momentum3D",
+        ),
+        np.float32,
+    )
+
+    eta, offsets = flat_lists(objects.eta)
+    phi, _ = flat_lists(objects.phi)
+    d_eta, d_phi = relative_to_parent(
+        eta, phi, ak.to_numpy(jets.eta), ak.to_numpy(jets.phi), offsets
+    )
+
+    assert same_bits(d_eta, ak.to_numpy(ak.flatten(objects.deltaeta(jets))))
+    assert same_bits(d_phi, ak.to_numpy(ak.flatten(objects.deltaphi(jets))))
+
+
+def test_weighted_sign_same_as_sum():
+    rng = np.random.default_rng(3)
+    objects = random_lists(rng, 5000, 4)
+
+    values, offsets = flat_lists(objects.eta)
+    pt, _ = flat_lists(objects.pt)
+    sign = weighted_sign(values, pt, offsets)
+
+    total = ak.to_numpy(ak.sum(objects.eta * objects.pt, axis=1))
+    assert sign.dtype == np.int64
+    assert sign.tolist() == np.where(total >= 0, 1, -1).tolist()
+
+
+def test_weighted_sign_empty_and_nan():
+    values = np.array([1.0, np.nan, -2.0, 0.0], dtype=np.float32)
+    weights = np.ones(4, dtype=np.float32)
+    offsets = np.array([0, 0, 2, 3, 4])
+
+    assert weighted_sign(values, weights, offsets).tolist() == [1, 0, -1, 1]
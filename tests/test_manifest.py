@@ -0,0 +1,60 @@
+from pathlib import Path
+
+from calratio_training_data.manifest import (
+    ConversionManifest,
+    ShardRecord,
+    load_manifest,
+    manifest_path,
+    save_manifest,
+    source_file_name,
+)
+
+
+def test_manifest_path():
+    assert manifest_path("out/training.parquet") == "out/training_manifest.json"
+
+
+def test_source_file_name_path():
+    assert source_file_name("/cache/abc123/root___file_1.root") == "root___file_1.root"
+
+
+def test_source_file_name_signed_url():
+    "The signature on a url changes every time, but the file name does not"
+    url = "http://localhost:9000/bucket/file_1.root?X-Amz-Signature=deadbeef"
+    assert source_file_name(url) == "file_1.root"
+
+
+def test_load_missing(tmp_path: Path):
+    assert load_manifest(str(tmp_path / "training_manifest.json")) is None
+
+
+def test_round_trip(tmp_path: Path):
+    path = str(tmp_path / "training_manifest.json")
+    manifest = ConversionManifest(
+        fingerprint={"datatype": "qcd", "rotation": True},
+        shards=[ShardRecord("training_000.parquet", 0, 10, ["f1.root", "f2.root"])],
+        empty_files=["f3.root"],
+    )
+
+    save_manifest(manifest, path)
+
+    assert load_manifest(path) == manifest
+    assert not Path(f"{path}.tmp").exists()
+
+
+def test_completed_files():
+    manifest = ConversionManifest(
+        fingerprint={},
+        shards=[
+            ShardRecord("training_000.parquet", 0, 10, ["f1.root"]),
+            ShardRecord("training_001.parquet", 1, 5, ["f2.root"]),
+        ],
+        empty_files=["f3.root"],
+    )
+
+    assert manifest.completed_files() == {"f1.root", "f2.root", "f3.root"}
+    assert manifest.next_shard_index() == 2
+
+
+def test_next_shard_index_empty():
+    assert ConversionManifest(fingerprint={}).next_shard_index() == 0
@@ -0,0 +1,243 @@
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from calratio_training_data.metrics import (
+    FileMetrics,
+    StageClock,
+    StageTimes,
+    add_stage_time,
+    file_metrics,
+    format_memory_report,
+    last_run_report,
+    max_rss_mb,
+    recording,
+    report_file,
+    run_metrics,
+    stage,
+    start_memory_tracing,
+    timed_items,
+    top_allocators,
+)
+
+
+@pytest.fixture
+def tracing():
+    start_memory_tracing()
+    yield
+    tracemalloc.stop()
+
+
+def allocate(mb: int) -> np.ndarray:
+    return np.ones(mb * 1_048_576, dtype=np.uint8)
+
+
+def test_stage_not_recording():
+    "Nothing happens (and nothing breaks) when nobody is recording"
+    with stage("read"):
+        pass
+    add_stage_time("write", 1.0)
+    StageClock("convert").lap("match")
+
+
+def test_stage_recording():
+    times = StageTimes()
+    with recording(times):
+        with stage("read"):
+            time.sleep(0.01)
+        with stage("read"):
+            pass
+        add_stage_time("write", 2.0)
+
+    assert set(times.stages) == {"read", "write"}
+    assert times.stages["read"] >= 0.01
+    assert times.stages["write"] == 2.0
+
+
+def test_stage_clock():
+    times = StageTimes()
+    with recording(times):
+        clock = StageClock("convert")
+        clock.lap("prepare")
+        time.sleep(0.01)
+        clock.lap("match")
+
+    assert set(times.stages) == {"convert.prepare", "convert.match"}
+    assert times.stages["convert.match"] >= 0.01
+
+
+def test_timed_items():
+    def items():
+        yield 1
+        time.sleep(0.01)
+        yield 2
+
+    result = list(timed_items(items(), "read"))
+
+    assert [i for i, _ in result] == [1, 2]
+    assert result[1][1].stages["read"] >= 0.01
+    assert result[1][1].peak_mb == {}
+
+
+def test_file_metrics_size(tmp_path: Path):
+    path = tmp_path / "sx.root"
+    path.write_bytes(b"0" * 100)
+
+    assert file_metrics(str(path)).bytes == 100
+    assert file_metrics("https://somewhere/sx.root").bytes == 0
+
+
+def test_run_metrics_report(tmp_path: Path):
+    "The report has run and per-file numbers, with rates"
+    out = tmp_path / "metrics.json"
+    with run_metrics(str(out)):
+        add_stage_time("servicex", 3.0)
+        report_file(
+            FileMetrics(
+                file="f1.root",
+                events=100,
+                jets=50,
+                bytes=1_048_576,
+                stages={"read": 0.5, "convert.match": 0.5},
+            )
+        )
+        report_file(FileMetrics(file="f2.root", events=100, jets=10, stages={}))
+
+    report = json.loads(out.read_text())
+    assert report["events"] == 200
+    assert report["jets"] == 60
+    assert report["stages"] == {"servicex": 3.0, "read": 0.5, "convert.match": 0.5}
+    assert report["events_per_s"] > 0
+    assert [f["file"] for f in report["files"]] == ["f1.root", "f2.root"]
+    assert report["files"][0]["seconds"] == 1.0
+    assert report["files"][0]["mb_per_s"] == 1.0
+    assert report["files"][0]["jets_per_s"] == 50.0
+
+
+def test_run_metrics_written_on_failure(tmp_path: Path):
+    "A run that fails part way still leaves its metrics behind"
+    out = tmp_path / "metrics.json"
+    with pytest.raises(RuntimeError):
+        with run_metrics(str(out)):
+            report_file(FileMetrics(file="f1.root", events=10))
+            raise RuntimeError("transform failed")
+
+    assert json.loads(out.read_text())["events"] == 10
+
+
+def test_run_metrics_off():
+    "No output path, no recording"
+    with run_metrics(None) as m:
+        report_file(FileMetrics(file="f1.root"))
+    assert m is None
+
+
+def test_stage_memory(tracing):
+    "Nested stages each get the peak of what happened inside them"
+    times = StageTimes()
+    with recording(times):
+        with stage("outer"):
+            with stage("inner"):
+                a = allocate(20)
+                del a
+            b = allocate(5)
+            del b
+        with stage("small"):
+            pass
+
+    assert times.peak_mb["inner"] >= 20
+    assert times.peak_mb["outer"] >= 20
+    assert times.peak_mb["small"] < 5
+    assert times.rss_mb["inner"] > 0
+
+
+def test_stage_clock_memory(tracing):
+    times = StageTimes()
+    with recording(times):
+        clock = StageClock("convert")
+        a = allocate(20)
+        del a
+        clock.lap("match")
+        clock.lap("flatten")
+
+    assert times.peak_mb["convert.match"] >= 20
+    assert times.peak_mb["convert.flatten"] < 5
+
+
+def test_timed_items_memory(tracing):
+    def items():
+        yield allocate(10)
+
+    ((_, times),) = list(timed_items(items(), "read"))
+
+    assert times.peak_mb["read"] >= 10
+
+
+def test_stage_times_merge():
+    a = StageTimes(stages={"read": 1.0}, peak_mb={"read": 10.0}, rss_mb={"read": 50})
+    a.merge(
+        StageTimes(stages={"read": 2.0}, peak_mb={"read": 5.0}, rss_mb={"read": 70})
+    )
+
+    assert a.stages == {"read": 3.0}
+    assert a.peak_mb == {"read": 10.0}
+    assert a.rss_mb == {"read": 70}
+
+
+def test_max_rss():
+    assert max_rss_mb() > 1
+
+
+def test_top_allocators(tracing):
+    held = allocate(10)
+    allocators = top_allocators(tracemalloc.take_snapshot(), top=3)
+
+    assert len(allocators) == 3
+    assert allocators[0]["mb"] >= 10
+    # Charged to the test, not numpy.
+    assert "test_metrics.py" in allocators[0]["where"]
+    del held
+
+
+def test_run_metrics_profile_memory(tmp_path: Path, capsys):
+    "Profiling memory adds per-stage peaks and top allocators, without printing them"
+    out = tmp_path / "metrics.json"
+    with run_metrics(str(out), profile_memory=True):
+        with stage("convert"):
+            held = allocate(10)
+        metrics = FileMetrics(file="f1.root")
+        with recording(metrics):
+            with stage("read"):
+                pass
+        report_file(metrics)
+    del held
+
+    assert not tracemalloc.is_tracing()
+    report = json.loads(out.read_text())
+    assert report["memory"]["peak_mb"]["convert"] >= 10
+    assert "read" in report["memory"]["peak_mb"]
+    assert "memory" in report["files"][0]
+    assert report["memory_profile"]["traced_peak_mb"] >= 10
+    assert report["memory_profile"]["top_allocators"][0]["mb"] >= 10
+
+    assert capsys.readouterr().out == ""
+    assert last_run_report() == report
+    summary = format_memory_report(report)
+    assert "Peak memory" in summary
+    assert "convert" in summary
+    assert "test_metrics.py" in summary
+
+
+def test_run_metrics_profile_memory_only():
+    "Memory can be profiled without writing a report"
+    with run_metrics(None, profile_memory=True) as m:
+        with stage("convert"):
+            pass
+    assert m is not None
+    report = last_run_report()
+    assert report is not None
+    assert "Peak memory" in format_memory_report(report)
@@ -0,0 +1,111 @@
+import awkward as ak
+import numpy as np
+import pytest
+import vector
+
+from calratio_training_data.association import delta_phi_matches, delta_r_matches
+from calratio_training_data.constants import Engine
+from calratio_training_data.kinematics import (
+    broadcast_to_lists,
+    flat_lists,
+    relative_to_parent,
+    weighted_sign,
+)
+from momentum_helpers import random_lists, same_bits
+
+numba_kernels = pytest.importorskip("calratio_training_data.numba_kernels")
+
+vector.register_awkward()
+
+# Angles where the wrapping into [-pi, pi) is most likely to round differently.
+EDGES = np.array(
+    [np.pi, -np.pi, 0.0, -0.0, 3.1415925, -3.1415925, 6.2831855, -6.2831855, np.nan],
+    dtype=np.float32,
+)
+
+
+def test_relative_to_parent_same_bits():
+    rng = np.random.default_rng(1)
+    n = 100_000
+    phi = np.concatenate([rng.uniform(-4, 4, n), EDGES, EDGES]).astype(np.float32)
+    parent_phi = np.concatenate(
+        [rng.uniform(-4, 4, n), np.zeros(len(EDGES)), EDGES[::-1]]
+    ).astype(np.float32)
+    eta = rng.uniform(-3, 3, len(phi)).astype(np.float32)
+    parent_eta = rng.uniform(-3, 3, len(phi)).astype(np.float32)
+    offsets = np.arange(len(phi) + 1)
+
+    with np.errstate(invalid="ignore"):
+        expected = relative_to_parent(eta, phi, parent_eta, parent_phi, offsets)
+    result = numba_kernels.relative_to_parent(eta, phi, parent_eta, parent_phi, offsets)
+
+    assert same_bits(result[0], expected[0])
+    assert same_bits(result[1], expected[1])
+
+
+def test_rotate_same_bits():
+    "The same as the relative angle followed by the eta and phi flips"
+    rng = np.random.default_rng(2)
+    objects = random_lists(rng, 2000, 5)
+    parents = random_lists(rng, 2000, 1)
+    eta, offsets = flat_lists(objects.eta)
+    phi, _ = flat_lists(objects.phi)
+    pt, _ = flat_lists(objects.pt)
+    # A parent with no angle, and a list whose weighted sum is exactly zero.
+    parent_eta = ak.to_numpy(ak.fill_none(ak.firsts(parents.eta), np.float32(np.nan)))
+    parent_phi = ak.to_numpy(ak.fill_none(ak.firsts(parents.phi), np.float32(0)))
+    first, last = offsets[3], offsets[4]
+    pt[first:last] = 0
+
+    rel_eta, rel_phi = relative_to_parent(eta, phi, parent_eta, parent_phi, offsets)
+    expected_eta = rel_eta * broadcast_to_lists(
+        weighted_sign(rel_eta, pt, offsets), offsets
+    )
+    expected_phi = rel_phi * broadcast_to_lists(
+        weighted_sign(rel_phi, pt, offsets), offsets
+    )
+    result_eta, result_phi = numba_kernels.rotate(
+        eta, phi, pt, parent_eta, parent_phi, offsets
+    )
+
+    assert same_bits(result_eta, expected_eta)
+    assert same_bits(result_phi, expected_phi)
+
+
+@pytest.mark.parametrize("max_dr", [0.2, 0.4, 4.0])
+def test_delta_r_matches_numba_same(max_dr):
+    rng = np.random.default_rng(3)
+    jets, tracks = random_lists(rng, 500, 4), random_lists(rng, 500, 60)
+
+    expected = delta_r_matches(jets, tracks, max_dr)
+    result = delta_r_matches(jets, tracks, max_dr, Engine.NUMBA)
+
+    assert result.index.to_list() == expected.index.to_list()
+    assert result.index.type == expected.index.type
+    assert result.distance.to_list() == expected.distance.to_list()
+    assert result.distance.type == expected.distance.type
+
+
+@pytest.mark.parametrize("max_dphi", [0.05, 0.2, 3.2])
+def test_delta_phi_matches_numba_same(max_dphi):
+    rng = np.random.default_rng(4)
+    jets, msegs = random_lists(rng, 500, 4), random_lists(rng, 500, 30)
+
+    expected = delta_phi_matches(jets, msegs, max_dphi)
+    result = delta_phi_matches(jets, msegs, max_dphi, Engine.NUMBA)
+
+    assert result.index.to_list() == expected.index.to_list()
+    assert result.index.type == expected.index.type
+    assert result.distance.to_list() == expected.distance.to_list()
+    assert result.distance.type == expected.distance.type
+
+
+def test_matches_numba_empty():
+    jets = random_lists(np.random.default_rng(5), 3, 0)
+    tracks = random_lists(np.random.default_rng(6), 3, 0)
+
+    by_r = delta_r_matches(jets, tracks, 0.2, Engine.NUMBA)
+    by_phi = delta_phi_matches(jets[:0], tracks[:0], 0.2, Engine.NUMBA)
+
+    assert by_r.index.to_list() == [[], [], []]
+    assert by_phi.index.to_list() == []
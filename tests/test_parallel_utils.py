@@ -0,0 +1,58 @@
+import os
+import time
+
+import pytest
+
+from calratio_training_data.parallel_utils import process_map
+
+
+def square(x: int) -> int:
+    return x * x
+
+
+def slow_square(x: int) -> int:
+    # Early items take the longest, so they finish last.
+    time.sleep(0.05 * (4 - x))
+    return x * x
+
+
+def worker_pid(_: int) -> int:
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def fail_on_three(x: int) -> int:
+    if x == 3:
+        raise ValueError("bad file 3")
+    return x
+
+
+def test_process_map_ordered():
+    assert list(process_map(slow_square, range(5), workers=5)) == [0, 1, 4, 9, 16]
+
+
+def test_process_map_unordered():
+    "Unordered gives everything back, but fast ones first"
+    results = list(process_map(slow_square, range(5), workers=5, ordered=False))
+    assert sorted(results) == [0, 1, 4, 9, 16]
+    assert results[0] == 16
+
+
+def test_process_map_runs_in_other_processes():
+    pids = set(process_map(worker_pid, range(4), workers=2))
+    assert os.getpid() not in pids
+
+
+def test_process_map_bounded_in_flight():
+    "More items than the in-flight limit still all get processed"
+    results = list(process_map(square, range(50), workers=2, max_in_flight=3))
+    assert results == [x * x for x in range(50)]
+
+
+def test_process_map_empty():
+    assert list(process_map(square, [], workers=2)) == []
+
+
+def test_process_map_exception():
+    with pytest.raises(ValueError, match="bad file 3"):
+        list(process_map(fail_on_three, range(5), workers=2))
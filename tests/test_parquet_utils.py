@@ -0,0 +1,158 @@
+from pathlib import Path
+
+import awkward as ak
+import numpy as np
+import pyarrow.parquet as pq
+
+from calratio_training_data.parquet_utils import shard_path, write_training_files
+
+
+def _jets(n: int, offset: float = 0.0) -> ak.Array:
+    "Some per-jet training data that looks like what conversion makes"
+    track_pt = ak.values_astype(
+        ak.Array([[1.0 + offset] * (i % 3) for i in range(n)]), np.float32
+    )
+    return ak.zip(
+        {
+            "pt": np.arange(n, dtype=np.float32) + offset,
+            "eta": np.zeros(n, dtype=np.float32),
+            "phi": np.zeros(n, dtype=np.float32),
+            "tracks": ak.zip(
+                {"pt": track_pt, "eta": track_pt * 0.1, "phi": track_pt * 0.2},
+                with_name="Momentum3D",
+            ),
+            "label": ak.Array([1] * n),
+            "desc_label": ak.Array(["HSS"] * n),
+        },
+        with_name="Momentum3D",
+        depth_limit=1,
+    )
+
+
+def test_shard_path():
+    assert shard_path("training.parquet", 3) == "training_003.parquet"
+    assert shard_path("out/sig.parquet", 12) == "out/sig_012.parquet"
+
+
+def test_write_one_file(tmp_path: Path):
+    "Several arrays go into a single file, one row group each"
+    data = [_jets(5), _jets(3, 10.0), _jets(4, 20.0)]
+
+    files, n_jets = write_training_files(
+        [("f1", data[0]), ("f1", data[1]), ("f2", data[2])],
+        str(tmp_path / "training.parquet"),
+        max_file_size=1_000_000_000,
+    )
+
+    assert files == [str(tmp_path / "training_000.parquet")]
+    assert n_jets == 12
+    assert pq.ParquetFile(files[0]).num_row_groups == 3
+    assert ak.from_parquet(files[0]).to_list() == ak.concatenate(data).to_list()
+
+
+def test_write_same_as_concatenate(tmp_path: Path):
+    "Streaming gives back the same array and type as writing everything at once"
+    data = [_jets(5), _jets(3, 10.0)]
+    ak.to_parquet(ak.concatenate(data), tmp_path / "all.parquet")
+
+    files, _ = write_training_files(
+        [("f1", d) for d in data],
+        str(tmp_path / "training.parquet"),
+        max_file_size=1_000_000_000,
+    )
+
+    expected = ak.from_parquet(tmp_path / "all.parquet")
+    streamed = ak.from_parquet(files[0])
+    assert streamed.type == expected.type
+    assert streamed.to_list() == expected.to_list()
+
+
+def test_write_rolls_files(tmp_path: Path):
+    "Once a file is big enough, the next source goes in a new file"
+    data = [("f1", _jets(5)), ("f2", _jets(3, 10.0)), ("f3", _jets(4, 20.0))]
+
+    files, n_jets = write_training_files(
+        data, str(tmp_path / "training.parquet"), max_file_size=1, first_index=2
+    )
+
+    assert [Path(f).name for f in files] == [
+        "training_002.parquet",
+        "training_003.parquet",
+        "training_004.parquet",
+    ]
+    assert n_jets == 12
+    assert [len(ak.from_parquet(f)) for f in files] == [5, 3, 4]
+
+
+def test_write_source_not_split(tmp_path: Path):
+    "All the data from one source goes into the same file"
+    data = [("f1", _jets(5)), ("f1", _jets(3, 10.0)), ("f2", _jets(4, 20.0))]
+
+    files, _ = write_training_files(
+        data, str(tmp_path / "training.parquet"), max_file_size=1
+    )
+
+    assert [len(ak.from_parquet(f)) for f in files] == [8, 4]
+
+
+def test_write_callback(tmp_path: Path):
+    "Told about each file as it is finished, along with the sources in it"
+    written = []
+    data = [
+        ("f0", ak.Array([])),
+        ("f1", _jets(5)),
+        ("f2", ak.Array([])),
+        ("f3", _jets(3, 10.0)),
+        ("f4", ak.Array([])),
+    ]
+
+    files, _ = write_training_files(
+        data,
+        str(tmp_path / "training.parquet"),
+        max_file_size=1,
+        on_file_written=lambda p, s, n: written.append((p, list(s), n)),
+    )
+
+    assert written == [
+        (files[0], ["f0", "f1"], 5),
+        (files[1], ["f2", "f3"], 3),
+        (None, ["f4"], 0),
+    ]
+
+
+def test_write_skips_empty(tmp_path: Path):
+    "Empty results do not make it into the files, and no data means no files"
+    files, n_jets = write_training_files(
+        [("f1", ak.Array([])), ("f2", ak.Array([]))],
+        str(tmp_path / "training.parquet"),
+        max_file_size=1,
+    )
+
+    assert files == []
+    assert n_jets == 0
+    assert list(tmp_path.iterdir()) == []
+
+    files, n_jets = write_training_files(
+        [("f1", ak.Array([])), ("f1", _jets(2)), ("f1", ak.Array([]))],
+        str(tmp_path / "training.parquet"),
+        max_file_size=1,
+    )
+    assert len(files) == 1
+    assert n_jets == 2
+
+
+def test_write_categorical_as_dictionary(tmp_path: Path):
+    "Categorical (compact schema) labels are written dictionary encoded"
+    data = _jets(5)
+    data["desc_label"] = ak.str.to_categorical(data.desc_label)
+
+    files, _ = write_training_files(
+        [("f1", data)], str(tmp_path / "training.parquet"), max_file_size=1_000_000_000
+    )
+
+    assert str(pq.read_schema(files[0]).field("desc_label").type).startswith(
+        "dictionary<values=string"
+    )
+    result = ak.from_parquet(files[0])
+    assert result.desc_label.to_list() == ["HSS"] * 5
+    assert result.desc_label.layout.parameter("__array__") == "categorical"
@@ -1,4 +1,5 @@
 import awkward as ak
+import numpy as np
 
 from calratio_training_data.processing import do_rotations
 
@@ -163,3 +164,28 @@ def test_do_rotations_msegs():
     assert ak.array_equal(
         ak.round(mseg_array, 2), correct_array
     )  # rounded for comparison
+
+
+def test_do_rotations_clusters_empty_list():
+    "A jet with no clusters has nothing to rotate to, and its list is None"
+    cluster_array = ak.values_astype(
+        ak.Array(
+            [
+                [
+                    {"pt": 1.0, "eta": 0.5, "phi": 3.0},
+                    {"pt": 2.0, "eta": -0.5, "phi": -3.0},
+                ],
+                [],
+            ],
+            with_name="Momentum3D",
+        ),
+        np.float32,
+    )
+
+    rotated = do_rotations(cluster_array, "cluster")
+
+    assert rotated.to_list()[1] is None
+    assert [c["pt"] for c in rotated.to_list()[0]] == [2.0, 1.0]
+    assert rotated.to_list()[0][0]["eta"] == 0.0
+    assert rotated.to_list()[0][1]["eta"] == 1.0
+    assert abs(rotated.to_list()[0][1]["phi"] - (2 * np.pi - 6.0)) < 1e-6
@@ -0,0 +1,81 @@
+from pathlib import Path
+
+import pytest
+
+from calratio_training_data.fetch import DataType
+from calratio_training_data.production import (
+    ProductionEntry,
+    default_output,
+    load_production_yaml,
+)
+
+
+def test_load_production_yaml(tmp_path: Path):
+    config = tmp_path / "production.yaml"
+    config.write_text("""
+datasets:
+  - dataset: mc23_13p6TeV:mc23_13p6TeV.801234.Py8_HSS_mH125_mS5.deriv.DAOD_LLP1
+    datatype: signal
+    desc-label: HSS
+    n-files: 10
+  - dataset: mc23_13p6TeV:mc23_13p6TeV.801166.Py8EG_A14NNPDF23LO_jj_JZ2.deriv.DAOD_LLP1
+    datatype: qcd
+    desc-label: JZ2
+    output: jz2.parquet
+""")
+
+    entries = load_production_yaml(config)
+
+    assert entries == [
+        ProductionEntry(
+            dataset="mc23_13p6TeV:mc23_13p6TeV.801234.Py8_HSS_mH125_mS5.deriv.DAOD_LLP1",
+            datatype=DataType.SIGNAL,
+            desc_label="HSS",
+            n_files=10,
+            output="HSS_801234.parquet",
+        ),
+        ProductionEntry(
+            dataset="mc23_13p6TeV:mc23_13p6TeV.801166.Py8EG_A14NNPDF23LO_jj_JZ2.deriv."
+            "DAOD_LLP1",
+            datatype=DataType.QCD,
+            desc_label="JZ2",
+            n_files=None,
+            output="jz2.parquet",
+        ),
+    ]
+
+
+def test_load_production_yaml_output_dir(tmp_path: Path):
+    config = tmp_path / "production.yaml"
+    config.write_text("""
+output-dir: out
+datasets:
+  - dataset: a_ds.root
+    datatype: qcd
+    desc-label: JZ2
+""")
+
+    entries = load_production_yaml(config)
+
+    assert entries[0].output == str(Path("out") / "JZ2_a_ds.parquet")
+
+
+def test_load_production_yaml_duplicate_output(tmp_path: Path):
+    "Two datasets can't write to the same files"
+    config = tmp_path / "production.yaml"
+    config.write_text("""
+datasets:
+  - dataset: a_ds
+    datatype: qcd
+    desc-label: JZ2
+  - dataset: a_ds
+    datatype: qcd
+    desc-label: JZ2
+""")
+
+    with pytest.raises(ValueError, match="JZ2_a_ds.parquet"):
+        load_production_yaml(config)
+
+
+def test_default_output_no_run_number():
+    assert default_output("/data/local/file.root", "HSS") == "HSS_file.parquet"
@@ -0,0 +1,208 @@
+import dataclasses
+import re
+import sys
+from math import cos
+from typing import Dict, Iterable, List
+
+import pytest
+import qastle
+
+from calratio_training_data.constants import (
+    CLUSTER_LAYERS,
+    JET_MSEG_DELTA_PHI,
+    JET_TRACK_DELTA_R,
+    LLP_JET_DELTA_R,
+    SKIM_MARGIN,
+)
+from calratio_training_data.fetch import DataType
+from calratio_training_data.query import build_training_query
+from calratio_training_data.training_query import training_branches
+
+
+def selection(data_type: DataType, **options) -> str:
+    "The query as the text sent to ServiceX"
+    return build_training_query(data_type, **options).generate_selection_string()
+
+
+def cpp_source(tmp_path, data_type: DataType, file="query.cxx", **options) -> str:
+    "The C++ the transformer would build from the query"
+    executor = pytest.importorskip("func_adl_xAOD.atlas.xaod.executor")
+    query = qastle.text_ast_to_python_ast(selection(data_type, **options))
+    ex = executor.atlas_xaod_executor()
+    ex.write_cpp_files(ex.apply_ast_transformations(query.body[0].value), tmp_path)
+    return (tmp_path / file).read_text()
+
+
+def branch_types(data_type: DataType, **options) -> Dict[str, type]:
+    "The name and type of each branch the query returns, as func_adl works them out"
+    query = build_training_query(data_type, **options)
+    return {f.name: f.type for f in dataclasses.fields(query.item_type)}
+
+
+def expected_branch_types(data_type: DataType) -> Dict[str, type]:
+    "The branches (and their types) the query has always returned"
+    ints = [f"track_{n}" for n in ["PixelShared", "SCTShared", "PixelHoles"]]
+    ints += [f"track_{n}" for n in ["SCTHoles", "PixelHits", "SCTHits"]]
+    floats = [f"track_{n}" for n in ["pT", "eta", "phi", "d0", "z0", "chiSquared"]]
+    floats += [f"MSeg_{n}" for n in ["x", "y", "z", "px", "py", "pz"]]
+    floats += ["MSeg_t0", "MSeg_chiSquared", "jet_pt", "jet_eta", "jet_phi"]
+    per_cluster = [f"clus_{n}" for n in ["eta", "phi", "pt", "layers", "time"]]
+    if data_type == DataType.SIGNAL:
+        ints.append("LLP_pdgid")
+        floats += [f"LLP_{n}" for n in ["eta", "phi", "pt", "Lz", "Lxy"]]
+    if data_type == DataType.BIB:
+        floats.append("jet_emf")
+    return {
+        "runNumber": int,
+        "eventNumber": int,
+        "mcEventWeight": float,
+        "track_vertex_nParticles": Iterable[int],
+        **{b: Iterable[int] for b in ints},
+        **{b: Iterable[float] for b in floats},
+        **{b: Iterable[Iterable[float]] for b in per_cluster},
+    }
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL, DataType.BIB])
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"skim_to_jets": True}, {"llp_jets_only": True}],
+    ids=["plain", "skim_to_jets", "llp_jets_only"],
+)
+def test_query_branch_types_unchanged(data_type, options):
+    """Selecting the jets once (and skimming or selecting them further) returns the
+    same branches, with the same types, without needing a C++ backend"""
+    assert branch_types(data_type, **options) == expected_branch_types(data_type)
+
+
+def queried_branches(data_type: DataType, compact_transfer=False) -> List[str]:
+    "The branches the conversion reads that the query sends"
+    not_sent = [f"clus_{layer}" for layer in CLUSTER_LAYERS]
+    not_sent += ["track_vertex_nParticles"] if compact_transfer else ["n_pv_tracks"]
+    return [b for b in training_branches(data_type) if b not in not_sent]
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL, DataType.BIB])
+def test_skim_to_jets_same_branches(data_type):
+    "The skimmed query returns every branch the conversion reads"
+    skimmed = selection(data_type, skim_to_jets=True)
+
+    for branch in queried_branches(data_type):
+        assert f"'{branch}'" in skimmed
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL])
+def test_skim_to_jets_no_extra_jet_cleaning(tmp_path, data_type):
+    "The skim loops over the jets without running the cleaning tool again"
+    (tmp_path / "plain").mkdir()
+    (tmp_path / "skimmed").mkdir()
+    plain = cpp_source(tmp_path / "plain", data_type)
+    skimmed = cpp_source(tmp_path / "skimmed", data_type, skim_to_jets=True)
+
+    assert skimmed.count("m_jetCleaning_llp->keep(") == plain.count(
+        "m_jetCleaning_llp->keep("
+    )
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL, DataType.BIB])
+def test_query_within_default_recursion_limit(data_type):
+    "All the options together can be turned into text without a deeper stack"
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(1000)
+    try:
+        options = dict(skim_to_jets=True, llp_jets_only=True, compact_transfer=True)
+        assert "'jet_pt'" in selection(data_type, **options)
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def test_skim_to_jets_only_when_asked():
+    plain = selection(DataType.QCD)
+    skimmed = selection(DataType.QCD, skim_to_jets=True)
+
+    # The cuts are a little wider than the conversion's.
+    cuts = [
+        f" {JET_TRACK_DELTA_R + SKIM_MARGIN})",
+        f" {cos(JET_MSEG_DELTA_PHI + SKIM_MARGIN)} ",
+    ]
+    for cut in cuts:
+        assert cut not in plain
+        assert cut in skimmed
+
+
+@pytest.mark.parametrize("skim_to_jets", [False, True])
+def test_llp_jets_only_signal(skim_to_jets):
+    plain = selection(DataType.SIGNAL, skim_to_jets=skim_to_jets)
+    selected = selection(DataType.SIGNAL, skim_to_jets=skim_to_jets, llp_jets_only=True)
+
+    cut = f" {LLP_JET_DELTA_R + SKIM_MARGIN})"
+    assert cut not in plain
+    assert cut in selected
+    for branch in queried_branches(DataType.SIGNAL):
+        assert f"'{branch}'" in selected
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.BIB])
+def test_llp_jets_only_ignored_without_llps(data_type):
+    "Only signal has the LLPs to select jets with"
+    assert selection(data_type, llp_jets_only=True) == selection(data_type)
+
+
+def test_cluster_layers_packed():
+    "All the layer energies come from one helper call per cluster"
+    plain = selection(DataType.QCD)
+
+    assert "'clus_layers'" in plain
+    assert plain.count("(call cluster_layer_energies c)") == 1
+    assert "'eSample')" not in plain
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL, DataType.BIB])
+def test_query_options_translate_to_cpp(tmp_path, data_type):
+    "The query, with all the options that change it, can be turned into C++"
+    source = cpp_source(tmp_path, data_type, skim_to_jets=True, llp_jets_only=True)
+
+    assert 'Branch("clus_layers"' in source
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL, DataType.BIB])
+def test_jets_selected_once_per_branch(tmp_path, data_type):
+    """Each loop over the jets (one per jet branch, and the preselection) checks each
+    jet once, and resolves its clusters only for the cluster branches"""
+    source = cpp_source(tmp_path, data_type)
+    jet_loops = len(re.findall(r"for \(auto &&\w+ : \*jets\w*\)", source))
+    jet_branches = source.count('Branch("jet_')
+    cluster_branches = source.count('Branch("clus_')
+
+    assert jet_loops == jet_branches + cluster_branches + 1
+    assert source.count("m_jetCleaning_llp->keep(") == jet_loops
+    assert source.count("originalObject(*clus)") == cluster_branches
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL, DataType.BIB])
+def test_compact_transfer_branches(data_type):
+    "Only the branches the conversion reads are sent"
+    plain = selection(data_type)
+    compact = selection(data_type, compact_transfer=True)
+
+    for branch in queried_branches(data_type, compact_transfer=True):
+        assert f"'{branch}'" in compact
+    assert "'track_vertex_nParticles'" in plain
+    assert "'track_vertex_nParticles'" not in compact
+    assert "'LLP_pdgid'" not in compact
+    assert ("'mcEventWeight'" in compact) == (data_type != DataType.BIB)
+
+
+@pytest.mark.parametrize("data_type", [DataType.QCD, DataType.SIGNAL, DataType.BIB])
+def test_compact_transfer_floats(tmp_path, data_type):
+    "The kinematics are written as float rather than double"
+    (tmp_path / "plain").mkdir()
+    (tmp_path / "compact").mkdir()
+    plain = cpp_source(tmp_path / "plain", data_type, file="query.h")
+    compact = cpp_source(
+        tmp_path / "compact", data_type, file="query.h", compact_transfer=True
+    )
+
+    assert "std::vector<double> _jet_pt" in plain
+    assert "std::vector<float> _jet_pt" in compact
+    assert "double" not in compact
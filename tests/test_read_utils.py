@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from pathlib import Path
+
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+
+from calratio_training_data.read_utils import (
+    cache_raw_chunks,
+    compact_raw_data,
+    iterate_file,
+    load_file,
+    read_ahead,
+)
+
+
+def test_read_ahead_in_order():
+    "Items come back in the order they were produced"
+    assert list(read_ahead(iter(range(10)), depth=3)) == list(range(10))
+
+
+def test_read_ahead_no_thread():
+    "Depth of zero means everything happens in the caller's thread"
+    threads = []
+
+    def items():
+        for i in range(3):
+            threads.append(threading.current_thread())
+            yield i
+
+    assert list(read_ahead(items(), depth=0)) == [0, 1, 2]
+    assert all(t is threading.current_thread() for t in threads)
+
+
+def test_read_ahead_background_thread():
+    "Items are produced on a different thread"
+    threads = []
+
+    def items():
+        for i in range(3):
+            threads.append(threading.current_thread())
+            yield i
+
+    assert list(read_ahead(items(), depth=2)) == [0, 1, 2]
+    assert all(t is not threading.current_thread() for t in threads)
+
+
+def test_read_ahead_bounded():
+    "The producer never gets more than depth items (plus the one in hand) ahead"
+    produced = []
+
+    def items():
+        for i in range(20):
+            produced.append(i)
+            yield i
+
+    it = read_ahead(items(), depth=2)
+    first = next(it)
+    time.sleep(0.2)
+    assert first == 0
+    assert len(produced) <= 4
+    assert list(it) == list(range(1, 20))
+
+
+def test_read_ahead_exception():
+    "An error while producing an item is raised in the caller"
+
+    def items():
+        yield 1
+        raise ValueError("bad file")
+
+    it = read_ahead(items(), depth=2)
+    assert next(it) == 1
+    with pytest.raises(ValueError, match="bad file"):
+        next(it)
+
+
+def test_read_ahead_early_stop():
+    "If the caller stops early the background thread shuts down"
+
+    def items():
+        i = 0
+        while True:
+            yield i
+            i += 1
+
+    it = read_ahead(items(), depth=2)
+    assert next(it) == 0
+    it.close()  # type: ignore
+
+    assert not any(t.name == "read-ahead" for t in threading.enumerate())
+
+
+def _write_sx_file(path: Path) -> Path:
+    "Write a small file that looks like a ServiceX output file"
+    with uproot.recreate(path) as f:
+        tree = f.mktree(
+            "atlas_xaod_tree",
+            {
+                "runNumber": np.uint32,
+                "jet_pt": "var * float64",
+                "LLP_pdgid": "var * int32",
+            },
+        )
+        tree.extend(
+            {
+                "runNumber": np.array([1, 2, 3], dtype=np.uint32),
+                "jet_pt": ak.Array([[50.0, 60.0], [], [70.0]]),
+                "LLP_pdgid": ak.values_astype(ak.Array([[35], [35, 35], []]), np.int32),
+            }
+        )
+    return path
+
+
+def test_load_file_all_branches(tmp_path: Path):
+    data = load_file(str(_write_sx_file(tmp_path / "sx.root")))
+
+    assert set(data.fields) >= {"runNumber", "jet_pt", "LLP_pdgid"}
+    assert data.jet_pt.to_list() == [[50.0, 60.0], [], [70.0]]
+
+
+def test_load_file_branches(tmp_path: Path):
+    "Only the requested branches come back"
+    data = load_file(str(_write_sx_file(tmp_path / "sx.root")), ["runNumber", "jet_pt"])
+
+    assert set(data.fields) == {"runNumber", "jet_pt"}
+    assert data.runNumber.to_list() == [1, 2, 3]
+
+
+def test_load_file_branches_logs_skipped(tmp_path: Path, caplog):
+    caplog.set_level(logging.DEBUG)
+    load_file(str(_write_sx_file(tmp_path / "sx.root")), ["runNumber", "jet_pt"])
+
+    assert "Skipping" in caplog.text
+    assert "MB compressed" in caplog.text
+
+
+def test_iterate_file_whole(tmp_path: Path):
+    "With no step size the whole file is one chunk"
+    chunks = list(iterate_file(str(_write_sx_file(tmp_path / "sx.root"))))
+
+    assert len(chunks) == 1
+    assert chunks[0].runNumber.to_list() == [1, 2, 3]
+
+
+def test_iterate_file_chunks(tmp_path: Path):
+    "Events come back in chunks of the step size"
+    chunks = list(
+        iterate_file(str(_write_sx_file(tmp_path / "sx.root")), ["jet_pt"], step_size=2)
+    )
+
+    assert [len(c) for c in chunks] == [2, 1]
+    assert set(chunks[0].fields) == {"jet_pt"}
+    assert ak.concatenate(chunks).jet_pt.to_list() == [[50.0, 60.0], [], [70.0]]
+
+
+def test_iterate_file_parquet(tmp_path: Path):
+    "Parquet copies of ServiceX output files are read the same way"
+    path = tmp_path / "sx.parquet"
+    ak.to_parquet(load_file(str(_write_sx_file(tmp_path / "sx.root"))), path)
+
+    whole = list(iterate_file(str(path), ["runNumber", "jet_pt"]))
+    chunks = list(iterate_file(str(path), ["jet_pt"], step_size=2))
+
+    assert set(whole[0].fields) == {"runNumber", "jet_pt"}
+    assert whole[0].runNumber.to_list() == [1, 2, 3]
+    assert [len(c) for c in chunks] == [2, 1]
+    assert ak.concatenate(chunks).jet_pt.to_list() == [[50.0, 60.0], [], [70.0]]
+
+
+def test_compact_raw_data(tmp_path: Path):
+    "Only per-object floating point columns are shrunk"
+    data = ak.zip(
+        {
+            "runNumber": np.array([1, 2], dtype=np.uint32),
+            "mcEventWeight": np.array([0.5, 1.5]),
+            "jet_pt": ak.Array([[50.1, 60.2], [70.3]]),
+            "track_PixelHits": ak.Array([[3], [4, 5]]),
+        },
+        depth_limit=1,
+    )
+
+    compact = compact_raw_data(data)
+
+    assert str(compact.runNumber.type) == "2 * uint32"
+    assert str(compact.mcEventWeight.type) == "2 * float64"
+    assert str(compact.jet_pt.type) == "2 * var * float32"
+    assert str(compact.track_PixelHits.type) == "2 * var * int64"
+    assert (
+        compact.jet_pt.to_list() == ak.values_astype(data.jet_pt, np.float32).to_list()
+    )
+
+
+def test_cache_raw_chunks(tmp_path: Path):
+    "Chunks pass through unchanged and the copy holds all of them"
+    sx_path = str(_write_sx_file(tmp_path / "sx.root"))
+    cache_path = tmp_path / "sx.parquet"
+
+    chunks = list(cache_raw_chunks(iterate_file(sx_path, step_size=2), str(cache_path)))
+
+    assert [len(c) for c in chunks] == [2, 1]
+    assert str(chunks[0].jet_pt.type) == "2 * var * float64"
+    cached = ak.from_parquet(cache_path)
+    assert cached.runNumber.to_list() == [1, 2, 3]
+    assert cached.jet_pt.to_list() == [[50.0, 60.0], [], [70.0]]
+    assert str(cached.jet_pt.type) == "3 * var * float32"
+
+
+def test_cache_raw_chunks_interrupted(tmp_path: Path):
+    "No copy is left behind if reading fails part way through"
+    sx_path = str(_write_sx_file(tmp_path / "sx.root"))
+    cache_path = tmp_path / "sx.parquet"
+
+    def chunks():
+        yield from iterate_file(sx_path, step_size=2)
+        raise RuntimeError("read failed")
+
+    with pytest.raises(RuntimeError):
+        list(cache_raw_chunks(chunks(), str(cache_path)))
+
+    assert not cache_path.exists()
@@ -0,0 +1,73 @@
+import awkward as ak
+import pytest
+
+from calratio_training_data.constants import CLUSTER_LAYERS
+from calratio_training_data.fetch import DataType
+from calratio_training_data.synthetic import Multiplicities, generate_raw_events
+from calratio_training_data.training_query import (
+    convert_to_training_data,
+    training_branches,
+)
+
+
+@pytest.mark.parametrize(
+    "data_type", [DataType.SIGNAL, DataType.QCD, DataType.DATA, DataType.BIB]
+)
+def test_generate_branches(data_type):
+    "All the branches the conversion reads are there, with the query's types"
+    data = generate_raw_events(100, data_type)
+
+    assert len(data) == 100
+    unpacked = {f"clus_{layer}" for layer in CLUSTER_LAYERS}
+    assert set(training_branches(data_type)) - set(data.fields) == unpacked | {
+        "n_pv_tracks"
+    }
+    assert str(data.jet_pt.type) == "100 * var * float64"
+    assert str(data.clus_layers.type) == "100 * var * var * float64"
+    assert ak.all(ak.num(data.clus_layers, axis=2) == 8 * ak.num(data.clus_pt, axis=2))
+    assert str(data.track_PixelHits.type) == "100 * var * int32"
+    assert ak.all(ak.num(data.clus_pt, axis=2) >= 0)
+    assert ak.all(ak.num(data.jet_pt) == ak.num(data.clus_pt))
+
+
+def test_generate_same_seed():
+    a = generate_raw_events(50, DataType.QCD, seed=3)
+    b = generate_raw_events(50, DataType.QCD, seed=3)
+    c = generate_raw_events(50, DataType.QCD, seed=4)
+
+    assert a.to_list() == b.to_list()
+    assert a.jet_pt.to_list() != c.jet_pt.to_list()
+
+
+def test_generate_pileup_adds_tracks():
+    low = generate_raw_events(500, DataType.QCD, pileup=0)
+    high = generate_raw_events(500, DataType.QCD, pileup=200)
+
+    assert ak.sum(ak.num(high.track_pT)) > ak.sum(ak.num(low.track_pT))
+
+
+def test_generate_multiplicities():
+    data = generate_raw_events(
+        10,
+        DataType.QCD,
+        pileup=0,
+        multiplicities=Multiplicities(jets=0, tracks=0, clusters_per_jet=0, msegs=0),
+    )
+
+    # There is always at least one jet.
+    assert ak.all(ak.num(data.jet_pt) == 1)
+    assert ak.sum(ak.num(data.track_pT)) == 0
+
+
+@pytest.mark.parametrize("data_type", [DataType.SIGNAL, DataType.QCD, DataType.BIB])
+def test_generate_converts(data_type):
+    "The events make it through conversion, with jets left at the end"
+    data = generate_raw_events(200, data_type)
+
+    result = convert_to_training_data(
+        data, data_type, "mc23_13p6TeV.999999.HSS_mH125_mS40_ct1.deriv", desc_label="x"
+    )
+
+    assert len(result) > 0
+    assert ak.sum(ak.num(result.tracks)) > 0
+    assert ak.sum(ak.num(result.msegs)) > 0
@@ -1,7 +1,40 @@
+import asyncio
+import json
+import time
+
 import awkward as ak
+import numpy as np
+import pytest
 
-from calratio_training_data.training_query import convert_to_training_data
+from calratio_training_data.manifest import load_manifest
+from calratio_training_data.metrics import FileMetrics, last_run_report
+from calratio_training_data.production import ProductionEntry
+from calratio_training_data.training_query import (
+    RunConfig,
+    compact_schema,
+    convert_file,
+    convert_to_training_data,
+    fetch_many_training_data_to_files,
+    fetch_training_data,
+    fetch_training_data_to_file,
+    reprocess_training_data_to_file,
+    training_branches,
+)
+from calratio_training_data.constants import (
+    CLUSTER_LAYERS,
+    JET_MSEG_DELTA_PHI,
+    JET_TRACK_DELTA_R,
+    LLP_JET_DELTA_R,
+    SKIM_MARGIN,
+    Engine,
+    LLP_central_eta_cut,
+    LLP_Lxy_max,
+    LLP_Lxy_min,
+    LLP_Lz_max,
+    LLP_Lz_min,
+)
 from calratio_training_data.fetch import DataType
+from calratio_training_data.synthetic import generate_raw_events
 
 
 def test_convert_to_training_data_mc_no_rotation():
@@ -258,6 +291,77 @@ def test_convert_to_training_data_bib_select_min_emf():
     assert "jet_emf" not in ak.fields(result)
 
 
+def test_convert_to_training_data_mseg_delta_phi_either_side():
+    """The muon segments of a jet are those with abs(jet.deltaphi(segment)) below
+    JET_MSEG_DELTA_PHI, on either side of the jet, and no others. The original
+    (signed) cut, jet.deltaphi(segment) < JET_MSEG_DELTA_PHI, also kept every segment
+    at negative deltaphi, up to pi ahead of the jet."""
+    # Segments 0.15 behind, 0.15 ahead, 1.5 ahead and 0.5 behind the jet in phi,
+    # labelled by t0.
+    mseg_phi = np.array([0.85, 1.15, 2.5, 0.5])
+    t0 = np.array([0.0, 1.0, 2.0, 3.0])
+    d_phi = (1.0 - mseg_phi + np.pi) % (2 * np.pi) - np.pi  # jet.deltaphi(segment)
+    assert d_phi[2] == pytest.approx(-1.5)
+    signed_cut = t0[d_phi < JET_MSEG_DELTA_PHI].tolist()
+    abs_cut = t0[abs(d_phi) < JET_MSEG_DELTA_PHI].tolist()
+    assert signed_cut == [0.0, 1.0, 2.0]
+    assert abs_cut == [0.0, 1.0]
+    raw_data_dict = {
+        "runNumber": ak.Array([123456]),
+        "eventNumber": ak.Array([789012]),
+        "mcEventWeight": ak.Array([1.0]),
+        "jet_pt": ak.Array([[50.0]]),
+        "jet_eta": ak.Array([[0.5]]),
+        "jet_phi": ak.Array([[1.0]]),
+        "jet_emf": ak.Array([[0.1]]),
+        "track_pT": ak.Array([[10.0]]),
+        "track_eta": ak.Array([[0.4]]),
+        "track_phi": ak.Array([[0.9]]),
+        "track_vertex_nParticles": ak.Array([[3]]),
+        "track_d0": ak.Array([[0.1]]),
+        "track_z0": ak.Array([[0.5]]),
+        "track_chiSquared": ak.Array([[1.0]]),
+        "track_PixelShared": ak.Array([[0]]),
+        "track_SCTShared": ak.Array([[0]]),
+        "track_PixelHoles": ak.Array([[0]]),
+        "track_SCTHoles": ak.Array([[0]]),
+        "track_PixelHits": ak.Array([[3]]),
+        "track_SCTHits": ak.Array([[8]]),
+        "MSeg_x": ak.Array([list(5000.0 * np.cos(mseg_phi))]),
+        "MSeg_y": ak.Array([list(5000.0 * np.sin(mseg_phi))]),
+        "MSeg_z": ak.Array([[300.0, 400.0, 500.0, 600.0]]),
+        "MSeg_px": ak.Array([list(np.cos(mseg_phi))]),
+        "MSeg_py": ak.Array([list(np.sin(mseg_phi))]),
+        "MSeg_pz": ak.Array([[0.1, 0.2, 0.3, 0.4]]),
+        "MSeg_t0": ak.Array([list(t0)]),
+        "MSeg_chiSquared": ak.Array([[1.2, 1.5, 1.7, 1.9]]),
+        "clus_eta": ak.Array([[[0.5, 0.6]]]),
+        "clus_phi": ak.Array([[[1.0, 1.1]]]),
+        "clus_pt": ak.Array([[[5.0, 6.0]]]),
+        "clus_l1hcal": ak.Array([[[100.0, 110.0]]]),
+        "clus_l2hcal": ak.Array([[[200.0, 210.0]]]),
+        "clus_l3hcal": ak.Array([[[300.0, 310.0]]]),
+        "clus_l4hcal": ak.Array([[[400.0, 410.0]]]),
+        "clus_l1ecal": ak.Array([[[500.0, 510.0]]]),
+        "clus_l2ecal": ak.Array([[[600.0, 610.0]]]),
+        "clus_l3ecal": ak.Array([[[700.0, 710.0]]]),
+        "clus_l4ecal": ak.Array([[[800.0, 810.0]]]),
+        "clus_time": ak.Array([[[-14.0, -4.0]]]),
+    }
+    raw_data = ak.Array([raw_data_dict])[0]
+
+    for engine in Engine:
+        result = convert_to_training_data(
+            raw_data, DataType.BIB, "data24_dataset", rotation=False, engine=engine
+        )
+
+        assert len(result) == 1
+        # The segment 1.5 ahead (deltaphi -1.5) is no longer kept.
+        assert result.msegs.t0[0].to_list() == abs_cut
+        assert result.msegs.t0[0].to_list() != signed_cut
+        assert result.msegs.phiPos[0].to_list() == pytest.approx([0.85, 1.15], abs=1e-5)
+
+
 def test_convert_to_training_data_bib_multiple_events():
     """Test BIB EMF selection with multiple events to verify per-event selection."""
     # Create test data with 2 events, each with 3 jets
@@ -393,6 +497,209 @@ def test_convert_to_training_data_bib_multiple_events():
     assert abs(float(result.mcEventWeight[1]) - 1.0) < 0.001
 
 
+@pytest.mark.parametrize("datatype, label", [(DataType.QCD, 0), (DataType.BIB, 2)])
+def test_convert_to_training_data_per_jet_constants(datatype, label):
+    "Every jet gets the label, the descriptive label and an empty LLP"
+    raw = generate_raw_events(50, datatype, seed=1)
+
+    result = convert_to_training_data(
+        raw, datatype, "ds", rotation=False, desc_label="JZ2"
+    )
+
+    n = len(result)
+    assert n > 0
+    assert result.label.to_list() == [label] * n
+    assert str(result.label.type) == f"{n} * int64"
+    assert result.desc_label.to_list() == ["JZ2"] * n
+    assert ak.all(ak.is_none(result.llp))
+    assert str(result.llp.type) == (
+        f"{n} * ?Momentum3D[eta: float64, phi: float64, pt: float64, Lz: float64, "
+        "Lxy: float64]"
+    )
+    if datatype == DataType.BIB:
+        assert ak.all(result.mcEventWeight == 1.0)
+
+
+@pytest.mark.parametrize("rotation", [True, False])
+@pytest.mark.parametrize("datatype", [DataType.SIGNAL, DataType.QCD, DataType.BIB])
+def test_convert_to_training_data_numba_engine_identical(datatype, rotation):
+    "The numba engine gives the same output as the default one, bit for bit"
+    pytest.importorskip("numba")
+    raw = generate_raw_events(300, datatype, seed=4)
+
+    ds_name = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+
+    expected = convert_to_training_data(raw, datatype, ds_name, rotation=rotation)
+    result = convert_to_training_data(
+        raw, datatype, ds_name, rotation=rotation, engine=Engine.NUMBA
+    )
+
+    assert len(expected) > 0
+    form, length, buffers = ak.to_buffers(ak.to_packed(result))
+    expected_form, expected_length, expected_buffers = ak.to_buffers(
+        ak.to_packed(expected)
+    )
+    assert (form, length) == (expected_form, expected_length)
+    assert buffers.keys() == expected_buffers.keys()
+    for key, buffer in buffers.items():
+        assert buffer.tobytes() == expected_buffers[key].tobytes(), key
+
+
+@pytest.mark.parametrize("datatype", [DataType.SIGNAL, DataType.QCD])
+def test_convert_to_training_data_compact(datatype):
+    "The compact schema has narrow types but the same values"
+    raw = generate_raw_events(50, datatype, seed=2)
+    ds_name = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+
+    expected = convert_to_training_data(raw, datatype, ds_name, desc_label="JZ2")
+    result = convert_to_training_data(
+        raw, datatype, ds_name, desc_label="JZ2", compact=True
+    )
+
+    assert result.to_list() == expected.to_list()
+    assert result.runNumber.type == expected.runNumber.type
+    assert result.eventNumber.type == expected.eventNumber.type
+    assert str(result.tracks.PixelHits.type) == f"{len(result)} * var * uint8"
+    assert str(result.tracks.vertex_nParticles.type) == f"{len(result)} * var * int16"
+    assert str(result.label.type) == f"{len(result)} * int8"
+    assert result.desc_label.layout.parameter("__array__") == "categorical"
+
+
+def test_compact_schema_count_too_big():
+    raw = generate_raw_events(20, DataType.QCD, seed=2)
+    result = convert_to_training_data(raw, DataType.QCD, "ds")
+    result["tracks", "PixelHits"] = result.tracks.PixelHits + 300
+
+    with pytest.raises(ValueError, match="PixelHits"):
+        compact_schema(result)
+
+
+def _skim_to_jets(raw: ak.Array) -> ak.Array:
+    "Drop the tracks and segments far from every jet, as the --skim-to-jets query does"
+    jets = ak.zip(
+        {"pt": raw.jet_pt, "eta": raw.jet_eta, "phi": raw.jet_phi},
+        with_name="Momentum3D",
+    )
+    tracks = ak.zip(
+        {"pt": raw.track_pT, "eta": raw.track_eta, "phi": raw.track_phi},
+        with_name="Momentum3D",
+    )
+    msegs = ak.zip({"x": raw.MSeg_x, "y": raw.MSeg_y}, with_name="Vector2D")
+    pairs = ak.cartesian({"obj": tracks, "jet": jets}, axis=1, nested=True)
+    near_track = ak.any(
+        pairs.obj.deltaR(pairs.jet) < JET_TRACK_DELTA_R + SKIM_MARGIN, axis=2
+    )
+    pairs = ak.cartesian({"obj": msegs, "jet": jets}, axis=1, nested=True)
+    near_mseg = ak.any(
+        abs(pairs.jet.deltaphi(pairs.obj)) < JET_MSEG_DELTA_PHI + SKIM_MARGIN, axis=2
+    )
+    skimmed = {}
+    for field in ak.fields(raw):
+        if field.startswith("track_"):
+            skimmed[field] = raw[field][near_track]
+        elif field.startswith("MSeg_"):
+            skimmed[field] = raw[field][near_mseg]
+        else:
+            skimmed[field] = raw[field]
+    assert ak.sum(near_track) < ak.count(raw.track_eta)
+    assert ak.sum(near_mseg) < ak.count(raw.MSeg_x)
+    return ak.zip(skimmed, depth_limit=1)
+
+
+@pytest.mark.parametrize("datatype", [DataType.SIGNAL, DataType.QCD, DataType.BIB])
+def test_convert_to_training_data_skimmed_same(datatype):
+    "Skimming the tracks and segments to those near jets does not change the output"
+    raw = generate_raw_events(200, datatype, seed=5)
+    ds_name = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+
+    expected = convert_to_training_data(raw, datatype, ds_name)
+    result = convert_to_training_data(_skim_to_jets(raw), datatype, ds_name)
+
+    assert len(expected) > 0
+    assert result.to_list() == expected.to_list()
+
+
+def _select_llp_jets(raw: ak.Array) -> ak.Array:
+    "Keep the jets near calorimeter LLPs, and their events, as the --llp-jets-only query"
+    llps = ak.zip(
+        {"pt": raw.LLP_pt, "eta": raw.LLP_eta, "phi": raw.LLP_phi},
+        with_name="Momentum3D",
+    )
+    jets = ak.zip(
+        {"pt": raw.jet_pt, "eta": raw.jet_eta, "phi": raw.jet_phi},
+        with_name="Momentum3D",
+    )
+    in_calorimeter = (
+        (abs(raw.LLP_eta) < LLP_central_eta_cut + SKIM_MARGIN)
+        & (raw.LLP_Lxy > LLP_Lxy_min - SKIM_MARGIN)
+        & (raw.LLP_Lxy < LLP_Lxy_max + SKIM_MARGIN)
+    ) | (
+        (abs(raw.LLP_eta) > LLP_central_eta_cut - SKIM_MARGIN)
+        & (abs(raw.LLP_Lz) > LLP_Lz_min - SKIM_MARGIN)
+        & (abs(raw.LLP_Lz) < LLP_Lz_max + SKIM_MARGIN)
+    )
+    pairs = ak.cartesian({"jet": jets, "llp": llps[in_calorimeter]}, nested=True)
+    near_llp = ak.any(
+        pairs.jet.deltaR(pairs.llp) < LLP_JET_DELTA_R + SKIM_MARGIN, axis=2
+    )
+    selected = {}
+    for field in ak.fields(raw):
+        if field.startswith("jet_") or field.startswith("clus_"):
+            selected[field] = raw[field][near_llp]
+        elif field.startswith("LLP_"):
+            selected[field] = raw[field][in_calorimeter]
+        else:
+            selected[field] = raw[field]
+    selected = ak.zip(selected, depth_limit=1)
+    assert ak.sum(near_llp) < ak.count(raw.jet_pt)
+    assert ak.sum(in_calorimeter) < ak.count(raw.LLP_eta)
+    return selected[ak.any(near_llp, axis=1)]
+
+
+def test_convert_to_training_data_llp_jets_only_same():
+    "Keeping only the jets near calorimeter LLPs does not change the output"
+    raw = generate_raw_events(200, DataType.SIGNAL, seed=6)
+    ds_name = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+    selected = _select_llp_jets(raw)
+
+    expected = convert_to_training_data(raw, DataType.SIGNAL, ds_name)
+    result = convert_to_training_data(selected, DataType.SIGNAL, ds_name)
+
+    assert len(selected) < len(raw)
+    assert len(expected) > 0
+    assert result.to_list() == expected.to_list()
+
+
+def _compact_transfer(raw: ak.Array, datatype: DataType) -> ak.Array:
+    "The raw data as the --compact-transfer query sends it"
+    kept = set(training_branches(datatype)) - {"track_vertex_nParticles"}
+    compact = {}
+    for field in ak.fields(raw):
+        if field not in kept:
+            continue
+        if field.split("_")[-1] in ("pt", "pT", "eta", "phi", "Lz", "Lxy"):
+            compact[field] = ak.values_astype(raw[field], np.float32)
+        else:
+            compact[field] = raw[field]
+    compact["n_pv_tracks"] = ak.fill_none(ak.firsts(raw.track_vertex_nParticles), 0)
+    return ak.zip(compact, depth_limit=1)
+
+
+@pytest.mark.parametrize("datatype", [DataType.SIGNAL, DataType.QCD, DataType.BIB])
+def test_convert_to_training_data_compact_transfer_same(datatype):
+    "The smaller raw files the compact transfer query sends give the same output"
+    raw = generate_raw_events(200, datatype, seed=8)
+    ds_name = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+    compact = _compact_transfer(raw, datatype)
+
+    expected = convert_to_training_data(raw, datatype, ds_name)
+    result = convert_to_training_data(compact, datatype, ds_name)
+
+    assert str(compact.jet_pt.type) == "200 * var * float32"
+    assert len(expected) > 0
+    assert result.to_list() == expected.to_list()
+
+
 def test_convert_to_training_no_near_llps():
     """Test convert_to_training_data with datatype=SIGNAL and rotation=False."""
     # Create minimal input data that matches the expected structure
@@ -468,3 +775,483 @@ def test_convert_to_training_no_near_llps():
 
     # Check that we have some jets in the output
     assert len(result) == 0
+
+
+def _qcd_raw_data() -> ak.Record:
+    "A single QCD event with two jets, in the format `run_query` returns"
+    raw_data_dict = {
+        "runNumber": ak.Array([123456]),
+        "eventNumber": ak.Array([789012]),
+        "mcEventWeight": ak.Array([1.0]),
+        "jet_pt": ak.Array([[50.0, 60.0]]),
+        "jet_eta": ak.Array([[0.5, 1.2]]),
+        "jet_phi": ak.Array([[1.0, 2.0]]),
+        "track_pT": ak.Array([[10.0, 15.0, 20.0]]),
+        "track_eta": ak.Array([[0.4, 0.6, 1.1]]),
+        "track_phi": ak.Array([[0.9, 1.1, 1.9]]),
+        "track_vertex_nParticles": ak.Array([[3, 3, 3]]),
+        "track_d0": ak.Array([[0.1, 0.2, 0.3]]),
+        "track_z0": ak.Array([[0.5, 0.6, 0.7]]),
+        "track_chiSquared": ak.Array([[1.0, 1.5, 2.0]]),
+        "track_PixelShared": ak.Array([[0, 1, 0]]),
+        "track_SCTShared": ak.Array([[0, 0, 1]]),
+        "track_PixelHoles": ak.Array([[0, 0, 0]]),
+        "track_SCTHoles": ak.Array([[0, 1, 0]]),
+        "track_PixelHits": ak.Array([[3, 4, 3]]),
+        "track_SCTHits": ak.Array([[8, 8, 7]]),
+        "MSeg_x": ak.Array([[100.0, 200.0]]),
+        "MSeg_y": ak.Array([[50.0, 100.0]]),
+        "MSeg_z": ak.Array([[300.0, 400.0]]),
+        "MSeg_px": ak.Array([[10.0, 15.0]]),
+        "MSeg_py": ak.Array([[5.0, 7.0]]),
+        "MSeg_pz": ak.Array([[30.0, 40.0]]),
+        "MSeg_t0": ak.Array([[0.0, 1.0]]),
+        "MSeg_chiSquared": ak.Array([[1.2, 1.5]]),
+        "clus_eta": ak.Array([[[0.5, 0.6], [1.2, 1.3]]]),
+        "clus_phi": ak.Array([[[1.0, 1.1], [2.0, 2.1]]]),
+        "clus_pt": ak.Array([[[5.0, 6.0], [7.0, 8.0]]]),
+        "clus_l1hcal": ak.Array([[[100.0, 110.0], [120.0, 130.0]]]),
+        "clus_l2hcal": ak.Array([[[200.0, 210.0], [220.0, 230.0]]]),
+        "clus_l3hcal": ak.Array([[[300.0, 310.0], [320.0, 330.0]]]),
+        "clus_l4hcal": ak.Array([[[400.0, 410.0], [420.0, 430.0]]]),
+        "clus_l1ecal": ak.Array([[[500.0, 510.0], [520.0, 530.0]]]),
+        "clus_l2ecal": ak.Array([[[600.0, 610.0], [620.0, 630.0]]]),
+        "clus_l3ecal": ak.Array([[[700.0, 710.0], [720.0, 730.0]]]),
+        "clus_l4ecal": ak.Array([[[800.0, 810.0], [820.0, 830.0]]]),
+        "clus_time": ak.Array([[[-14.0, -4.0], [4.0, 14.0]]]),
+    }
+    return ak.Array([raw_data_dict])[0]
+
+
+def test_convert_file(mocker):
+    "Converting a file by path reads it and converts it"
+    load = mocker.patch(
+        "calratio_training_data.training_query.iterate_file",
+        return_value=iter([_qcd_raw_data()]),
+    )
+    config = RunConfig(datatype=DataType.QCD, desc_label="JZ2", rotation=False)
+
+    path, result, metrics = convert_file("sx_output_1.root", "a_ds", config)
+
+    load.assert_called_once_with(
+        "sx_output_1.root", training_branches(DataType.QCD), None
+    )
+    assert path == "sx_output_1.root"
+    assert len(result) == 1
+    assert len(result[0]) == 2
+    assert result[0].desc_label.to_list() == ["JZ2", "JZ2"]
+    assert metrics.file == "sx_output_1.root"
+    assert (metrics.events, metrics.jets) == (1, 2)
+    assert "read" in metrics.stages
+    assert "convert.match" in metrics.stages
+
+
+def test_convert_file_chunked(mocker):
+    "Each chunk of events is converted separately"
+    load = mocker.patch(
+        "calratio_training_data.training_query.iterate_file",
+        return_value=iter([_qcd_raw_data(), _qcd_raw_data()]),
+    )
+    config = RunConfig(datatype=DataType.QCD, chunk_events=1)
+
+    _, result, _ = convert_file("sx_output_1.root", "a_ds", config)
+
+    load.assert_called_once_with("sx_output_1.root", training_branches(DataType.QCD), 1)
+    assert [len(r) for r in result] == [2, 2]
+
+
+def test_fetch_training_data_workers(mocker):
+    "With workers, only the file names are handed to the process pool"
+    mocker.patch(
+        "calratio_training_data.training_query.fetch_raw_training_files",
+        return_value=["f1.root", "f2.root"],
+    )
+    pool = mocker.patch(
+        "calratio_training_data.training_query.process_map",
+        return_value=iter(
+            [
+                ("f2.root", ["r1"], FileMetrics(file="f2.root")),
+                ("f1.root", ["r2", "r3"], FileMetrics(file="f1.root")),
+            ]
+        ),
+    )
+    config = RunConfig(datatype=DataType.QCD, workers=4, ordered=False)
+
+    results = list(fetch_training_data("a_ds", config))
+
+    assert results == ["r1", "r2", "r3"]
+    fn, files = pool.call_args.args
+    assert files == ["f1.root", "f2.root"]
+    assert pool.call_args.kwargs == {"workers": 4, "ordered": False}
+    assert fn.keywords == {"ds_name": "a_ds", "config": config}
+
+
+def test_training_branches_by_type():
+    "Each data type only reads what it needs"
+    assert "LLP_eta" in training_branches(DataType.SIGNAL)
+    assert "LLP_pdgid" not in training_branches(DataType.SIGNAL)
+    assert "jet_emf" not in training_branches(DataType.SIGNAL)
+    assert "jet_emf" in training_branches(DataType.BIB)
+    assert "LLP_eta" not in training_branches(DataType.BIB)
+    assert "mcEventWeight" not in training_branches(DataType.BIB)
+    assert "mcEventWeight" in training_branches(DataType.QCD)
+
+
+def test_training_branches_sufficient():
+    "Conversion works with only the declared branches (those the file has)"
+    raw_data = _qcd_raw_data()
+    projected = ak.zip(
+        {
+            b: raw_data[b]
+            for b in training_branches(DataType.QCD)
+            if b in raw_data.fields
+        },
+        depth_limit=1,
+    )
+
+    result = convert_to_training_data(projected, DataType.QCD, "a_ds", rotation=True)
+
+    assert len(result) == 2
+
+
+@pytest.mark.parametrize("datatype", [DataType.SIGNAL, DataType.QCD])
+def test_convert_unpacked_cluster_layers_same(datatype):
+    "Raw files with a branch for each cluster layer give the same training data"
+    raw = generate_raw_events(100, datatype, seed=7)
+    ds_name = "mc23_13p6TeV.999999.Py8EG_HSS_mH125_mS40_ct1.deriv.DAOD_LLP1"
+    layers = ak.unflatten(raw.clus_layers, len(CLUSTER_LAYERS), axis=2)
+    unpacked = {f: raw[f] for f in ak.fields(raw) if f != "clus_layers"}
+    for i, layer in enumerate(CLUSTER_LAYERS):
+        unpacked[f"clus_{layer}"] = ak.to_packed(layers[:, :, :, i])
+
+    expected = convert_to_training_data(raw, datatype, ds_name)
+    result = convert_to_training_data(
+        ak.zip(unpacked, depth_limit=1), datatype, ds_name
+    )
+
+    assert len(expected) > 0
+    assert result.to_list() == expected.to_list()
+
+
+def test_convert_chunked_identical():
+    "Converting events in chunks gives the same jets as converting them all at once"
+    one_event = _qcd_raw_data()
+    # Three events, the middle one with its jets moved a little.
+    raw_data = ak.zip(
+        {
+            k: ak.concatenate([v, v + 0.1 if k.startswith("jet") else v, v])
+            for k, v in zip(ak.fields(one_event), ak.unzip(one_event))
+        },
+        depth_limit=1,
+    )
+
+    whole = convert_to_training_data(raw_data, DataType.QCD, "a_ds", rotation=True)
+    chunks = [
+        convert_to_training_data(chunk, DataType.QCD, "a_ds", rotation=True)
+        for chunk in (raw_data[:2], raw_data[2:])
+    ]
+
+    assert ak.concatenate(chunks).to_list() == whole.to_list()
+
+
+def _mock_sx_files(mocker, files, fail_on=None):
+    "Mock ServiceX returning `files`, each with one QCD event in it"
+    mocker.patch(
+        "calratio_training_data.training_query.deliver_query", return_value=files
+    )
+
+    def iterate_file(path, branches, step_size):
+        if path == fail_on:
+            raise RuntimeError(f"Failed reading {path}")
+        yield _qcd_raw_data()
+
+    return mocker.patch(
+        "calratio_training_data.training_query.iterate_file", side_effect=iterate_file
+    )
+
+
+def test_fetch_training_data_to_file(mocker, tmp_path):
+    "Converted chunks are streamed into the training files"
+    _mock_sx_files(mocker, ["f1.root", "f2.root"])
+    output = tmp_path / "training.parquet"
+    config = RunConfig(datatype=DataType.QCD, output_path=str(output))
+
+    fetch_training_data_to_file("a_ds", config)
+
+    chunk = convert_to_training_data(_qcd_raw_data(), DataType.QCD, "a_ds")
+    result = ak.from_parquet(tmp_path / "training_000.parquet")
+    assert len(result) == 4
+    assert result.to_list() == ak.concatenate([chunk, chunk]).to_list()
+
+    manifest = load_manifest(str(tmp_path / "training_manifest.json"))
+    assert manifest is not None
+    assert manifest.completed_files() == {"f1.root", "f2.root"}
+    assert manifest.shards[0].file == "training_000.parquet"
+    assert manifest.shards[0].jets == 4
+
+
+def test_fetch_training_data_to_file_resume(mocker, tmp_path):
+    "An interrupted run only re-converts the files it had not finished"
+    output = tmp_path / "training.parquet"
+    # A tiny file size means each ServiceX file ends up in its own training file.
+    config = RunConfig(
+        datatype=DataType.QCD, output_path=str(output), max_file_size_gb=1e-12
+    )
+
+    _mock_sx_files(mocker, ["f1.root", "f2.root", "f3.root"], fail_on="f3.root")
+    with pytest.raises(RuntimeError):
+        fetch_training_data_to_file("a_ds", config)
+
+    reader = _mock_sx_files(mocker, ["f1.root", "f2.root", "f3.root"])
+    fetch_training_data_to_file("a_ds", config)
+
+    # f2 was in the file that was being written when f3 failed, so it is redone.
+    assert [c.args[0] for c in reader.call_args_list] == ["f2.root", "f3.root"]
+    manifest = load_manifest(str(tmp_path / "training_manifest.json"))
+    assert manifest is not None
+    assert [s.source_files for s in manifest.shards] == [
+        ["f1.root"],
+        ["f2.root"],
+        ["f3.root"],
+    ]
+    assert [s.index for s in manifest.shards] == [0, 1, 2]
+    assert len(ak.from_parquet(tmp_path / "training_002.parquet")) == 2
+
+
+def test_fetch_training_data_to_file_settings_changed(mocker, tmp_path):
+    "If the settings change, everything is converted again"
+    output = tmp_path / "training.parquet"
+    config = RunConfig(datatype=DataType.QCD, output_path=str(output))
+    _mock_sx_files(mocker, ["f1.root"])
+    fetch_training_data_to_file("a_ds", config)
+
+    reader = _mock_sx_files(mocker, ["f1.root"])
+    config.desc_label = "JZ3"
+    fetch_training_data_to_file("a_ds", config)
+
+    assert reader.call_count == 1
+    result = ak.from_parquet(tmp_path / "training_000.parquet")
+    assert result.desc_label.to_list() == ["JZ3", "JZ3"]
+
+
+def test_fetch_training_data_to_file_no_resume(mocker, tmp_path):
+    "Asking not to resume converts everything again"
+    output = tmp_path / "training.parquet"
+    config = RunConfig(datatype=DataType.QCD, output_path=str(output))
+    _mock_sx_files(mocker, ["f1.root"])
+    fetch_training_data_to_file("a_ds", config)
+
+    reader = _mock_sx_files(mocker, ["f1.root"])
+    config.resume = False
+    fetch_training_data_to_file("a_ds", config)
+
+    assert reader.call_count == 1
+
+
+def test_reprocess_from_raw_cache(mocker, tmp_path):
+    "Reprocessing the raw copies saved by a fetch gives the same training data"
+    _mock_sx_files(mocker, ["f1.root", "f2.root"])
+    cache = tmp_path / "raw"
+    fetch_training_data_to_file(
+        "a_ds",
+        RunConfig(
+            datatype=DataType.QCD,
+            output_path=str(tmp_path / "fetched.parquet"),
+            raw_cache_dir=str(cache),
+        ),
+    )
+    mocker.stopall()
+
+    assert sorted(p.name for p in cache.iterdir()) == [
+        "f1.parquet",
+        "f2.parquet",
+        "raw_cache.json",
+    ]
+
+    config = RunConfig(
+        datatype=DataType.QCD, output_path=str(tmp_path / "reprocessed.parquet")
+    )
+    reprocess_training_data_to_file(str(cache), config)
+
+    fetched = ak.from_parquet(tmp_path / "fetched_000.parquet")
+    reprocessed = ak.from_parquet(tmp_path / "reprocessed_000.parquet")
+    assert reprocessed.type == fetched.type
+    assert reprocessed.to_list() == fetched.to_list()
+
+    manifest = load_manifest(str(tmp_path / "reprocessed_manifest.json"))
+    assert manifest is not None
+    assert manifest.fingerprint["dataset"] == "a_ds"
+    assert manifest.completed_files() == {"f1.parquet", "f2.parquet"}
+
+
+def test_reprocess_wrong_datatype(tmp_path):
+    "Raw copies only hold the branches for the data type they were fetched as"
+    (tmp_path / "raw_cache.json").write_text('{"dataset": "a_ds", "datatype": "qcd"}')
+
+    with pytest.raises(ValueError, match="qcd"):
+        reprocess_training_data_to_file(
+            str(tmp_path), RunConfig(datatype=DataType.SIGNAL)
+        )
+
+
+def test_reprocess_no_files(tmp_path):
+    with pytest.raises(ValueError, match="No .root or .parquet"):
+        reprocess_training_data_to_file(str(tmp_path), RunConfig())
+
+
+def test_fetch_many_training_data_to_files(mocker, tmp_path):
+    "Datasets are converted as they are delivered, each to its own files"
+    delivered = {"ds_1": (0.3, ["f1.root"]), "ds_3": (0.0, ["f2.root", "f3.root"])}
+    requested = []
+
+    async def deliver_query_async(ds_name, query, config):
+        requested.append((ds_name, config.n_files))
+        if ds_name not in delivered:
+            raise RuntimeError("transform failed")
+        delay, files = delivered[ds_name]
+        await asyncio.sleep(delay)
+        return files
+
+    mocker.patch(
+        "calratio_training_data.training_query.deliver_query_async",
+        side_effect=deliver_query_async,
+    )
+    reader = _mock_sx_files(mocker, [])
+    entries = [
+        ProductionEntry(
+            "ds_1", DataType.QCD, "JZ1", n_files=1, output=str(tmp_path / "jz1.parquet")
+        ),
+        ProductionEntry(
+            "ds_2", DataType.QCD, "JZ2", output=str(tmp_path / "jz2.parquet")
+        ),
+        ProductionEntry(
+            "ds_3", DataType.QCD, "JZ3", output=str(tmp_path / "jz3.parquet")
+        ),
+    ]
+
+    failed = fetch_many_training_data_to_files(entries, RunConfig())
+
+    assert failed == ["ds_2"]
+    assert sorted(requested) == [("ds_1", 1), ("ds_2", None), ("ds_3", None)]
+    # ds_3 was delivered first, so it was converted first.
+    assert [c.args[0] for c in reader.call_args_list] == [
+        "f2.root",
+        "f3.root",
+        "f1.root",
+    ]
+    jz1 = ak.from_parquet(tmp_path / "jz1_000.parquet")
+    jz3 = ak.from_parquet(tmp_path / "jz3_000.parquet")
+    assert jz1.desc_label.to_list() == ["JZ1"] * 2
+    assert jz3.desc_label.to_list() == ["JZ3"] * 4
+    assert not (tmp_path / "jz2_000.parquet").exists()
+
+
+def test_fetch_many_converts_one_dataset_at_a_time(mocker, tmp_path):
+    """The transforms still running keep going while a dataset is converted, but
+    only one dataset is converted at a time"""
+    delays = {"ds_1": 0.0, "ds_2": 0.05, "ds_3": 0.15}
+    events = []
+
+    async def deliver_query_async(ds_name, query, config):
+        await asyncio.sleep(delays[ds_name])
+        events.append(("delivered", ds_name))
+        return [f"{ds_name}.root"]
+
+    def write_fetched_training_data(files, ds_name, query, config):
+        events.append(("start", ds_name))
+        time.sleep(0.3)
+        events.append(("end", ds_name))
+
+    mocker.patch(
+        "calratio_training_data.training_query.deliver_query_async",
+        side_effect=deliver_query_async,
+    )
+    mocker.patch(
+        "calratio_training_data.training_query.write_fetched_training_data",
+        side_effect=write_fetched_training_data,
+    )
+    entries = [
+        ProductionEntry(ds, DataType.QCD, "JZ", output=str(tmp_path / f"{ds}.parquet"))
+        for ds in delays
+    ]
+
+    assert fetch_many_training_data_to_files(entries, RunConfig()) == []
+
+    # ds_2 and ds_3 were delivered while ds_1 was being converted.
+    assert events[:4] == [
+        ("delivered", "ds_1"),
+        ("start", "ds_1"),
+        ("delivered", "ds_2"),
+        ("delivered", "ds_3"),
+    ]
+    conversions = [e for e in events if e[0] != "delivered"]
+    assert [e[0] for e in conversions] == ["start", "end"] * 3
+
+
+def test_fetch_many_training_data_to_files_new_output_dir(mocker, tmp_path):
+    "The output directory is made if it doesn't exist yet"
+
+    async def deliver_query_async(ds_name, query, config):
+        return ["f1.root"]
+
+    mocker.patch(
+        "calratio_training_data.training_query.deliver_query_async",
+        side_effect=deliver_query_async,
+    )
+    _mock_sx_files(mocker, [])
+    output = tmp_path / "training" / "jz1.parquet"
+    entries = [ProductionEntry("ds_1", DataType.QCD, "JZ1", output=str(output))]
+
+    failed = fetch_many_training_data_to_files(entries, RunConfig())
+
+    assert failed == []
+    jz1 = ak.from_parquet(tmp_path / "training" / "jz1_000.parquet")
+    assert jz1.desc_label.to_list() == ["JZ1"] * 2
+
+
+def test_fetch_training_data_to_file_metrics(mocker, tmp_path):
+    "The metrics report covers every stage and file of the run"
+    _mock_sx_files(mocker, ["f1.root", "f2.root"])
+    metrics_out = tmp_path / "metrics.json"
+    config = RunConfig(
+        datatype=DataType.QCD,
+        output_path=str(tmp_path / "training.parquet"),
+        metrics_out=str(metrics_out),
+    )
+
+    fetch_training_data_to_file("a_ds", config)
+
+    report = json.loads(metrics_out.read_text())
+    assert report["events"] == 2
+    assert report["jets"] == 4
+    assert {"query", "servicex", "read", "convert.match", "write"} <= set(
+        report["stages"]
+    )
+    assert [f["file"] for f in report["files"]] == ["f1.root", "f2.root"]
+
+
+def test_fetch_training_data_to_file_profile_memory(mocker, tmp_path, capsys):
+    "Profiling memory adds peaks for each stage and file, and leaves printing to the CLI"
+    _mock_sx_files(mocker, ["f1.root", "f2.root"])
+    # Deep tracebacks make the conversion very slow.
+    mocker.patch("calratio_training_data.metrics.TRACE_FRAMES", 1)
+    metrics_out = tmp_path / "metrics.json"
+    config = RunConfig(
+        datatype=DataType.QCD,
+        output_path=str(tmp_path / "training.parquet"),
+        metrics_out=str(metrics_out),
+        read_ahead=0,
+        profile_memory=True,
+    )
+
+    fetch_training_data_to_file("a_ds", config)
+
+    report = json.loads(metrics_out.read_text())
+    assert {"read", "convert.match", "convert.flatten", "write"} <= set(
+        report["memory"]["peak_mb"]
+    )
+    assert "convert.match" in report["files"][0]["memory"]["peak_mb"]
+    assert report["memory_profile"]["rss_peak_mb"] > 0
+    assert len(report["memory_profile"]["top_allocators"]) > 0
+    assert last_run_report() == report
+    assert capsys.readouterr().out == ""